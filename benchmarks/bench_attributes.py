@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Attribute extraction benchmark
+
+旧実装（行ごとの部分文字列判定＋インライン正規表現）と、
+プリコンパイル済みの属性レキサーの1行あたりの処理時間を比較する。
+参考として、AST全体を構築する parse_scenario の時間と、
+旧実装で4つのハンドラーがそれぞれ走査していた場合の時間も出力する。
+"""
+
+import re
+import sys
+import json
+import argparse
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from server import parse_scenario, parse_attributes, _TAG_RE, _lex_attributes
+
+SAMPLE_LINES = [
+    "*scene_{i}",
+    "[cm]",
+    '[bg storage="room_{i}.jpg" time=500]',
+    '[chara_new name="chara_{i}" storage="chara/{i}.png" jname="キャラ{i}"]',
+    '[chara_show name="chara_{i}"]',
+    "#キャラ{i}",
+    "これはテストの台詞です。{i}番目のシーン。[p]",
+    '[playbgm storage="bgm_{i}.ogg" loop=true]',
+    '[playse storage="se_{i}.ogg"]',
+    '[glink text="選択肢{i}" target="*scene_{i}" size=20 width=400 x=50 y=200]',
+    '[jump storage="chapter{i}.ks" target="*scene_{i}"]',
+    '[call target="*sub_{i}"]',
+]
+
+
+def build_scenario(lines: int) -> str:
+    """ベンチマーク用のシナリオを生成"""
+    return "\n".join(
+        SAMPLE_LINES[n % len(SAMPLE_LINES)].format(i=n // len(SAMPLE_LINES))
+        for n in range(lines)
+    )
+
+
+def legacy_scan(content: str) -> int:
+    """旧実装と同等の行ごとの走査"""
+    found = 0
+    for line in content.split("\n"):
+        line_strip = line.strip()
+        if line_strip.startswith(";") or line_strip.startswith("//"):
+            continue
+        if "[jump" in line_strip or "@jump" in line_strip or "[call" in line_strip or "[link" in line_strip or "[glink" in line_strip:
+            if re.search(r'target=["\']?\*?([^"\'\s\]]+)', line_strip):
+                found += 1
+        if "[bg" in line_strip or "[image" in line_strip or "[chara_new" in line_strip or "[chara_show" in line_strip or "[chara_mod" in line_strip:
+            if re.search(r'storage=["\']([^"\']+)["\']', line_strip):
+                found += 1
+        if "[playbgm" in line_strip or "[playse" in line_strip or "[playvideo" in line_strip or "[call" in line_strip:
+            if re.search(r'storage=["\']?([^"\'\s\]]+)', line_strip):
+                found += 1
+        if "[chara_new" in line_strip or "[chara_show" in line_strip or "[chara_hide" in line_strip or "[chara_mod" in line_strip:
+            if re.search(r'name=["\']([^"\']+)["\']', line_strip):
+                found += 1
+        if "[glink" in line_strip or "[link" in line_strip:
+            if re.search(r'text=["\']([^"\']+)["\']', line_strip):
+                found += 1
+        if line_strip and not line_strip.startswith("[") and not line_strip.startswith("*"):
+            found += len(re.sub(r'\[.*?\]', '', line_strip))
+    return found
+
+
+def lexer_scan(content: str) -> int:
+    """プリコンパイル済みレキサーによる走査（全タグの全属性を取得）"""
+    found = 0
+    for line in content.split("\n"):
+        for match in _TAG_RE.finditer(line):
+            found += len(parse_attributes(match.group(2)))
+    return found
+
+
+def full_parse(content: str) -> int:
+    """AST全体の構築"""
+    ast = parse_scenario(content)
+    return len(ast.tags)
+
+
+def legacy_four_handlers(content: str) -> int:
+    """旧実装: validate/analyze/flow/optimize がそれぞれ同じファイルを走査"""
+    return sum(legacy_scan(content) for _ in range(4))
+
+
+def cold(fn):
+    """属性のメモ化キャッシュを空にした状態で計測する"""
+    def run(content):
+        _lex_attributes.cache_clear()
+        return fn(content)
+    return run
+
+
+CASES = (
+    ("legacy_inline_regex", legacy_scan),
+    ("attribute_lexer", cold(lexer_scan)),
+    ("attribute_lexer_warm", lexer_scan),
+    ("full_parse", cold(full_parse)),
+    ("legacy_four_handlers", legacy_four_handlers),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, default=20000, help="シナリオの行数")
+    parser.add_argument("--repeat", type=int, default=5, help="計測回数（最小値を採用）")
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力")
+    args = parser.parse_args()
+
+    content = build_scenario(args.lines)
+    results = {}
+    for name, fn in CASES:
+        seconds = min(timeit.repeat(lambda: fn(content), number=1, repeat=args.repeat))
+        results[name] = {
+            "seconds": seconds,
+            "us_per_line": seconds / args.lines * 1e6,
+        }
+    speedup = {
+        "attribute_lexer_vs_legacy": results["legacy_inline_regex"]["seconds"] / results["attribute_lexer"]["seconds"],
+        "attribute_lexer_warm_vs_legacy": results["legacy_inline_regex"]["seconds"] / results["attribute_lexer_warm"]["seconds"],
+        "full_parse_vs_legacy_four_handlers": results["legacy_four_handlers"]["seconds"] / results["full_parse"]["seconds"],
+    }
+
+    if args.json:
+        print(json.dumps({"lines": args.lines, "results": results, "speedup": speedup}, indent=2))
+        return
+
+    print(f"Lines: {args.lines:,}")
+    for name, _ in CASES:
+        r = results[name]
+        print(f"  {name:<22} {r['seconds'] * 1000:8.1f} ms  {r['us_per_line']:6.2f} us/line")
+    for name, value in speedup.items():
+        print(f"  {name}: {value:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
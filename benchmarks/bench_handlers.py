@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Handler benchmark suite
+
+合成プロジェクトを生成して各ツールハンドラーの実行時間を計測し、
+コミット間で比較できるJSONを出力する。
+
+    python benchmarks/bench_handlers.py --files 300 --output bench.json
+    python benchmarks/bench_handlers.py --compare bench.json
+"""
+
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import subprocess
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+import server
+from synthetic_project import ProjectSpec, generate_project
+
+PROJECT_NAME = "bench_project"
+
+
+def reset_caches(project_path: Path):
+    """メモリ上とディスク上の解析キャッシュを破棄（コールドスタート相当）"""
+    server.scenario_cache.clear()
+    server.drop_project_index(project_path)
+    shutil.rmtree(project_path / server.PROJECT_CACHE_DIRNAME, ignore_errors=True)
+
+
+async def batch_rename_roundtrip(project_name: str):
+    """リネームして元に戻す（プロジェクトを変更したままにしない）"""
+    await server.batch_rename_handler({
+        "project_name": project_name, "pattern": r"^se(\d+)", "replacement": r"sound\1", "target_dir": "sound",
+    })
+    await server.batch_rename_handler({
+        "project_name": project_name, "pattern": r"^sound(\d+)", "replacement": r"se\1", "target_dir": "sound",
+    })
+
+
+def build_cases(project_name: str) -> dict:
+    """計測対象のハンドラーと引数"""
+    target = {"project_name": project_name, "scenario_file": "scene0000.ks"}
+    project = {"project_name": project_name}
+    return {
+        "validate_scenario": lambda: server.validate_scenario_handler(target),
+        "validate_project": lambda: server.validate_project_handler(project),
+        "analyze_project": lambda: server.analyze_project_handler(project),
+        "analyze_scenario_flow": lambda: server.analyze_scenario_flow_handler(target),
+        "optimize_resources": lambda: server.optimize_resources_handler(project),
+        "batch_rename": lambda: batch_rename_roundtrip(project_name),
+    }
+
+
+async def run_benchmarks(project_path: Path, repeat: int) -> dict:
+    results = {}
+    for name, run in build_cases(project_path.name).items():
+        reset_caches(project_path)
+        start = time.perf_counter()
+        await run()
+        cold = time.perf_counter() - start
+
+        warm = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            await run()
+            warm.append(time.perf_counter() - start)
+
+        results[name] = {"cold_s": cold, "warm_s": min(warm)}
+    return results
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(report: dict, baseline: dict | None):
+    print(f"Project: {report['project']}")
+    header = f"{'handler':<24}{'cold (ms)':>12}{'warm (ms)':>12}"
+    if baseline:
+        header += f"{'cold Δ':>10}{'warm Δ':>10}"
+    print(header)
+    for name, r in report["results"].items():
+        row = f"{name:<24}{r['cold_s'] * 1000:>12.1f}{r['warm_s'] * 1000:>12.1f}"
+        base = (baseline or {}).get("results", {}).get(name)
+        if base:
+            row += f"{r['cold_s'] / base['cold_s']:>9.2f}x{r['warm_s'] / base['warm_s']:>9.2f}x"
+        print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    for name, default in ProjectSpec().to_dict().items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default)
+    parser.add_argument("--repeat", type=int, default=3, help="ウォーム計測の回数（最小値を採用）")
+    parser.add_argument("--output", type=Path, help="結果JSONの出力先")
+    parser.add_argument("--compare", type=Path, help="比較対象の結果JSON")
+    args = parser.parse_args()
+
+    spec = ProjectSpec(**{name: getattr(args, name) for name in ProjectSpec().to_dict()})
+
+    with tempfile.TemporaryDirectory(prefix="tyrano_bench_") as tmp:
+        server.PROJECTS_DIR = Path(tmp)
+        project_path = server.PROJECTS_DIR / PROJECT_NAME
+        project_stats = generate_project(project_path, spec)
+        results = asyncio.run(run_benchmarks(project_path, args.repeat))
+        server.drop_project_index(project_path)
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "spec": spec.to_dict(),
+        "project": project_stats,
+        "results": results,
+    }
+
+    baseline = json.loads(args.compare.read_text(encoding="utf-8")) if args.compare else None
+    print_results(report, baseline)
+
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2), encoding="utf-8")
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
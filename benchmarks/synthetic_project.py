@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Synthetic TyranoScript project generator
+
+ベンチマーク用に、指定した規模のTyranoScriptプロジェクトを生成する。
+"""
+
+import random
+import argparse
+from dataclasses import dataclass, asdict
+from pathlib import Path
+
+
+@dataclass
+class ProjectSpec:
+    """生成するプロジェクトの規模"""
+    files: int = 50
+    lines_per_file: int = 1000
+    labels_per_file: int = 20
+    branching: int = 3
+    backgrounds: int = 40
+    characters: int = 10
+    bgm: int = 10
+    sounds: int = 30
+    unused_assets: float = 0.2
+    seed: int = 1
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def _scenario_name(index: int) -> str:
+    return f"scene{index:04d}.ks"
+
+
+def generate_scenario(spec: ProjectSpec, index: int, rng: random.Random) -> str:
+    """シナリオファイル1つ分を生成"""
+    used_bg = max(1, int(spec.backgrounds * (1 - spec.unused_assets)))
+    used_bgm = max(1, int(spec.bgm * (1 - spec.unused_assets)))
+    used_se = max(1, int(spec.sounds * (1 - spec.unused_assets)))
+    labels = [f"s{index}_l{n}" for n in range(spec.labels_per_file)]
+    lines_per_label = max(4, spec.lines_per_file // max(1, spec.labels_per_file))
+
+    out = []
+    if index == 0:
+        for c in range(spec.characters):
+            out.append(f'[chara_new name="chara{c}" storage="chara{c}.png" jname="キャラ{c}"]')
+
+    for n, label in enumerate(labels):
+        out.append(f"*{label}")
+        out.append("[cm]")
+        out.append(f'[bg storage="bg{rng.randrange(used_bg)}.jpg" time=500]')
+        out.append(f'[playbgm storage="bgm{rng.randrange(used_bgm)}.ogg"]')
+
+        body = lines_per_label - 6
+        for m in range(body):
+            kind = rng.random()
+            if kind < 0.1:
+                out.append(f'[chara_show name="chara{rng.randrange(max(1, spec.characters))}"]')
+            elif kind < 0.2:
+                out.append(f"#キャラ{rng.randrange(max(1, spec.characters))}")
+            elif kind < 0.25:
+                out.append(f'[playse storage="se{rng.randrange(used_se)}.ogg"]')
+            elif kind < 0.28:
+                out.append('[eval exp="f.score = f.score + 1"]')
+            else:
+                out.append(f"これは{index}番目のシナリオの{n}番目のシーン、{m}行目のテキストです。[p]")
+
+        # 分岐: 同じファイル内の後続ラベルか、次のファイルへ
+        if n + 1 < len(labels) and spec.branching > 1 and rng.random() < 0.5:
+            for b in range(spec.branching):
+                target = labels[min(len(labels) - 1, n + 1 + b)]
+                out.append(f'[glink text="選択肢{b}" target="*{target}" size=20 width=400 x=50 y={200 + b * 60}]')
+            out.append("[s]")
+        elif n + 1 < len(labels):
+            out.append(f'[jump target="*{labels[n + 1]}"]')
+        elif index + 1 < spec.files:
+            out.append(f'[jump storage="{_scenario_name(index + 1)}" target="*s{index + 1}_l0"]')
+        else:
+            out.append("[s]")
+
+    return "\n".join(out) + "\n"
+
+
+def generate_project(project_path: Path, spec: ProjectSpec) -> dict:
+    """プロジェクトを生成し、生成したファイル数などを返す"""
+    rng = random.Random(spec.seed)
+    data = project_path / "data"
+    for category in ("scenario", "bgimage", "fgimage", "image", "bgm", "sound", "video", "system"):
+        (data / category).mkdir(parents=True, exist_ok=True)
+
+    total_lines = 0
+    for index in range(spec.files):
+        content = generate_scenario(spec, index, rng)
+        total_lines += content.count("\n")
+        (data / "scenario" / _scenario_name(index)).write_text(content, encoding="utf-8")
+    (data / "scenario" / "first.ks").write_text(
+        f'*start\n[jump storage="{_scenario_name(0)}" target="*s0_l0"]\n', encoding="utf-8"
+    )
+
+    assets = {
+        "bgimage": [f"bg{n}.jpg" for n in range(spec.backgrounds)],
+        "fgimage": [f"chara{n}.png" for n in range(spec.characters)],
+        "bgm": [f"bgm{n}.ogg" for n in range(spec.bgm)],
+        "sound": [f"se{n}.ogg" for n in range(spec.sounds)],
+    }
+    for category, names in assets.items():
+        for name in names:
+            (data / category / name).write_bytes(rng.randbytes(256))
+
+    (data / "system" / "Config.tjs").write_text(";TITLE = synthetic\n", encoding="utf-8")
+
+    return {
+        "scenario_files": spec.files + 1,
+        "scenario_lines": total_lines,
+        "assets": sum(len(names) for names in assets.values()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("output", type=Path, help="生成先のプロジェクトディレクトリ")
+    for name, default in ProjectSpec().to_dict().items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args()
+
+    spec = ProjectSpec(**{name: getattr(args, name) for name in ProjectSpec().to_dict()})
+    stats = generate_project(args.output, spec)
+    print(f"Generated {args.output}: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,39 @@ TyranoStudio MCP Server
 """
 
 import os
+import re
+import asyncio
+import atexit
+import base64
+import fnmatch
+import glob
+import heapq
 import json
 import shutil
+import tempfile
+import sqlite3
+import hashlib
+import mmap
+import multiprocessing
+import queue
+import threading
+import subprocess
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, suppress
+from contextvars import ContextVar, copy_context
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
 from pathlib import Path
-from typing import Any
+from typing import Any, Awaitable, Callable
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 import mcp.types as types
 from mcp.server import Server
 from mcp.server.stdio import stdio_server
@@ -20,482 +49,2783 @@ SYSTEM_MASTER_DIR = TYRANO_BASE / "system_master"
 EXPORT_DIR = TYRANO_BASE / "export"
 DLC_DIR = TYRANO_BASE / "dlc"
 
+
+# ============================================================
+# ツール実行の計測
+# ============================================================
+
+# JSON Lines形式のトレース出力先（未設定なら出力しない）
+TRACE_FILE = os.environ.get("TYRANO_MCP_TRACE")
+
+
+@dataclass(slots=True)
+class CallMetrics:
+    """ツール呼び出し1回分のI/Oとキャッシュの計測値"""
+    bytes_read: int = 0
+    bytes_written: int = 0
+    files: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+
+
+_call_metrics: ContextVar[CallMetrics | None] = ContextVar("tyrano_call_metrics", default=None)
+# ワーカースレッドからも同じ計測値に加算するので更新をまとめて保護する
+_metrics_lock = threading.Lock()
+
+
+def record_io(bytes_read: int = 0, bytes_written: int = 0, files: int = 1):
+    """実行中のツール呼び出しにI/O量を記録"""
+    metrics = _call_metrics.get()
+    if metrics is not None:
+        with _metrics_lock:
+            metrics.bytes_read += bytes_read
+            metrics.bytes_written += bytes_written
+            metrics.files += files
+
+
+def record_cache(hits: int = 0, misses: int = 0):
+    """実行中のツール呼び出しにキャッシュのヒット/ミスを記録"""
+    metrics = _call_metrics.get()
+    if metrics is not None:
+        with _metrics_lock:
+            metrics.cache_hits += hits
+            metrics.cache_misses += misses
+
+
+def in_caller_context(fn: Callable) -> Callable:
+    """呼び出し元のコンテキスト（計測値の記録先）でfnを実行する関数を返す（スレッドプール用）
+
+    Contextは同時に複数のスレッドで使えないので、呼び出しごとに複製する。
+    """
+    context = copy_context()
+    return lambda *args: context.copy().run(fn, *args)
+
+
+class ToolStats:
+    """ツールごとの累積統計"""
+
+    # パーセンタイル計算に使う直近の実行時間の件数
+    RECENT_SAMPLES = 256
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.totals = CallMetrics()
+        self.recent: deque[float] = deque(maxlen=self.RECENT_SAMPLES)
+
+    def add(self, seconds: float, metrics: CallMetrics, ok: bool):
+        self.calls += 1
+        self.errors += 0 if ok else 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.recent.append(seconds)
+        for name in CallMetrics.__slots__:
+            setattr(self.totals, name, getattr(self.totals, name) + getattr(metrics, name))
+
+    def percentile(self, q: float) -> float:
+        if not self.recent:
+            return 0.0
+        samples = sorted(self.recent)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "total_ms": self.total_seconds * 1000,
+            "avg_ms": self.total_seconds / self.calls * 1000 if self.calls else 0.0,
+            "p50_ms": self.percentile(0.5) * 1000,
+            "p95_ms": self.percentile(0.95) * 1000,
+            "max_ms": self.max_seconds * 1000,
+            "bytes_read": self.totals.bytes_read,
+            "bytes_written": self.totals.bytes_written,
+            "files": self.totals.files,
+            "cache_hits": self.totals.cache_hits,
+            "cache_misses": self.totals.cache_misses,
+        }
+
+
+tool_stats: dict[str, ToolStats] = {}
+
+
+class TraceWriter:
+    """トレースをバックグラウンドのスレッドで追記する（ツール呼び出しをファイル書き込みで待たせない）
+
+    溜まった記録はまとめて1回の書き込みで追記する。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, record: dict):
+        self._queue.put(record)
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            with suppress(queue.Empty):
+                while True:
+                    records.append(self._queue.get_nowait())
+            lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records if record is not None)
+            if lines:
+                try:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(lines)
+                except OSError:
+                    pass
+            if None in records:
+                return
+
+    def close(self):
+        """残りの記録を書き出してスレッドを止める"""
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+
+_trace_writer: TraceWriter | None = None
+
+
+def write_trace(record: dict):
+    """トレースファイルへの追記を登録（書き込みはバックグラウンドで行う）"""
+    global _trace_writer
+    if not TRACE_FILE:
+        return
+    if _trace_writer is None:
+        _trace_writer = TraceWriter(TRACE_FILE)
+        atexit.register(_trace_writer.close)
+    _trace_writer.write(record)
+
+
+# ============================================================
+# TyranoScript パーサー
+# ============================================================
+
+# [tag attr=value ...] 形式のタグ（引用符内の ] は無視する。所有量指定子でバックトラックを防ぐ）
+_TAG_RE = re.compile(r"""\[\s*([A-Za-z_][\w-]*)((?:[^\]"']++|"[^"]*"|'[^']*')*+)\]""")
+# attr="value" / attr='value' / attr=value / attr（値なし）を1回の走査で取り出す
+# グループ: (属性名, 引用符, 値)。値は引用符の種類によらず同じグループに入る
+_ATTR_RE = re.compile(
+    r"""([^\s=\]"']+)(?:\s*=\s*(["']?)((?:(?<=")[^"]*|(?<=')[^']*|(?<!["'])[^\s"'\]]+))\2)?"""
+)
+
+# ラベルへ遷移するタグ
+JUMP_TAGS = frozenset({"jump", "call", "link", "glink"})
+
+# 制御フローグラフで扱うタグ（遷移するタグと、そこで進行が止まるタグ）
+FLOW_EDGE_TAGS = frozenset({"jump", "call", "link", "glink", "button", "clickable"})
+FLOW_STOP_TAGS = frozenset({"s", "return"})
+
+# storage属性で参照されるリソースと配置先カテゴリ
+# 素材を参照するタグ: {タグ名: ((属性名, data/ 配下のカテゴリ), ...)}
+RESOURCE_TAG_ATTRS: dict[str, tuple[tuple[str, str], ...]] = {
+    "bg": (("storage", "bgimage"),),
+    "bg2": (("storage", "bgimage"),),
+    "loadcg": (("storage", "bgimage"),),
+    "image": (("storage", "image"),),
+    "cursor": (("storage", "image"),),
+    "mask": (("graphic", "image"),),
+    "layermode": (("graphic", "image"),),
+    "layermode_movie": (("video", "video"),),
+    "chara_new": (("storage", "fgimage"),),
+    "chara_show": (("storage", "fgimage"),),
+    "chara_mod": (("storage", "fgimage"),),
+    "chara_face": (("storage", "fgimage"),),
+    "chara_layer": (("storage", "fgimage"),),
+    "button": (
+        ("graphic", "image"), ("enterimg", "image"), ("clickimg", "image"),
+        ("enterse", "sound"), ("clickse", "sound"), ("leavese", "sound"),
+    ),
+    "glink": (("enterse", "sound"), ("clickse", "sound"), ("leavese", "sound")),
+    "playbgm": (("storage", "bgm"),),
+    "fadeinbgm": (("storage", "bgm"),),
+    "xchgbgm": (("storage", "bgm"),),
+    "playse": (("storage", "sound"),),
+    "fadeinse": (("storage", "sound"),),
+    "playvideo": (("storage", "video"),),
+    "bgmovie": (("storage", "video"),),
+    "movie": (("storage", "video"),),
+}
+
+
+@dataclass(slots=True)
+class ScenarioLabel:
+    """ラベル定義 (*label)"""
+    name: str
+    line: int
+
+
+@dataclass(slots=True)
+class ScenarioTag:
+    """タグ ([tag] / @tag / #name)"""
+    name: str
+    attrs: dict[str, str]
+    line: int
+
+    @property
+    def target(self) -> str | None:
+        """target属性（先頭の*を除いたラベル名）"""
+        target = self.attrs.get("target")
+        return target.lstrip("*") if target else None
+
+
+@dataclass(slots=True)
+class ScenarioText:
+    """表示テキスト"""
+    text: str
+    line: int
+
+
+@dataclass(slots=True)
+class ScenarioScript:
+    """[iscript]〜[endscript] 内のJavaScript"""
+    code: str
+    line: int
+
+
+@dataclass(slots=True)
+class ScenarioAST:
+    """シナリオファイル1つ分の解析結果"""
+    line_count: int
+    nodes: list = field(default_factory=list)
+    labels: list[ScenarioLabel] = field(default_factory=list)
+    tags: list[ScenarioTag] = field(default_factory=list)
+    texts: list[ScenarioText] = field(default_factory=list)
+    scripts: list[ScenarioScript] = field(default_factory=list)
+
+    @property
+    def text_line_count(self) -> int:
+        return len({t.line for t in self.texts})
+
+    @property
+    def char_count(self) -> int:
+        return sum(len(t.text) for t in self.texts)
+
+
+def resource_refs(tag: "ScenarioTag"):
+    """タグが参照する素材を (カテゴリ, ファイル名) で列挙（folder属性があればそちらを優先）"""
+    for attr, category in RESOURCE_TAG_ATTRS.get(tag.name, ()):
+        storage = tag.attrs.get(attr)
+        if storage:
+            if attr in ("storage", "graphic") and tag.attrs.get("folder"):
+                category = tag.attrs["folder"]
+            yield category, storage
+
+
+# ゲーム変数（f. / sf. / tf.）とその後ろのプロパティアクセス・代入演算子
+_VARIABLE_RE = re.compile(r"(?<![\w$.])((?:f|sf|tf)\.[A-Za-z_$][\w$]*)")
+_VARIABLE_TAIL_RE = re.compile(r"(?:\s*\.\s*[A-Za-z_$][\w$]*|\s*\[[^\]]*\])*\s*(\+\+|--|=(?!=)|(?:[-+*/%&|^]|\*\*|<<|>>>?)=)?")
+_VARIABLE_PREFIX_RE = re.compile(r"(?:\+\+|--)\s*$")
+# 変数名を書き込み先として受け取るタグの属性
+VARIABLE_NAME_TAGS = {"input": "name", "edit": "name", "clearvar": "exp"}
+
+
+def variable_refs(code: str, line: int = 1):
+    """式やJavaScriptから変数の読み書きを (変数名, 行, 種類) で列挙
+
+    種類は "read" / "write"（= で代入）/ "update"（+= や ++ など、読んでから書く）。
+    """
+    for match in _VARIABLE_RE.finditer(code):
+        operator = _VARIABLE_TAIL_RE.match(code, match.end()).group(1)
+        if operator is None and _VARIABLE_PREFIX_RE.search(code, 0, match.start()):
+            operator = "++"
+        access = "read" if operator is None else "write" if operator == "=" else "update"
+        yield match.group(1), line + code.count("\n", 0, match.start()), access
+
+
+@lru_cache(maxsize=8192)
+def _lex_attributes(source: str) -> dict[str, str]:
+    # 値なし属性（引用符も値もない）はフラグとして扱う
+    return {key: value if (value or quote) else "true" for key, quote, value in _ATTR_RE.findall(source)}
+
+
+def parse_attributes(source: str) -> dict[str, str]:
+    """タグの属性文字列を辞書に変換
+
+    シナリオ中では同じ属性文字列（[p] や同じ背景指定など）が繰り返し現れるため、
+    字句解析の結果をメモ化している。
+    """
+    if not source or source.isspace():
+        return {}
+    return _lex_attributes(source).copy()
+
+
+def parse_scenario(content: str) -> ScenarioAST:
+    """TyranoScriptをトークン化してASTを構築"""
+    lines = content.split("\n")
+    ast = ScenarioAST(line_count=len(lines))
+    nodes, tags, texts, labels = ast.nodes, ast.tags, ast.texts, ast.labels
+    in_block_comment = False
+    script_lines = None
+    script_start = 0
+
+    for i, line in enumerate(lines, 1):
+        line_strip = line.strip()
+
+        # ブロックコメント
+        if in_block_comment:
+            if "*/" in line_strip:
+                in_block_comment = False
+            continue
+
+        # [iscript]内はJavaScriptとしてそのまま保持
+        if script_lines is not None:
+            if line_strip.startswith(("[endscript", "@endscript")):
+                script = ScenarioScript("\n".join(script_lines), script_start)
+                nodes.append(script)
+                ast.scripts.append(script)
+                tag = ScenarioTag("endscript", {}, i)
+                nodes.append(tag)
+                tags.append(tag)
+                script_lines = None
+            else:
+                script_lines.append(line)
+            continue
+
+        # 空行
+        if not line_strip:
+            continue
+
+        head = line_strip[0]
+
+        # コメント
+        if head == ";" or line_strip.startswith("//"):
+            continue
+        if line_strip.startswith("/*"):
+            in_block_comment = "*/" not in line_strip[2:]
+            continue
+
+        # ラベル定義 (*label|表示名)
+        if head == "*":
+            label_name = line_strip[1:].split("|", 1)[0].strip()
+            if label_name:
+                label = ScenarioLabel(label_name, i)
+                nodes.append(label)
+                labels.append(label)
+            continue
+
+        # 発言者名 (#name) は [chara_ptext] の省略形
+        if head == "#":
+            tag = ScenarioTag("chara_ptext", {"name": line_strip[1:].strip()}, i)
+            nodes.append(tag)
+            tags.append(tag)
+            continue
+
+        # 1行タグ (@tag attr=value)
+        if head == "@":
+            tag_name, _, rest = line_strip[1:].partition(" ")
+            tag = ScenarioTag(tag_name.strip(), parse_attributes(rest), i)
+            nodes.append(tag)
+            tags.append(tag)
+            if tag.name == "iscript":
+                script_lines, script_start = [], i + 1
+            continue
+
+        # タグを含まないテキスト行
+        if "[" not in line_strip:
+            text = ScenarioText(line_strip, i)
+            nodes.append(text)
+            texts.append(text)
+            continue
+
+        # テキストとインラインタグの混在行
+        pos = 0
+        for match in _TAG_RE.finditer(line_strip):
+            start = match.start()
+            if start > pos:
+                segment = line_strip[pos:start].strip()
+                if segment:
+                    text = ScenarioText(segment, i)
+                    nodes.append(text)
+                    texts.append(text)
+            tag_name, attr_source = match.groups()
+            tag = ScenarioTag(tag_name, parse_attributes(attr_source), i)
+            nodes.append(tag)
+            tags.append(tag)
+            pos = match.end()
+            if tag_name == "iscript":
+                script_lines, script_start = [], i + 1
+                break
+        else:
+            segment = line_strip[pos:].strip()
+            if segment:
+                text = ScenarioText(segment, i)
+                nodes.append(text)
+                texts.append(text)
+
+    if script_lines is not None:
+        script = ScenarioScript("\n".join(script_lines), script_start)
+        nodes.append(script)
+        ast.scripts.append(script)
+
+    return ast
+
+
+class ScenarioCache:
+    """解析済みシナリオのLRUキャッシュ
+
+    パスと (st_mtime_ns, st_size) をキーにし、変更されたファイルだけを再解析する。
+    ASTの推定メモリ量が上限を超えたら古いものから破棄する。
+    """
+
+    # ソース1バイトあたりのAST推定メモリ量
+    AST_BYTES_PER_SOURCE_BYTE = 8
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Path, tuple[tuple[int, int], int, ScenarioAST]] = OrderedDict()
+        # スレッドプールやto_threadのワーカーから同時に使われるので、LRUの操作は排他する
+        self._lock = threading.Lock()
+
+    def get(self, scenario_path: Path) -> ScenarioAST:
+        """シナリオのASTを取得（未変更ならキャッシュから）"""
+        st = scenario_path.stat()
+        key = (st.st_mtime_ns, st.st_size)
+
+        with self._lock:
+            entry = self._entries.get(scenario_path)
+            if entry and entry[0] == key:
+                self._entries.move_to_end(scenario_path)
+                self.hits += 1
+                record_cache(hits=1)
+                return entry[2]
+            self.misses += 1
+
+        record_cache(misses=1)
+        record_io(bytes_read=st.st_size)
+        ast = parse_scenario(scenario_path.read_text(encoding="utf-8"))
+        self.put(scenario_path, key, ast, st.st_size * self.AST_BYTES_PER_SOURCE_BYTE)
+        return ast
+
+    def put(self, scenario_path: Path, key: tuple[int, int], ast: ScenarioAST, cost: int):
+        """ASTを登録し、上限を超えた分を古い順に破棄"""
+        with self._lock:
+            entry = self._entries.pop(scenario_path, None)
+            if entry:
+                self.total_bytes -= entry[1]
+            if cost > self.max_bytes:
+                return
+            self._entries[scenario_path] = (key, cost, ast)
+            self.total_bytes += cost
+            while self.total_bytes > self.max_bytes:
+                _, (_, old_cost, _) = self._entries.popitem(last=False)
+                self.total_bytes -= old_cost
+
+    def apply_edit(self, scenario_path: Path, content: str):
+        """書き込んだ内容をそのまま解析して登録（ファイルは読み直さないが、全体を再解析する）"""
+        st = scenario_path.stat()
+        key = (st.st_mtime_ns, st.st_size)
+        ast = parse_scenario(content)
+        self.put(scenario_path, key, ast, st.st_size * self.AST_BYTES_PER_SOURCE_BYTE)
+
+    def invalidate(self, scenario_path: Path):
+        """指定ファイルのキャッシュを破棄"""
+        with self._lock:
+            entry = self._entries.pop(scenario_path, None)
+            if entry:
+                self.total_bytes -= entry[1]
+
+    def invalidate_tree(self, root: Path):
+        """root 以下のファイルのキャッシュをすべて破棄"""
+        with self._lock:
+            for path in [path for path in self._entries if path.is_relative_to(root)]:
+                self.total_bytes -= self._entries.pop(path)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# 解析キャッシュの上限 (MB)
+SCENARIO_CACHE_MB = int(os.environ.get("TYRANO_MCP_CACHE_MB", "64"))
+scenario_cache = ScenarioCache(SCENARIO_CACHE_MB * 1024 * 1024)
+
+
+def load_scenario(scenario_path: Path) -> ScenarioAST:
+    """シナリオファイルを解析（未変更ならキャッシュを返す）"""
+    return scenario_cache.get(scenario_path)
+
+
+# ============================================================
+# 永続プロジェクトインデックス
+# ============================================================
+
+# プロジェクト内のキャッシュディレクトリ（.gitignore対象）
+PROJECT_CACHE_DIRNAME = ".tyrano_mcp"
+INDEX_SCHEMA_VERSION = "5"
+
+
+def summarize_scenario(ast: ScenarioAST) -> dict:
+    """ASTからインデックスに保存する要約を作成"""
+    summary = {
+        "line_count": ast.line_count,
+        "text_lines": ast.text_line_count,
+        "chars": ast.char_count,
+        "labels": [[label.name, label.line] for label in ast.labels],
+        "jumps": [],  # [tag, storage, target, line]
+        "resources": [],  # [category, storage, line, tag]
+        "characters": [],
+        "flow": [],  # [tag, storage, target, line, conditional]
+        "label_chars": {},  # {ラベル名 ("" はファイル先頭): 文字数}
+        "variables": [],  # [name, line, access, tag]
+    }
+    # ラベルごとの表示文字数
+    label_lines = [label.line for label in ast.labels]
+    label_chars = summary["label_chars"]
+    for text in ast.texts:
+        position = bisect_right(label_lines, text.line) - 1
+        name = ast.labels[position].name if position >= 0 else ""
+        label_chars[name] = label_chars.get(name, 0) + len(text.text)
+    # [if] / [ignore] の中のタグは条件付きでしか実行されない
+    depth = 0
+    for tag in ast.tags:
+        if tag.name in ("if", "ignore"):
+            depth += 1
+        elif tag.name in ("endif", "endignore"):
+            depth = max(0, depth - 1)
+        if tag.name in FLOW_STOP_TAGS or (
+            tag.name in FLOW_EDGE_TAGS and (tag.target or tag.attrs.get("storage"))
+        ):
+            conditional = depth > 0 or "cond" in tag.attrs
+            summary["flow"].append([tag.name, tag.attrs.get("storage"), tag.target, tag.line, conditional])
+        if tag.name in JUMP_TAGS:
+            summary["jumps"].append([tag.name, tag.attrs.get("storage"), tag.target, tag.line])
+        for category, storage in resource_refs(tag):
+            summary["resources"].append([category, storage, tag.line, tag.name])
+        if tag.name == "chara_new" and tag.attrs.get("name"):
+            summary["characters"].append(tag.attrs["name"])
+        summary["variables"].extend(tag_variable_refs(tag))
+    for script in ast.scripts:
+        summary["variables"].extend(
+            [name, line, access, "iscript"] for name, line, access in variable_refs(script.code, script.line)
+        )
+    summary["variables"].sort(key=lambda ref: ref[1])
+    return summary
+
+
+def tag_variable_refs(tag: ScenarioTag) -> list[list]:
+    """タグの exp= / cond= / &式 / 変数名属性から変数の読み書きを取り出す"""
+    refs = []
+    target_attr = VARIABLE_NAME_TAGS.get(tag.name)
+    for attr, value in tag.attrs.items():
+        if attr == target_attr:
+            refs.extend([name, tag.line, "write", tag.name] for name, _, _ in variable_refs(value, tag.line))
+        elif attr in ("exp", "cond") or value.startswith("&"):
+            refs.extend([name, line, access, tag.name] for name, line, access in variable_refs(value, tag.line))
+    return refs
+
+
+def index_scenario_text(content: str) -> dict:
+    """シナリオのテキストを解析して要約を返す（ワーカープロセスで実行）"""
+    return summarize_scenario(parse_scenario(content))
+
+
+def _read_scenario_source(scenario_path: Path) -> tuple[str, str] | None:
+    """シナリオを読み込み (sha1, テキスト) を返す（読めなければNone）"""
+    try:
+        data = scenario_path.read_bytes()
+        return hashlib.sha1(data).hexdigest(), data.decode("utf-8")
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+# 並列解析のワーカー数（0ならCPUコア数）
+ANALYSIS_WORKERS = int(os.environ.get("TYRANO_MCP_WORKERS", "0")) or os.cpu_count() or 1
+# この件数未満ならプロセスプールを使わずその場で解析する
+PARALLEL_PARSE_THRESHOLD = 8
+
+_io_executor: ThreadPoolExecutor | None = None
+_cpu_executor: ProcessPoolExecutor | None = None
+
+
+def map_io(fn, items: list) -> list:
+    """I/Oバウンドな処理をスレッドプールで並列実行"""
+    global _io_executor
+    if len(items) < 2 or ANALYSIS_WORKERS < 2:
+        return [fn(item) for item in items]
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix="tyrano-io")
+    return list(_io_executor.map(in_caller_context(fn), items))
+
+
+def map_cpu(fn, items: list) -> list:
+    """CPUバウンドな処理をプロセスプールで並列実行"""
+    global _cpu_executor
+    if len(items) < PARALLEL_PARSE_THRESHOLD or ANALYSIS_WORKERS < 2:
+        return [fn(item) for item in items]
+    try:
+        if _cpu_executor is None:
+            # 監視やグループコミットのスレッドが動くプロセスをforkするとロックを持ったまま
+            # 複製されてデッドロックしうるので、forkserver（なければspawn）で起動する
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _cpu_executor = ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS, mp_context=context)
+        chunksize = max(1, len(items) // (ANALYSIS_WORKERS * 4))
+        return list(_cpu_executor.map(fn, items, chunksize=chunksize))
+    except (OSError, BrokenProcessPool):
+        # プロセスを作れない環境ではその場で解析する
+        _cpu_executor = None
+        return [fn(item) for item in items]
+
+
+class ResourceIndex:
+    """素材 → 参照箇所 と シナリオ → 素材集合 の双方向インデックス
+
+    シナリオ要約の resources から作り、変更されたファイル分だけ差し替える。
+    """
+
+    def __init__(self):
+        # {(category, storage): [(scenario_file, line, tag), ...]}
+        self.usages: dict[tuple[str, str], list[tuple[str, int, str]]] = {}
+        # {scenario_file: {(category, storage), ...}}
+        self.by_file: dict[str, set[tuple[str, str]]] = {}
+
+    def set_file(self, scenario_file: str, resources: list):
+        """シナリオ1ファイル分の参照を登録（既存の参照は置き換え）"""
+        self.remove_file(scenario_file)
+        keys = set()
+        for category, storage, line, tag in resources:
+            key = (category, storage)
+            self.usages.setdefault(key, []).append((scenario_file, line, tag))
+            keys.add(key)
+        self.by_file[scenario_file] = keys
+
+    def remove_file(self, scenario_file: str):
+        for key in self.by_file.pop(scenario_file, ()):
+            refs = [ref for ref in self.usages[key] if ref[0] != scenario_file]
+            if refs:
+                self.usages[key] = refs
+            else:
+                del self.usages[key]
+
+    def used(self) -> dict[str, set[str]]:
+        """{カテゴリ: 参照されているファイル名の集合}"""
+        result: dict[str, set[str]] = {}
+        for category, storage in self.usages:
+            result.setdefault(category, set()).add(storage)
+        return result
+
+    def refs_in(self, scenario_file: str) -> list[tuple[str, str, int, str]]:
+        """シナリオ内の参照 [(category, storage, line, tag)]（行順）"""
+        refs = [
+            (category, storage, line, tag)
+            for category, storage in self.by_file.get(scenario_file, ())
+            for file, line, tag in self.usages[(category, storage)]
+            if file == scenario_file
+        ]
+        return sorted(refs, key=lambda ref: ref[2])
+
+    def find(self, query: str, category: str | None = None) -> dict[tuple[str, str], list[tuple[str, int, str]]]:
+        """ファイル名（パス・ファイル名のみ・globのいずれか）で参照箇所を検索"""
+        if category and (category, query) in self.usages:
+            return {(category, query): list(self.usages[(category, query)])}
+        glob_query = any(c in query for c in "*?[")
+        result = {}
+        for key, refs in self.usages.items():
+            if category and key[0] != category:
+                continue
+            storage = key[1]
+            name = storage.rsplit("/", 1)[-1]
+            if storage == query or name == query or (
+                glob_query and (fnmatch.fnmatch(storage, query) or fnmatch.fnmatch(name, query))
+            ):
+                result[key] = list(refs)
+        return result
+
+
+class VariableIndex:
+    """変数 → 読み書きの箇所 の逆引きインデックス（def-use表）
+
+    書かれずに読まれるだけの変数、書かれるだけで読まれない変数の集合を
+    ファイル単位の差し替えのたびに更新しておき、問い合わせはそのまま返す。
+    """
+
+    def __init__(self):
+        # {name: [(scenario_file, line, tag), ...]}（"update" は両方に入る）
+        self.reads: dict[str, list[tuple[str, int, str]]] = {}
+        self.writes: dict[str, list[tuple[str, int, str]]] = {}
+        # {scenario_file: {name, ...}}
+        self.by_file: dict[str, set[str]] = {}
+        self.unwritten: set[str] = set()
+        self.unread: set[str] = set()
+
+    def set_file(self, scenario_file: str, variables: list):
+        """シナリオ1ファイル分の読み書きを登録（既存の分は置き換え）"""
+        self.remove_file(scenario_file)
+        names = set()
+        for name, line, access, tag in variables:
+            if access != "write":
+                self.reads.setdefault(name, []).append((scenario_file, line, tag))
+            if access != "read":
+                self.writes.setdefault(name, []).append((scenario_file, line, tag))
+            names.add(name)
+        self.by_file[scenario_file] = names
+        self._classify(names)
+
+    def remove_file(self, scenario_file: str):
+        names = self.by_file.pop(scenario_file, set())
+        for table in (self.reads, self.writes):
+            for name in names:
+                refs = [ref for ref in table.get(name, ()) if ref[0] != scenario_file]
+                if refs:
+                    table[name] = refs
+                else:
+                    table.pop(name, None)
+        self._classify(names)
+
+    def _classify(self, names: set[str]):
+        for name in names:
+            read, written = name in self.reads, name in self.writes
+            self.unwritten.discard(name)
+            self.unread.discard(name)
+            if read and not written:
+                self.unwritten.add(name)
+            elif written and not read:
+                self.unread.add(name)
+
+    def names(self) -> set[str]:
+        return self.reads.keys() | self.writes.keys()
+
+    def usages(self, name: str) -> tuple[list[tuple[str, int, str]], list[tuple[str, int, str]]]:
+        """変数の (代入箇所, 参照箇所)（ファイル・行順）"""
+        return sorted(self.writes.get(name, ())), sorted(self.reads.get(name, ()))
+
+    def report(self) -> tuple[int, list[tuple[str, tuple[str, int, str]]], list[tuple[str, tuple[str, int, str]]]]:
+        """(変数の数, [(代入されずに参照される変数, 初出)], [(参照されない変数, 初出)])"""
+        return (
+            len(self.names()),
+            [(name, min(self.reads[name])) for name in sorted(self.unwritten)],
+            [(name, min(self.writes[name])) for name in sorted(self.unread)],
+        )
+
+
+class ProjectIndex:
+    """プロジェクトのシナリオ要約を保持するオンディスクインデックス
+
+    data/scenario 内の各 .ks について、ラベル・ジャンプ・リソース参照・
+    キャラクター定義を内容ハッシュとともに SQLite に保存する。
+    サーバー再起動後も、変更されたファイルだけを再インデックスする。
+    """
+
+    def __init__(self, project_path: Path):
+        self.project_path = project_path
+        self.scenario_dir = project_path / "data" / "scenario"
+        self.db_path = project_path / PROJECT_CACHE_DIRNAME / "index.sqlite"
+        self._lock = threading.Lock()
+        self._db = None
+        # {file_name: (mtime_ns, size, sha1, summary)}
+        self._entries: dict[str, tuple[int, int, str, dict]] = {}
+        self._resources: ResourceIndex | None = None
+        self._variables: VariableIndex | None = None
+
+    def _connect(self):
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # 既存のGitリポジトリでもキャッシュがコミットされないよう、ディレクトリごと無視させる
+        gitignore = self.db_path.parent / ".gitignore"
+        if not gitignore.exists():
+            gitignore.write_text("*\n", encoding="utf-8")
+        db = sqlite3.connect(self.db_path, check_same_thread=False)
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        row = db.execute("SELECT value FROM meta WHERE key = 'schema'").fetchone()
+        if not row or row[0] != INDEX_SCHEMA_VERSION:
+            db.execute("DROP TABLE IF EXISTS scenarios")
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('schema', ?)", (INDEX_SCHEMA_VERSION,))
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS scenarios ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, sha1 TEXT, summary TEXT)"
+        )
+        db.commit()
+        for path, mtime_ns, size, sha1, summary in db.execute("SELECT * FROM scenarios"):
+            self._entries[path] = (mtime_ns, size, sha1, json.loads(summary))
+        return db
+
+    def refresh(self) -> dict[str, dict]:
+        """変更されたファイルだけを再インデックスし、{ファイル名: 要約} を返す"""
+        with self._lock:
+            if self._db is None:
+                self._db = self._connect()
+
+            current = {}
+            if self.scenario_dir.exists():
+                with os.scandir(self.scenario_dir) as it:
+                    for entry in it:
+                        if entry.name.endswith(".ks") and entry.is_file():
+                            st = entry.stat()
+                            current[entry.name] = (st.st_mtime_ns, st.st_size)
+
+            stale = [
+                name for name, stat_key in current.items()
+                if name not in self._entries or self._entries[name][:2] != stat_key
+            ]
+
+            record_cache(hits=len(current) - len(stale), misses=len(stale))
+            record_io(bytes_read=sum(current[name][1] for name in stale), files=len(stale))
+
+            # 読み込みとハッシュ計算はスレッドプールで並列化
+            loaded = map_io(_read_scenario_source, [self.scenario_dir / name for name in stale])
+
+            to_parse = []
+            updates = []
+            for name, result in zip(stale, loaded):
+                if result is None:
+                    current.pop(name)
+                    continue
+                sha1, text = result
+                cached = self._entries.get(name)
+                if cached and cached[2] == sha1:
+                    self._store(name, current[name], sha1, cached[3], updates)
+                else:
+                    to_parse.append((name, sha1, text))
+
+            # 解析はCPUバウンドなのでプロセスプールで並列化
+            summaries = map_cpu(index_scenario_text, [text for _, _, text in to_parse])
+            for (name, sha1, _), summary in zip(to_parse, summaries):
+                self._store(name, current[name], sha1, summary, updates)
+
+            removed = [name for name in self._entries if name not in current]
+            for name in removed:
+                del self._entries[name]
+                if self._resources is not None:
+                    self._resources.remove_file(name)
+                if self._variables is not None:
+                    self._variables.remove_file(name)
+
+            if updates or removed:
+                self._db.executemany("INSERT OR REPLACE INTO scenarios VALUES (?, ?, ?, ?, ?)", updates)
+                self._db.executemany("DELETE FROM scenarios WHERE path = ?", [(n,) for n in removed])
+                self._db.commit()
+
+            return {name: entry[3] for name, entry in self._entries.items()}
+
+    def query_resources(self, query: Callable[[ResourceIndex], Any], refresh: bool = True):
+        """素材の参照インデックスに問い合わせる（変更されたファイルだけ差し替える）
+
+        インデックスは更新時にその場で書き換わるので、query はロックを保持したまま実行する。
+        query はインデックス内部のリストや集合をそのまま返さず、複製して返すこと。
+        """
+        if refresh or self._db is None:
+            self.refresh()
+        with self._lock:
+            if self._resources is None:
+                self._resources = ResourceIndex()
+                for name, entry in self._entries.items():
+                    self._resources.set_file(name, entry[3]["resources"])
+            return query(self._resources)
+
+    def query_variables(self, query: Callable[[VariableIndex], Any], refresh: bool = True):
+        """変数の読み書きのインデックスに問い合わせる（query_resources と同じくロックを保持したまま実行）"""
+        if refresh or self._db is None:
+            self.refresh()
+        with self._lock:
+            if self._variables is None:
+                self._variables = VariableIndex()
+                for name, entry in self._entries.items():
+                    self._variables.set_file(name, entry[3]["variables"])
+            return query(self._variables)
+
+    def _store(self, name: str, stat_key: tuple[int, int], sha1: str, summary: dict, updates: list):
+        self._entries[name] = (*stat_key, sha1, summary)
+        if self._resources is not None:
+            self._resources.set_file(name, summary["resources"])
+        if self._variables is not None:
+            self._variables.set_file(name, summary["variables"])
+        updates.append((name, *stat_key, sha1, json.dumps(summary, ensure_ascii=False)))
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+            self._entries.clear()
+            self._resources = None
+            self._variables = None
+
+
+_project_indexes: dict[Path, ProjectIndex] = {}
+
+
+def get_project_index(project_path: Path) -> ProjectIndex:
+    """プロジェクトのインデックスを取得（なければ作成）"""
+    index = _project_indexes.get(project_path)
+    if index is None:
+        index = _project_indexes[project_path] = ProjectIndex(project_path)
+    return index
+
+
+def drop_project_index(project_path: Path):
+    """プロジェクトのインデックスを閉じて破棄"""
+    index = _project_indexes.pop(project_path, None)
+    if index:
+        index.close()
+
+
+def warm_project_indexes():
+    """起動時に全プロジェクトのインデックスを検証・更新"""
+    if not PROJECTS_DIR.exists():
+        return
+    for project_path in PROJECTS_DIR.iterdir():
+        if (project_path / "data" / "scenario").is_dir():
+            try:
+                get_project_index(project_path).refresh()
+            except Exception:
+                pass
+
+
+# ============================================================
+# 安全な書き込み（一時ファイル + fsync + os.replace）
+# ============================================================
+
+# グループコミットの待ち合わせ時間（ミリ秒、0で無効）
+GROUP_COMMIT_MS = float(os.environ.get("TYRANO_MCP_GROUP_COMMIT_MS", "0"))
+
+# write_batch() の中で遅延しているディレクトリfsync（Noneなら即時に行う）
+_pending_dir_syncs: ContextVar[set[Path] | None] = ContextVar("pending_dir_syncs", default=None)
+
+
+def fsync_directory(directory: Path):
+    """renameの結果（ディレクトリエントリ）を永続化"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # Windowsなどディレクトリをopenできない環境では何もしない
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def sync_directory(directory: Path):
+    """ディレクトリをfsync（write_batch() の中ではブロックの最後にまとめて行う）"""
+    pending = _pending_dir_syncs.get()
+    if pending is None:
+        fsync_directory(directory)
+    else:
+        pending.add(directory)
+
+
+@contextmanager
+def write_batch():
+    """複数ファイルを書き込む操作で、ディレクトリのfsyncを最後に1回ずつにまとめる"""
+    pending: set[Path] = set()
+    token = _pending_dir_syncs.set(pending)
+    try:
+        yield
+    finally:
+        _pending_dir_syncs.reset(token)
+        for directory in pending:
+            fsync_directory(directory)
+
+
+@dataclass(slots=True)
+class CommitTicket:
+    """グループコミットを待つ書き込み"""
+    event: threading.Event = field(default_factory=threading.Event)
+    error: BaseException | None = None
+
+
+class GroupCommitter:
+    """短時間に集中した書き込みをまとめて永続化する
+
+    書き込み側は一時ファイルの作成までを行って登録し、待ち合わせ時間の後に
+    fsync → os.replace → ディレクトリfsync をまとめて実行する。
+    同じファイルへの書き込みが重なった場合は最後の内容だけを永続化する。
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self.batches = 0
+        self.files = 0
+        self.coalesced = 0
+        self._pending: dict[Path, tuple[str, list[CommitTicket]]] = {}
+        self._timer: threading.Timer | None = None
+        self._lock = threading.Lock()
+
+    def submit(self, tmp_name: str, path: Path):
+        """一時ファイルを登録し、永続化されるまで待つ"""
+        ticket = CommitTicket()
+        with self._lock:
+            previous = self._pending.get(path)
+            tickets = [ticket]
+            if previous:
+                # 古い内容はfsyncせずに捨てる
+                with suppress(FileNotFoundError):
+                    os.unlink(previous[0])
+                tickets = previous[1] + tickets
+                self.coalesced += 1
+            self._pending[path] = (tmp_name, tickets)
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        ticket.event.wait()
+        if ticket.error:
+            raise ticket.error
+
+    def flush(self):
+        """登録済みの書き込みをまとめて永続化"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._timer = None
+        if not batch:
+            return
+
+        directories = set()
+        results = []
+        for path, (tmp_name, tickets) in batch.items():
+            error = None
+            try:
+                fd = os.open(tmp_name, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                os.replace(tmp_name, path)
+                directories.add(path.parent)
+            except OSError as e:
+                error = e
+                with suppress(FileNotFoundError):
+                    os.unlink(tmp_name)
+            results.append((tickets, error))
+
+        for directory in directories:
+            fsync_directory(directory)
+
+        self.batches += 1
+        self.files += len(batch)
+        for tickets, error in results:
+            for ticket in tickets:
+                ticket.error = error
+                ticket.event.set()
+
+    def to_dict(self) -> dict:
+        return {
+            "window_ms": self.window * 1000,
+            "batches": self.batches,
+            "files": self.files,
+            "coalesced": self.coalesced,
+        }
+
+
+group_committer = GroupCommitter(GROUP_COMMIT_MS / 1000) if GROUP_COMMIT_MS > 0 else None
+
+
+# ============================================================
+# 非同期I/Oヘルパー
+# ============================================================
+
+def read_text_file(path: Path) -> str:
+    """テキストファイルを読み込む"""
+    content = path.read_text(encoding="utf-8")
+    record_io(bytes_read=len(content.encode("utf-8")))
+    return content
+
+
+# 新規ファイルの権限に使うumask（取得には一度設定し直す必要があるので起動時に読む）
+FILE_UMASK = os.umask(0)
+os.umask(FILE_UMASK)
+
+
+def detect_newline(text: str) -> str:
+    """改行コードを判定（最初に見つかった改行に合わせる。改行がなければ LF）"""
+    position = text.find("\n")
+    if position > 0 and text[position - 1] == "\r":
+        return "\r\n"
+    if position == -1 and "\r" in text:
+        return "\r"
+    return "\n"
+
+
+def write_text_file(path: Path, content: str, newline: str = "\n"):
+    """テキストファイルを安全に書き込む（一時ファイル → fsync → os.replace。親ディレクトリも作成）
+
+    content の改行は LF で渡し、newline で書き込む改行コードを指定する。
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(prefix=f".{path.name}.", suffix=".tmp", dir=path.parent)
+    try:
+        # mkstempは0600で作るので、既存ファイルの権限を引き継ぐ（新規ならumaskに従う）
+        try:
+            mode = path.stat().st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o666 & ~FILE_UMASK
+        os.chmod(tmp_name, mode)
+        with os.fdopen(fd, "w", encoding="utf-8", newline=newline) as f:
+            f.write(content)
+            if group_committer is None:
+                f.flush()
+                os.fsync(f.fileno())
+        if group_committer is None:
+            os.replace(tmp_name, path)
+            sync_directory(path.parent)
+        else:
+            group_committer.submit(tmp_name, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_name)
+        raise
+    record_io(bytes_written=len(content.encode("utf-8")) + content.count("\n") * (len(newline) - 1))
+    notify_changed(path)
+
+
+def copy_file(source_path: Path, dest_path: Path):
+    """ファイルをコピー（配置先ディレクトリも作成）"""
+    dest_path.parent.mkdir(parents=True, exist_ok=True)
+    if USE_ASSET_STORE:
+        # 同じ内容の実体が既にあればリンクするだけで書き込みは発生しない
+        copied = asset_store().import_file(source_path, dest_path)
+        if copied:
+            record_io(bytes_written=dest_path.stat().st_size, files=0)
+        notify_changed(dest_path)
+        return
+    # ハードリンクされたファイルに上書きするとリンク元まで変わるので、先にリンクを外す
+    with suppress(FileNotFoundError):
+        if dest_path.stat().st_nlink > 1:
+            dest_path.unlink()
+    shutil.copy2(source_path, dest_path)
+    size = dest_path.stat().st_size
+    record_io(bytes_read=size, bytes_written=size)
+    notify_changed(dest_path)
+
+
+def list_dir_files(directory: Path) -> list[os.DirEntry]:
+    """ディレクトリ直下のファイル一覧（存在しなければ空）"""
+    if not directory.is_dir():
+        return []
+    with os.scandir(directory) as it:
+        return [entry for entry in it if entry.is_file()]
+
+
+def file_sizes(directory: Path) -> dict[str, int]:
+    """ディレクトリ直下のファイルの {ファイル名: サイズ}"""
+    return {entry.name: entry.stat().st_size for entry in list_dir_files(directory)}
+
+
+# list_project_files が1回に返す既定の件数
+FILE_LIST_LIMIT = 500
+
+
+@dataclass(slots=True)
+class FileListing:
+    """ファイル一覧の1エントリ"""
+    path: str  # 起点からの相対パス（/区切り）
+    is_dir: bool
+    size: int
+    mtime_ns: int
+
+
+def scan_files(root: Path, max_depth: int = 1, pattern: str = "", extensions: frozenset[str] = frozenset()) -> list[FileListing]:
+    """os.scandirでファイルを列挙（DirEntryのstatキャッシュを使う）
+
+    max_depth=1 で直下のみ、0 以下で無制限。ドット始まりのディレクトリと、
+    ディレクトリへのシンボリックリンク（循環するおそれがある）には降りない。
+    pattern / extensions を指定した場合はファイルだけを返す。
+    """
+    filtered = bool(pattern or extensions)
+    results = []
+    stack = [(root, "", 1)]
+    while stack:
+        directory, prefix, depth = stack.pop()
+        try:
+            it = os.scandir(directory)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                rel = prefix + entry.name
+                if entry.is_dir():
+                    descend = entry.is_dir(follow_symlinks=False) and not entry.name.startswith(".")
+                    if descend and (max_depth <= 0 or depth < max_depth):
+                        stack.append((entry.path, rel + "/", depth + 1))
+                    if not filtered:
+                        results.append(FileListing(rel, True, 0, entry.stat().st_mtime_ns))
+                    continue
+                if extensions and os.path.splitext(entry.name)[1].lower() not in extensions:
+                    continue
+                if pattern and not (fnmatch.fnmatch(rel, pattern) or fnmatch.fnmatch(entry.name, pattern)):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    # リンク切れのシンボリックリンク
+                    continue
+                results.append(FileListing(rel, False, st.st_size, st.st_mtime_ns))
+    return results
+
+
+# ファイル一覧の並び替えキー（同じ値の場合はパス順）
+FILE_SORT_KEYS: dict[str, Callable[[FileListing], tuple]] = {
+    "name": lambda f: (not f.is_dir, f.path),
+    "size": lambda f: (f.size, f.path),
+    "mtime": lambda f: (f.mtime_ns, f.path),
+}
+
+
+def encode_cursor(key: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key, ensure_ascii=False).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        return tuple(json.loads(base64.urlsafe_b64decode(cursor.encode("ascii"))))
+    except (ValueError, TypeError):
+        raise ValueError("cursor が不正です")
+
+
+def page_files(files: list[FileListing], sort: str, descending: bool, limit: int, cursor: str | None) -> tuple[list[FileListing], str | None]:
+    """並び替えてcursorの次から limit 件を取り出す（全件ソートせずヒープで選ぶ）"""
+    key = FILE_SORT_KEYS[sort]
+    if cursor:
+        after = decode_cursor(cursor)
+        try:
+            if descending:
+                files = [f for f in files if key(f) < after]
+            else:
+                files = [f for f in files if key(f) > after]
+        except TypeError:
+            # 別の sort で発行された cursor
+            raise ValueError("cursor が不正です")
+    select = heapq.nlargest if descending else heapq.nsmallest
+    page = select(limit + 1, files, key=key)
+    if len(page) <= limit:
+        return page, None
+    page = page[:limit]
+    return page, encode_cursor(key(page[-1]))
+
+
+async def run_command(args: list[str], cwd: Path) -> subprocess.CompletedProcess:
+    """外部コマンドをイベントループを止めずに実行"""
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        cwd=cwd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await proc.communicate()
+    return subprocess.CompletedProcess(
+        args,
+        proc.returncode,
+        stdout.decode("utf-8", errors="replace"),
+        stderr.decode("utf-8", errors="replace"),
+    )
+
+
+# ============================================================
+# プロジェクトの複製（reflink / ハードリンク）
+# ============================================================
+
+# プロジェクト作成時の既定の複製方法 (copy: 全コピー, link: reflink/ハードリンク)
+DEFAULT_COPY_MODE = os.environ.get("TYRANO_MCP_COPY_MODE", "copy")
+
+# Linux の FICLONE ioctl（Btrfs / XFS などでデータブロックを共有した独立コピーを作る）
+FICLONE = 0x40049409
+
+# ユーザーが編集するためハードリンクしないディレクトリ（プロジェクト直下のファイルも実体を持たせる）
+EDITABLE_DIRS = frozenset({"data"})
+
+# reflink に失敗した (コピー元デバイス, コピー先デバイス) の組み合わせ
+_reflink_unsupported: set[tuple[int, int]] = set()
+
+
+def reflink_file(source_path: Path, dest_path: Path) -> bool:
+    """reflink でコピー（非対応ならFalseを返し、何も残さない）"""
+    if fcntl is None:
+        return False
+    devices = (source_path.stat().st_dev, dest_path.parent.stat().st_dev)
+    if devices in _reflink_unsupported:
+        return False
+    try:
+        with open(source_path, "rb") as src, open(dest_path, "wb") as dest:
+            fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+    except OSError:
+        _reflink_unsupported.add(devices)
+        with suppress(FileNotFoundError):
+            dest_path.unlink()
+        return False
+    shutil.copystat(source_path, dest_path)
+    return True
+
+
+@dataclass(slots=True)
+class CloneStats:
+    """複製方法ごとのファイル数"""
+    reflinked: int = 0
+    linked: int = 0
+    copied: int = 0
+    bytes_copied: int = 0
+
+
+def clone_template(template_path: Path, project_path: Path) -> CloneStats:
+    """テンプレートを複製（reflink → エンジンファイルはハードリンク → コピーの順に試す）
+
+    data/ とプロジェクト直下のファイルは編集されるため、reflink できなければ実コピーする。
+    """
+    stats = CloneStats()
+    for root, _, files in os.walk(template_path):
+        relative = Path(root).relative_to(template_path)
+        dest_dir = project_path / relative
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        editable = not relative.parts or relative.parts[0] in EDITABLE_DIRS
+
+        for name in files:
+            source, dest = Path(root) / name, dest_dir / name
+            if reflink_file(source, dest):
+                stats.reflinked += 1
+                continue
+            if not editable:
+                try:
+                    os.link(source, dest)
+                    stats.linked += 1
+                    continue
+                except OSError:
+                    # 別デバイスなどハードリンクできない場合はコピー
+                    pass
+            shutil.copy2(source, dest)
+            stats.copied += 1
+            stats.bytes_copied += dest.stat().st_size
+
+    record_io(bytes_read=stats.bytes_copied, bytes_written=stats.bytes_copied,
+              files=stats.reflinked + stats.linked + stats.copied)
+    return stats
+
+
+# ============================================================
+# 行オフセットインデックス（範囲読み込み）
+# ============================================================
+
+# 行頭が *ラベル の行（ブロックコメント内なども拾うが、範囲の区切りとしては十分）
+_LABEL_LINE_RE = re.compile(rb"^[ \t]*\*([^|\r\n]*)", re.MULTILINE)
+
+# offset指定で読み込むときの既定の最大バイト数
+DEFAULT_READ_BYTES = 64 * 1024
+
+
+@dataclass(slots=True)
+class LineIndex:
+    """シナリオファイルの行頭バイトオフセットとラベル位置"""
+    key: tuple[int, int]
+    size: int
+    offsets: array = field(default_factory=lambda: array("q", [0]))
+    labels: dict[str, int] = field(default_factory=dict)
+    label_lines: list[int] = field(default_factory=list)
+
+    @property
+    def line_count(self) -> int:
+        return len(self.offsets)
+
+    def line_of(self, offset: int) -> int:
+        """バイトオフセットを含む行番号（1始まり）"""
+        return bisect_right(self.offsets, offset)
+
+    def line_start(self, line: int) -> int:
+        """行の先頭バイトオフセット"""
+        return self.offsets[line - 1]
+
+    def line_end(self, line: int) -> int:
+        """行末（改行を含む）のバイトオフセット"""
+        return self.offsets[line] if line < len(self.offsets) else self.size
+
+    def label_range(self, name: str) -> tuple[int, int] | None:
+        """*label から次のラベルの直前までの行範囲"""
+        start = self.labels.get(name)
+        if start is None:
+            return None
+        pos = bisect_right(self.label_lines, start)
+        end = self.label_lines[pos] - 1 if pos < len(self.label_lines) else self.line_count
+        return start, end
+
+
+def build_line_index(path: Path) -> LineIndex:
+    """mmapで改行とラベルを走査して索引を作る（ファイル全体はデコードしない）"""
+    st = path.stat()
+    index = LineIndex((st.st_mtime_ns, st.st_size), st.st_size)
+    if st.st_size == 0:
+        return index
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        offsets = index.offsets
+        pos = mm.find(b"\n")
+        while pos != -1:
+            offsets.append(pos + 1)
+            pos = mm.find(b"\n", pos + 1)
+
+        for m in _LABEL_LINE_RE.finditer(mm):
+            name = m.group(1).strip().decode("utf-8", errors="replace")
+            if name:
+                line = bisect_right(offsets, m.start())
+                index.labels.setdefault(name, line)
+                index.label_lines.append(line)
+
+    record_io(bytes_read=st.st_size)
+    return index
+
+
+class LineIndexCache:
+    """ファイルごとの行オフセットインデックスのLRUキャッシュ（mtime/サイズで検証）"""
+
+    def __init__(self, max_entries: int = 128):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[Path, LineIndex] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: Path) -> LineIndex:
+        st = path.stat()
+        key = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            index = self._entries.get(path)
+            if index is not None and index.key == key:
+                self._entries.move_to_end(path)
+                record_cache(hits=1)
+                return index
+
+        record_cache(misses=1)
+        index = build_line_index(path)
+        with self._lock:
+            self._entries[path] = index
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return index
+
+    def invalidate(self, path: Path):
+        with self._lock:
+            self._entries.pop(path, None)
+
+    def invalidate_tree(self, root: Path):
+        """root 以下のファイルのインデックスをすべて破棄"""
+        with self._lock:
+            for path in [path for path in self._entries if path.is_relative_to(root)]:
+                del self._entries[path]
+
+
+line_index_cache = LineIndexCache()
+
+
+def read_byte_range(path: Path, start: int, end: int) -> str:
+    """mmap経由で指定バイト範囲だけを読み込んでデコード"""
+    if end <= start:
+        return ""
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = mm[start:end]
+    record_io(bytes_read=len(data))
+    return data.decode("utf-8", errors="replace")
+
+
+def read_scenario_range(path: Path, arguments: dict) -> tuple[str, str]:
+    """行範囲・ラベル・バイトオフセットのいずれかで部分読み込み（本文, 位置情報）を返す"""
+    index = line_index_cache.get(path)
+    line_count = index.line_count
+    next_offset = None
+
+    if arguments.get("label"):
+        label = arguments["label"].lstrip("*")
+        label_range = index.label_range(label)
+        if label_range is None:
+            raise ValueError(f"ラベル '*{label}' が見つかりません")
+        start_line, end_line = label_range
+        start, end = index.line_start(start_line), index.line_end(end_line)
+
+    elif arguments.get("offset") is not None:
+        offset = int(arguments["offset"])
+        max_bytes = int(arguments.get("max_bytes", DEFAULT_READ_BYTES))
+        if offset < 0 or offset > index.size:
+            raise ValueError(f"offset は 0〜{index.size} の範囲で指定してください")
+        if max_bytes <= 0:
+            raise ValueError("max_bytes は正の数で指定してください")
+
+        start, end = offset, min(offset + max_bytes, index.size)
+        start_line, end_line = index.line_of(start) if start < index.size else line_count, line_count
+        if index.size:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # UTF-8の文字の途中から始まらないよう文字境界に揃える
+                while 0 < start < index.size and 0x80 <= mm[start] < 0xC0:
+                    start -= 1
+                end = min(start + max_bytes, index.size)
+                if end < index.size:
+                    end_line = index.line_of(end)
+                    if index.line_start(end_line) > start:
+                        # 行の区切りで止める
+                        end = index.line_start(end_line)
+                        end_line -= 1
+                    else:
+                        # 1行が max_bytes を超える場合は文字境界で止める
+                        boundary = end
+                        while boundary > start and 0x80 <= mm[boundary] < 0xC0:
+                            boundary -= 1
+                        if boundary == start:
+                            # max_bytes が1文字に満たなくても進むよう、その文字の終わりまで読む（最大3バイト超過）
+                            boundary = start + 1
+                            while boundary < index.size and 0x80 <= mm[boundary] < 0xC0:
+                                boundary += 1
+                        end = boundary
+                    if end < index.size:
+                        next_offset = end
+
+    else:
+        start_line = int(arguments.get("start_line", 1))
+        end_line = int(arguments.get("end_line", line_count))
+        if start_line < 1 or start_line > line_count:
+            raise ValueError(f"start_line は 1〜{line_count} の範囲で指定してください")
+        end_line = min(end_line, line_count)
+        if end_line < start_line:
+            raise ValueError("end_line は start_line 以上を指定してください")
+        start, end = index.line_start(start_line), index.line_end(end_line)
+
+    content = read_byte_range(path, start, end)
+    # offset指定のときは連結すると元のファイルに戻るよう末尾の改行も残す
+    if arguments.get("offset") is None and content.endswith("\n"):
+        content = content[:-1]
+
+    info = f"📄 {path.name}: 行 {start_line}-{end_line} / 全{line_count}行（バイト {start}-{end} / {index.size}）"
+    if next_offset is not None:
+        info += f"\n続きは offset={next_offset} で取得できます"
+    elif arguments.get("offset") is not None:
+        info += "\n（ファイル末尾まで読み込みました）"
+    return content, info
+
+
+# ============================================================
+# シナリオのパッチ適用
+# ============================================================
+
+_HUNK_HEADER_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+@dataclass(slots=True)
+class DiffHunk:
+    """unified diff の1ハンク"""
+    old_start: int
+    old: list[str] = field(default_factory=list)
+    new: list[str] = field(default_factory=list)
+
+
+def parse_unified_diff(diff: str) -> list[DiffHunk]:
+    """unified diff をハンクに分解（---/+++ ヘッダーは無視）"""
+    hunks = []
+    hunk = None
+    for line in diff.splitlines():
+        header = _HUNK_HEADER_RE.match(line)
+        if header:
+            old_start = int(header.group(1))
+            # 削除行数0のハンクは old_start の行の直後に挿入する
+            if header.group(2) == "0":
+                old_start += 1
+            hunk = DiffHunk(old_start)
+            hunks.append(hunk)
+            continue
+        if hunk is None or line.startswith("\\"):
+            continue
+        head, body = line[:1], line[1:]
+        if head == " " or line == "":
+            hunk.old.append(body)
+            hunk.new.append(body)
+        elif head == "-":
+            hunk.old.append(body)
+        elif head == "+":
+            hunk.new.append(body)
+        else:
+            raise ValueError(f"diffの行を解釈できません: {line}")
+    if not hunks:
+        raise ValueError("diffにハンク (@@ ... @@) がありません")
+    return hunks
+
+
+def _find_hunk(lines: list[str], old: list[str], expected: int, lower: int) -> int | None:
+    """ハンクの元の行が一致する位置を探す（指定位置から近い順）"""
+    size = len(old)
+    last = len(lines) - size
+    if lower <= expected <= last and lines[expected:expected + size] == old:
+        return expected
+    for distance in range(1, max(expected - lower, last - expected) + 1):
+        for at in (expected - distance, expected + distance):
+            if lower <= at <= last and lines[at:at + size] == old:
+                return at
+    return None
+
+
+def _changed_range(old: list[str], new: list[str], start: int) -> tuple[int, int]:
+    """前後の共通行を除いた変更行範囲（変更後の行番号。削除のみなら開始行-1を終了行とする）"""
+    prefix = 0
+    while prefix < min(len(old), len(new)) and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < min(len(old), len(new)) - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    return start + prefix, start + len(new) - suffix - 1
+
+
+def apply_hunks(lines: list[str], hunks: list[DiffHunk]) -> tuple[list[str], list[tuple[int, int]]]:
+    """ハンクを順に適用し、変更後の行と変更行範囲を返す"""
+    result = []
+    changed = []
+    pos = 0
+    for hunk in hunks:
+        at = _find_hunk(lines, hunk.old, hunk.old_start - 1, pos)
+        if at is None:
+            raise ValueError(f"ハンク @@ -{hunk.old_start} @@ の内容がファイルと一致しません")
+        result.extend(lines[pos:at])
+        changed.append(_changed_range(hunk.old, hunk.new, len(result) + 1))
+        result.extend(hunk.new)
+        pos = at + len(hunk.old)
+    result.extend(lines[pos:])
+    return result, changed
+
+
+def replace_label_blocks(lines: list[str], index: LineIndex, operations: list[dict]) -> tuple[list[str], list[tuple[int, int]]]:
+    """*label から次のラベルの直前までのブロックを置き換える"""
+    blocks = []
+    for operation in operations:
+        label = operation["label"].lstrip("*")
+        label_range = index.label_range(label)
+        if label_range is None:
+            raise ValueError(f"ラベル '*{label}' が見つかりません")
+        start, end = label_range
+        # 末尾の改行による空の最終行はブロックに含めない
+        if end == len(lines) and lines[-1] == "" and end > start:
+            end -= 1
+        blocks.append((start, end, operation["content"].split("\n")))
+
+    blocks.sort()
+    for (_, prev_end, _), (start, _, _) in zip(blocks, blocks[1:]):
+        if start <= prev_end:
+            raise ValueError("同じラベルブロックを複数回置き換えることはできません")
+
+    result = []
+    changed = []
+    pos = 0
+    for start, end, new in blocks:
+        result.extend(lines[pos:start - 1])
+        changed.append(_changed_range(lines[start - 1:end], new, len(result) + 1))
+        result.extend(new)
+        pos = end
+    result.extend(lines[pos:])
+    return result, changed
+
+
+def patch_scenario_file(scenario_path: Path, diff: str | None, operations: list[dict] | None) -> list[tuple[int, int]]:
+    """パッチを適用して一時ファイル経由で置き換え、変更行範囲を返す（改行コードは元のまま）"""
+    with open(scenario_path, encoding="utf-8", newline="") as f:
+        raw = f.read()
+    record_io(bytes_read=len(raw.encode("utf-8")))
+    newline = detect_newline(raw)
+    lines = raw.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+
+    if diff:
+        lines, changed = apply_hunks(lines, parse_unified_diff(diff))
+    else:
+        lines, changed = replace_label_blocks(lines, line_index_cache.get(scenario_path), operations)
+
+    new_content = "\n".join(lines)
+    write_text_file(scenario_path, new_content, newline)
+    line_index_cache.invalidate(scenario_path)
+    scenario_cache.apply_edit(scenario_path, new_content)
+    return changed
+
+
+# ============================================================
+# ファイル監視（プロジェクト状態のメモリ保持）
+# ============================================================
+
+# リソースのカテゴリ（data/ 配下のディレクトリ）
+ASSET_CATEGORIES = ("bgimage", "fgimage", "image", "bgm", "sound", "video")
+
+# ウォッチャーのポーリング間隔（秒）
+WATCH_INTERVAL = float(os.environ.get("TYRANO_MCP_WATCH_INTERVAL", "2.0"))
+
+
+class ProjectWatcher:
+    """プロジェクトのファイル構成と解析結果をメモリ上で最新に保つウォッチャー
+
+    標準ライブラリだけで動くよう、ポーリングで変更を検出する。
+    リソースディレクトリはディレクトリ自体のmtimeだけをstatし、変化したものだけを
+    scandirし直す。シナリオはプロジェクトインデックスの差分更新に任せる。
+    """
+
+    # ファイル内容の上書き（ディレクトリmtimeが変わらない変更）を拾うための全走査間隔
+    FULL_RESCAN_EVERY = 10
+
+    def __init__(self, project_path: Path, interval: float = WATCH_INTERVAL):
+        self.project_path = project_path
+        self.interval = interval
+        self.assets: dict[str, dict[str, int]] = {}
+        self.summaries: dict[str, dict] = {}
+        self.polls = 0
+        self.last_poll: float | None = None
+        self._dir_mtimes: dict[str, int] = {}
+        self._dirty: set[str] = {"scenario", *ASSET_CATEGORIES}
+        self._lock = threading.Lock()
+        # _dirty の追加と取り出し用（走査中も通知を待たせないよう _lock とは分ける）
+        self._dirty_lock = threading.Lock()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._dirty)
+
+    def mark_dirty(self, category: str):
+        """変更を通知（次の参照時に再走査する）"""
+        with self._dirty_lock:
+            self._dirty.add(category)
+
+    def poll(self):
+        """変更されたディレクトリだけを再走査"""
+        with self._lock:
+            with self._dirty_lock:
+                dirty, self._dirty = self._dirty, set()
+            full = self.polls % self.FULL_RESCAN_EVERY == 0
+            data_dir = self.project_path / "data"
+
+            for category in ASSET_CATEGORIES:
+                directory = data_dir / category
+                try:
+                    mtime = directory.stat().st_mtime_ns
+                except FileNotFoundError:
+                    self.assets.pop(category, None)
+                    self._dir_mtimes.pop(category, None)
+                    continue
+                if full or category in dirty or self._dir_mtimes.get(category) != mtime:
+                    self.assets[category] = file_sizes(directory)
+                    self._dir_mtimes[category] = mtime
+
+            self.summaries = get_project_index(self.project_path).refresh()
+            self.polls += 1
+            self.last_poll = time.time()
+
+    def ensure_fresh(self):
+        """通知済みの変更があれば反映"""
+        if self._dirty:
+            self.poll()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await asyncio.to_thread(self.poll)
+            except Exception:
+                pass
+
+    async def start(self):
+        await asyncio.to_thread(self.poll)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+project_watchers: dict[Path, ProjectWatcher] = {}
+
+
+def notify_changed(path: Path):
+    """ファイルの変更を監視中のウォッチャーに通知"""
+    for watcher in project_watchers.values():
+        try:
+            relative = path.relative_to(watcher.project_path / "data")
+        except ValueError:
+            continue
+        if relative.parts:
+            watcher.mark_dirty(relative.parts[0])
+
+
+async def scenario_summaries(project_path: Path) -> dict[str, dict]:
+    """シナリオ要約を取得（監視中ならメモリから）"""
+    watcher = project_watchers.get(project_path)
+    if watcher is None:
+        return await asyncio.to_thread(get_project_index(project_path).refresh)
+    if watcher.dirty:
+        await asyncio.to_thread(watcher.ensure_fresh)
+    return watcher.summaries
+
+
+async def asset_files(project_path: Path, category: str) -> dict[str, int] | None:
+    """data/<category> の {ファイル名: サイズ}（監視中ならメモリから。ディレクトリがなければNone）"""
+    watcher = project_watchers.get(project_path)
+    if watcher is None:
+        directory = project_path / "data" / category
+        return await asyncio.to_thread(lambda: file_sizes(directory) if directory.is_dir() else None)
+    if watcher.dirty:
+        await asyncio.to_thread(watcher.ensure_fresh)
+    return watcher.assets.get(category)
+
+
+# ============================================================
+# 制御フローグラフ（到達可能性・行き止まり・出口のないループ）
+# ============================================================
+
+# 辺の種類
+EDGE_FALLTHROUGH, EDGE_JUMP, EDGE_CALL, EDGE_CHOICE = range(4)
+EDGE_KIND_OF_TAG = {"jump": EDGE_JUMP, "call": EDGE_CALL}
+EDGE_KIND_NAMES = ("fallthrough", "jump", "call", "choice")
+
+
+@dataclass(slots=True)
+class ScenarioGraph:
+    """プロジェクト全体の制御フローグラフ
+
+    ノードは (シナリオファイル, ラベル) に連番の整数IDを振ったもの。ラベル "" は
+    ファイル先頭（最初のラベルより前）を表す。隣接リストは CSR 形式の配列で持つ。
+    """
+    nodes: list[tuple[str, str]] = field(default_factory=list)
+    lines: array = field(default_factory=lambda: array("i"))
+    # ノードごとの表示文字数
+    chars: array = field(default_factory=lambda: array("i"))
+    offsets: array = field(default_factory=lambda: array("i", [0]))
+    targets: array = field(default_factory=lambda: array("i"))
+    kinds: array = field(default_factory=lambda: array("b"))
+    ids: dict[tuple[str, str], int] = field(default_factory=dict)
+    # ファイルごとのノードIDの範囲
+    file_nodes: dict[str, range] = field(default_factory=dict)
+    # 遷移先のない理由 {node: "s" / "return" / "eof"}
+    stops: dict[int, str] = field(default_factory=dict)
+    # 解決できない遷移 [(file, line, tag, storage, target)]
+    unresolved: list[tuple[str, int, str, str | None, str | None]] = field(default_factory=list)
+    # 強連結成分 {call辺を除くか: (成分番号, 成分数)}（文字数だけの更新では構造が変わらないので使い回す）
+    _components: dict[bool, tuple[array, int]] = field(default_factory=dict)
+
+    @property
+    def node_count(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def edge_count(self) -> int:
+        return len(self.targets)
+
+    def successors(self, node: int) -> array:
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+    def label_of(self, node: int) -> str:
+        file, label = self.nodes[node]
+        return f"{file} *{label}" if label else f"{file} (先頭)"
+
+    def components(self, skip_calls: bool = False) -> tuple[array, int]:
+        if skip_calls not in self._components:
+            self._components[skip_calls] = strongly_connected_components(self, skip_calls)
+        return self._components[skip_calls]
+
+    def update_chars(self, file: str, label_chars: dict[str, int]):
+        """1ファイル分のラベルごとの文字数だけを差し替える"""
+        for node in self.file_nodes[file]:
+            self.chars[node] = label_chars.get(self.nodes[node][1], 0)
+
+
+def build_scenario_graph(summaries: dict[str, dict]) -> ScenarioGraph:
+    """シナリオ要約から制御フローグラフを構築"""
+    graph = ScenarioGraph()
+    nodes, lines, ids = graph.nodes, graph.lines, graph.ids
+    file_blocks: dict[str, tuple[list[int], list[int]]] = {}
+
+    # ノードIDの割り当て（ファイル先頭 + ラベル。同名ラベルは先のものを使う）
+    for file in sorted(summaries):
+        label_chars = summaries[file]["label_chars"]
+        block_lines, block_ids = [0], [len(nodes)]
+        ids[(file, "")] = len(nodes)
+        nodes.append((file, ""))
+        lines.append(0)
+        graph.chars.append(label_chars.get("", 0))
+        for label, line in sorted(summaries[file]["labels"], key=lambda item: item[1]):
+            if (file, label) in ids:
+                continue
+            ids[(file, label)] = len(nodes)
+            block_lines.append(line)
+            block_ids.append(len(nodes))
+            nodes.append((file, label))
+            lines.append(line)
+            graph.chars.append(label_chars.get(label, 0))
+        file_blocks[file] = (block_lines, block_ids)
+        graph.file_nodes[file] = range(block_ids[0], len(nodes))
+
+    edges: list[list[tuple[int, int]]] = [[] for _ in nodes]
+    for file, (block_lines, block_ids) in file_blocks.items():
+        terminated: set[int] = set()
+        for tag, storage, target, line, conditional in sorted(summaries[file]["flow"], key=lambda item: item[3]):
+            node = block_ids[bisect_right(block_lines, line) - 1]
+            if node in terminated:
+                continue
+            if tag in FLOW_STOP_TAGS:
+                if not conditional:
+                    terminated.add(node)
+                    graph.stops[node] = tag
+                continue
+
+            target_file = scenario_storage_name(storage) if storage else file
+            target_id = ids.get((target_file, target or ""))
+            if target_id is None:
+                graph.unresolved.append((file, line, tag, storage, target))
+            else:
+                edges[node].append((target_id, EDGE_KIND_OF_TAG.get(tag, EDGE_CHOICE)))
+            if tag == "jump" and not conditional:
+                terminated.add(node)
+
+        # 止まらずに終わったブロックは次のラベルへ続く（最後のブロックはファイル末尾で終わる）
+        for position, node in enumerate(block_ids):
+            if node in terminated:
+                continue
+            if position + 1 < len(block_ids):
+                edges[node].append((block_ids[position + 1], EDGE_FALLTHROUGH))
+            else:
+                graph.stops[node] = "eof"
+
+    for out in edges:
+        for target_id, kind in out:
+            graph.targets.append(target_id)
+            graph.kinds.append(kind)
+        graph.offsets.append(len(graph.targets))
+    return graph
+
+
+def reachable_nodes(graph: ScenarioGraph, start: int) -> bytearray:
+    """start から到達できるノード（BFS）"""
+    seen = bytearray(graph.node_count)
+    seen[start] = 1
+    queue = deque([start])
+    offsets, targets = graph.offsets, graph.targets
+    while queue:
+        node = queue.popleft()
+        for i in range(offsets[node], offsets[node + 1]):
+            target = targets[i]
+            if not seen[target]:
+                seen[target] = 1
+                queue.append(target)
+    return seen
+
+
+def strongly_connected_components(graph: ScenarioGraph, skip_calls: bool = False) -> tuple[array, int]:
+    """強連結成分（Tarjan法を再帰なしで実行）。ノードごとの成分番号と成分数を返す
+
+    skip_calls なら call の辺をたどらない（戻ってくる遷移なのでルートの分岐にならない）。
+    """
+    n = graph.node_count
+    offsets, targets, kinds = graph.offsets, graph.targets, graph.kinds
+    index = array("i", [-1]) * n
+    low = array("i", [0]) * n
+    component = array("i", [-1]) * n
+    on_stack = bytearray(n)
+    stack: list[int] = []
+    counter = 0
+    count = 0
+
+    for root in range(n):
+        if index[root] != -1:
+            continue
+        work = [(root, offsets[root])]
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = 1
+        while work:
+            node, i = work[-1]
+            if i < offsets[node + 1]:
+                work[-1] = (node, i + 1)
+                if skip_calls and kinds[i] == EDGE_CALL:
+                    continue
+                target = targets[i]
+                if index[target] == -1:
+                    index[target] = low[target] = counter
+                    counter += 1
+                    stack.append(target)
+                    on_stack[target] = 1
+                    work.append((target, offsets[target]))
+                elif on_stack[target] and index[target] < low[node]:
+                    low[node] = index[target]
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                if low[node] < low[parent]:
+                    low[parent] = low[node]
+            if low[node] == index[node]:
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = 0
+                    component[member] = count
+                    if member == node:
+                        break
+                count += 1
+    return component, count
+
+
+def closed_cycles(graph: ScenarioGraph, component: array, count: int, reachable: bytearray) -> list[list[int]]:
+    """抜け出す辺がないループ（到達可能な強連結成分のうち、外への辺も行き止まりもないもの）"""
+    members: list[list[int]] = [[] for _ in range(count)]
+    for node in range(graph.node_count):
+        if reachable[node]:
+            members[component[node]].append(node)
+
+    cycles = []
+    for comp, nodes in enumerate(members):
+        if not nodes:
+            continue
+        has_exit = False
+        has_cycle = len(nodes) > 1
+        for node in nodes:
+            successors = graph.successors(node)
+            if not successors:
+                has_exit = True
+                break
+            for target in successors:
+                if component[target] != comp:
+                    has_exit = True
+                    break
+                if target == node:
+                    has_cycle = True
+            if has_exit:
+                break
+        if has_cycle and not has_exit:
+            cycles.append(nodes)
+    return cycles
+
+
+@dataclass(slots=True)
+class RouteStats:
+    """開始点からひとつのエンディングまでのルート集計"""
+    nodes: list[int]  # エンディングのノード（抜け出せないループなら複数）
+    routes: int  # 異なる経路の数
+    shortest: int  # 最短ルートの文字数
+    longest: int  # 最長ルートの文字数
+    total: int  # 全ルートの文字数の合計
+
+    @property
+    def average(self) -> float:
+        return self.total / self.routes
+
+
+def count_routes(graph: ScenarioGraph, start: int) -> list[RouteStats]:
+    """start から各エンディングまでの経路数と最短・最長の文字数を求める
+
+    call の辺を除いた強連結成分を1ノードに縮約したDAG上で、トポロジカル順に経路数と
+    文字数を動的計画法で伝播する（経路を列挙しないので分岐が多くても指数的に増えない）。
+    経路は成分をまたぐ遷移の並びで区別し、平均はループを回らずに通った文字数で数える。
+    最短はループを回らない文字数（ノード単位のダイクストラ法）、最長はループを1周ずつ
+    回った文字数。call は戻ってくるので分岐として扱わず、呼び出し先から [return] までの
+    文字数を呼び出し元に足す。エンディングは call 以外の遷移先がない成分。
+    """
+    component, count = graph.components(skip_calls=True)
+    offsets, targets, kinds, chars = graph.offsets, graph.targets, graph.kinds, graph.chars
+    members: list[list[int]] = [[] for _ in range(count)]
+    for node in range(graph.node_count):
+        members[component[node]].append(node)
+
+    def flow(node: int):
+        for i in range(offsets[node], offsets[node + 1]):
+            if kinds[i] != EDGE_CALL:
+                yield targets[i]
+
+    # ノードの文字数（最短用, 最長用）。call 先の [return] までの文字数を含む
+    weights: dict[int, tuple[int, int]] = {}
+    # call 先ごとの [return] までの文字数（最短, 最長）
+    subroutines: dict[int, tuple[int, int]] = {}
+    # 成分ごとの1周分の文字数
+    laps: dict[int, int] = {}
+
+    def weight(node: int) -> tuple[int, int]:
+        if node not in weights:
+            low = high = chars[node]
+            for i in range(offsets[node], offsets[node + 1]):
+                if kinds[i] == EDGE_CALL:
+                    short, long = subroutine(targets[i])
+                    low += short
+                    high += long
+            weights[node] = (low, high)
+        return weights[node]
+
+    def lap(comp: int) -> int:
+        if comp not in laps:
+            laps[comp] = sum(weight(node)[1] for node in members[comp])
+        return laps[comp]
+
+    def shortest_paths(source: int, within: int | None = None) -> dict[int, int]:
+        """source から各ノードまでの最短文字数（両端を含む）。within なら成分の中だけをたどる"""
+        distance = {source: weight(source)[0]}
+        heap = [(distance[source], source)]
+        while heap:
+            d, node = heapq.heappop(heap)
+            if d > distance[node]:
+                continue
+            for target in flow(node):
+                if within is not None and component[target] != within:
+                    continue
+                nd = d + weight(target)[0]
+                if target not in distance or nd < distance[target]:
+                    distance[target] = nd
+                    heapq.heappush(heap, (nd, target))
+        return distance
+
+    def longest_paths(source: int) -> dict[int, int]:
+        """source の成分から到達できる成分ごとの最長文字数（ループは1周分）"""
+        first = component[source]
+        longest = {first: lap(first)}
+        # Tarjan法の成分番号は逆トポロジカル順なので、大きい番号から処理する
+        for comp in range(first, -1, -1):
+            if comp not in longest:
+                continue
+            for node in members[comp]:
+                for target in flow(node):
+                    next_comp = component[target]
+                    if next_comp != comp:
+                        long = longest[comp] + lap(next_comp)
+                        if long > longest.get(next_comp, -1):
+                            longest[next_comp] = long
+        return longest
+
+    def subroutine(entry: int) -> tuple[int, int]:
+        if entry not in subroutines:
+            # 再帰呼び出しは0字として扱う
+            subroutines[entry] = (0, 0)
+            shortest = shortest_paths(entry)
+            returns = [node for node in shortest if graph.stops.get(node) == "return"]
+            if returns:
+                longest = longest_paths(entry)
+                subroutines[entry] = (
+                    min(shortest[node] for node in returns),
+                    max(longest[component[node]] for node in returns),
+                )
+        return subroutines[entry]
+
+    shortest = shortest_paths(start)
+    longest = longest_paths(start)
+    # 成分の入口ノードごとの経路数と、入口に着くまでの文字数の合計
+    routes = {start: 1}
+    totals = {start: 0}
+    endings = []
+    for comp in range(component[start], -1, -1):
+        entries = [node for node in members[comp] if node in routes]
+        if not entries:
+            continue
+        # 入口から成分内の各ノードまでの最短文字数
+        if len(members[comp]) == 1:
+            inner = {entries[0]: {entries[0]: weight(entries[0])[0]}}
+        else:
+            inner = {entry: shortest_paths(entry, comp) for entry in entries}
+        exits = [(node, target) for node in members[comp] for target in flow(node) if component[target] != comp]
+        if not exits:
+            endings.append(RouteStats(
+                members[comp],
+                sum(routes[entry] for entry in entries),
+                min(shortest[node] for node in members[comp] if node in shortest),
+                longest[comp],
+                sum(totals[entry] + routes[entry] * inner[entry][entry] for entry in entries),
+            ))
+            continue
+        for node, target in exits:
+            for entry in entries:
+                routes[target] = routes.get(target, 0) + routes[entry]
+                totals[target] = totals.get(target, 0) + totals[entry] + routes[entry] * inner[entry][node]
+    return endings
+
+
+# 平均読書速度（文字/分）
+READING_CHARS_PER_MINUTE = 600
+
+
+def playtime_minutes(chars: float) -> float:
+    return chars / READING_CHARS_PER_MINUTE
+
+
+# {project_path: (構築に使った要約, グラフ)}
+_graph_cache: dict[Path, tuple[dict[str, dict], ScenarioGraph]] = {}
+
+
+def _update_graph(previous: dict[str, dict], summaries: dict[str, dict], graph: ScenarioGraph) -> ScenarioGraph | None:
+    """要約の差分からグラフを更新（本文だけの変更なら文字数を差し替え、ラベルや遷移が変わっていればNone）"""
+    if previous.keys() != summaries.keys():
+        return None
+    changed = [name for name, summary in summaries.items() if previous[name] is not summary]
+    for name in changed:
+        old, new = previous[name], summaries[name]
+        if old["labels"] != new["labels"] or old["flow"] != new["flow"]:
+            return None
+    if not changed:
+        return graph
+    # 使用中のグラフは書き換えず、文字数の配列だけ複製する（構造と強連結成分は共有）
+    graph = replace(graph, chars=array("i", graph.chars))
+    for name in changed:
+        graph.update_chars(name, summaries[name]["label_chars"])
+    return graph
+
+
+async def project_graph(project_path: Path, summaries: dict[str, dict] | None = None) -> ScenarioGraph:
+    """プロジェクトの制御フローグラフ（構築に使った要約と変わっていなければキャッシュを返す）
+
+    変更されたファイルの要約だけを見て、本文の変更なら文字数のみ更新する。
+    取得済みの要約があれば summaries に渡す（渡さなければインデックスから取得する）。
+    """
+    if summaries is None:
+        summaries = await scenario_summaries(project_path)
+    cached = _graph_cache.get(project_path)
+    graph = _update_graph(cached[0], summaries, cached[1]) if cached else None
+    if graph is not None:
+        record_cache(hits=1)
+    else:
+        record_cache(misses=1)
+        graph = await asyncio.to_thread(build_scenario_graph, summaries)
+    _graph_cache[project_path] = (dict(summaries), graph)
+    return graph
+
+
+# ============================================================
+# フローグラフの書き出し（Mermaid / DOT / JSON）
+# ============================================================
+
+EXPORT_FORMATS = ("mermaid", "dot", "json")
+# 書き出すノード数の上限（これを超えると開始点から近い順に残す）
+DEFAULT_NODE_BUDGET = 200
+
+
+@dataclass(slots=True)
+class ExportGraph:
+    """書き出し用に縮約したグラフ"""
+    chains: dict[int, list[int]]  # 代表ノード → まとめたノード（先頭が代表）
+    edges: list[tuple[int, int, int]]  # (元, 先, 辺の種類)
+    omitted: int  # 上限で省いたノード数
+
+
+def export_graph(
+    graph: ScenarioGraph,
+    selected: set[int] | None = None,
+    entry: int | None = None,
+    collapse: bool = True,
+    budget: int = DEFAULT_NODE_BUDGET,
+) -> ExportGraph:
+    """書き出すノードを選び、一本道をまとめ、上限までに切り詰める"""
+    if selected is None:
+        selected = set(range(graph.node_count))
+    out_edges: dict[int, list[tuple[int, int]]] = {node: [] for node in selected}
+    in_degree = dict.fromkeys(selected, 0)
+    for node in selected:
+        for i in range(graph.offsets[node], graph.offsets[node + 1]):
+            target = graph.targets[i]
+            if target in in_degree:
+                out_edges[node].append((target, graph.kinds[i]))
+                in_degree[target] += 1
+
+    # 同じファイル内で分岐も合流もない続きは前のノードにまとめる
+    def merges(node: int) -> int | None:
+        if not collapse or len(out_edges[node]) != 1:
+            return None
+        target = out_edges[node][0][0]
+        if (
+            target == node or target == entry or in_degree[target] != 1
+            or graph.nodes[target][0] != graph.nodes[node][0]
+        ):
+            return None
+        return target
+
+    merged_into: set[int] = set()
+    for node in selected:
+        target = merges(node)
+        if target is not None:
+            merged_into.add(target)
+
+    chains: dict[int, list[int]] = {}
+    covered: set[int] = set()
+
+    def add_chain(head: int):
+        chain = [head]
+        target = merges(head)
+        while target is not None and target != head:
+            chain.append(target)
+            target = merges(target)
+        chains[head] = chain
+        covered.update(chain)
+
+    for node in sorted(selected - merged_into):
+        add_chain(node)
+    # 一本道のループは代表がいないので、番号の小さいノードから始める
+    for node in sorted(merged_into - covered):
+        if node not in covered:
+            add_chain(node)
+
+    # 開始点（なければ入ってくる辺のないノード）から近い順に上限まで残す
+    roots = [entry] if entry in chains else [node for node in chains if in_degree[node] == 0]
+    order: list[int] = []
+    seen: set[int] = set()
+    for root in [*roots, *chains]:
+        if root in seen or len(order) >= budget:
+            continue
+        seen.add(root)
+        queue = deque([root])
+        while queue and len(order) < budget:
+            head = queue.popleft()
+            order.append(head)
+            for target, _ in out_edges[chains[head][-1]]:
+                if target in chains and target not in seen:
+                    seen.add(target)
+                    queue.append(target)
+    kept = {node: chains[node] for node in order}
+
+    edges = [
+        (head, target, kind)
+        for head, chain in kept.items()
+        for target, kind in out_edges[chain[-1]]
+        if target in kept
+    ]
+    omitted = sum(len(chain) for chain in chains.values()) - sum(len(chain) for chain in kept.values())
+    return ExportGraph(kept, edges, omitted)
+
+
+def _export_clusters(graph: ScenarioGraph, export: ExportGraph) -> dict[str, list[int]]:
+    """代表ノードをファイルごとにまとめる"""
+    clusters: dict[str, list[int]] = {}
+    for head in export.chains:
+        clusters.setdefault(graph.nodes[head][0], []).append(head)
+    return clusters
+
+
+def _chain_caption(graph: ScenarioGraph, chain: list[int]) -> str:
+    first = graph.nodes[chain[0]][1]
+    caption = f"*{first}" if first else "(先頭)"
+    if len(chain) > 1:
+        last = graph.nodes[chain[-1]][1]
+        caption += f" … *{last} ({len(chain)}ラベル)"
+    return caption
+
+
+def iter_mermaid(graph: ScenarioGraph, export: ExportGraph):
+    """Mermaidのflowchartを1行ずつ生成"""
+    def quote(text: str) -> str:
+        return '"' + text.replace('"', "#quot;") + '"'
+
+    yield "graph TD"
+    for index, (file, heads) in enumerate(sorted(_export_clusters(graph, export).items())):
+        yield f"  subgraph f{index}[{quote(file)}]"
+        for head in heads:
+            yield f"    n{head}[{quote(_chain_caption(graph, export.chains[head]))}]"
+        yield "  end"
+    arrows = {EDGE_FALLTHROUGH: "-.->", EDGE_JUMP: "-->", EDGE_CALL: "-.->|call|", EDGE_CHOICE: "-->|選択肢|"}
+    for source, target, kind in export.edges:
+        yield f"  n{source} {arrows[kind]} n{target}"
+    if export.omitted:
+        yield f"  omitted[{quote(f'...他{export.omitted}ノード')}]"
+
+
+def iter_dot(graph: ScenarioGraph, export: ExportGraph):
+    """Graphviz DOTを1行ずつ生成"""
+    def quote(text: str) -> str:
+        return '"' + text.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+    yield "digraph scenario {"
+    yield "  rankdir=TB;"
+    yield "  node [shape=box];"
+    for index, (file, heads) in enumerate(sorted(_export_clusters(graph, export).items())):
+        yield f"  subgraph cluster_{index} {{"
+        yield f"    label={quote(file)};"
+        for head in heads:
+            yield f"    n{head} [label={quote(_chain_caption(graph, export.chains[head]))}];"
+        yield "  }"
+    styles = {
+        EDGE_FALLTHROUGH: " [style=dashed]",
+        EDGE_JUMP: "",
+        EDGE_CALL: ' [style=dashed, label="call"]',
+        EDGE_CHOICE: ' [label="選択肢"]',
+    }
+    for source, target, kind in export.edges:
+        yield f"  n{source} -> n{target}{styles[kind]};"
+    if export.omitted:
+        yield f"  omitted [shape=note, label={quote(f'...他{export.omitted}ノード')}];"
+    yield "}"
+
+
+def export_json(graph: ScenarioGraph, export: ExportGraph) -> str:
+    """隣接リスト形式のJSON"""
+    adjacency: dict[int, list[dict]] = {head: [] for head in export.chains}
+    for source, target, kind in export.edges:
+        adjacency[source].append({"to": target, "kind": EDGE_KIND_NAMES[kind]})
+    return json.dumps({
+        "nodes": [
+            {
+                "id": head,
+                "file": graph.nodes[head][0],
+                "labels": [graph.nodes[node][1] for node in chain],
+                "chars": sum(graph.chars[node] for node in chain),
+                "edges": adjacency[head],
+            }
+            for head, chain in export.chains.items()
+        ],
+        "omitted": export.omitted,
+    }, ensure_ascii=False, indent=2)
+
+
+def render_graph(graph: ScenarioGraph, export: ExportGraph, fmt: str) -> str:
+    if fmt == "json":
+        return export_json(graph, export)
+    return "\n".join(iter_dot(graph, export) if fmt == "dot" else iter_mermaid(graph, export))
+
+
+# ============================================================
+# 共有アセットストア（内容アドレスによる重複排除）
+# ============================================================
+
+# 全プロジェクトで共有するアセットの保存先（ハードリンクするため PROJECTS_DIR と同じファイルシステムに置く）
+ASSET_STORE_DIRNAME = ".asset_store"
+
+# TYRANO_MCP_ASSET_STORE=1 で素材の取り込みをストア経由（ハードリンク）にする
+USE_ASSET_STORE = os.environ.get("TYRANO_MCP_ASSET_STORE") == "1"
+
+
+def file_sha1(path: Path) -> str:
+    """ファイル内容のSHA-1（チャンク単位で読み込む）"""
+    with open(path, "rb") as f:
+        digest = hashlib.file_digest(f, "sha1").hexdigest()
+    record_io(bytes_read=path.stat().st_size)
+    return digest
+
+
+def replace_with_link(target: Path, dest: Path):
+    """dest を target へのハードリンクに置き換える（一時名でリンクしてから os.replace）"""
+    tmp = dest.with_name(f".{dest.name}.{os.getpid()}.link")
+    with suppress(FileNotFoundError):
+        tmp.unlink()
+    os.link(target, tmp)
+    os.replace(tmp, dest)
+
+
+@dataclass(slots=True)
+class AssetFile:
+    """重複検出の対象ファイル"""
+    path: Path
+    size: int
+    inode: tuple[int, int]
+    sha1: str | None = None
+
+
+class AssetStore:
+    """SHA-1 → 実体 の内容アドレスストア
+
+    プロジェクトの data/ 配下のファイルはストアの実体へのハードリンクになる。
+    実体は読み取り専用にし、その場で書き換えられて他のプロジェクトに波及するのを防ぐ。
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def blob_path(self, sha1: str) -> Path:
+        return self.root / sha1[:2] / sha1
+
+    def adopt(self, path: Path, sha1: str) -> Path:
+        """ファイルを実体として登録（既にあればそれを返す）"""
+        blob = self.blob_path(sha1)
+        if not blob.exists():
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(path, blob)
+            except FileExistsError:
+                pass
+            else:
+                os.chmod(blob, 0o444)
+        return blob
+
+    def import_file(self, source_path: Path, dest_path: Path) -> bool:
+        """ストア経由でファイルを配置（実体が既にあればコピーせずリンクだけ。コピーしたらTrue）"""
+        sha1 = file_sha1(source_path)
+        blob = self.blob_path(sha1)
+        copied = False
+        if not blob.exists():
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            tmp = blob.with_name(f".{sha1}.{os.getpid()}.{threading.get_ident()}.tmp")
+            shutil.copyfile(source_path, tmp)
+            os.chmod(tmp, 0o444)
+            os.replace(tmp, blob)
+            copied = True
+        dest_path.parent.mkdir(parents=True, exist_ok=True)
+        replace_with_link(blob, dest_path)
+        return copied
+
+    def collect(self, project_paths: list[Path]) -> list[AssetFile]:
+        """プロジェクトのアセットファイルを列挙"""
+        files = []
+        for project_path in project_paths:
+            for category in ASSET_CATEGORIES:
+                directory = project_path / "data" / category
+                if not directory.is_dir():
+                    continue
+                for entry in scan_files(directory, 0):
+                    if entry.is_dir:
+                        continue
+                    path = directory / entry.path
+                    st = path.stat()
+                    files.append(AssetFile(path, st.st_size, (st.st_dev, st.st_ino)))
+        return files
+
+    def duplicate_groups(self, files: list[AssetFile]) -> dict[str, list[AssetFile]]:
+        """内容が同じで実体（inode）が複数あるファイルのグループ
+
+        ハッシュは同じサイズで別の実体があるファイルだけ計算する。
+        """
+        by_size: dict[int, list[AssetFile]] = {}
+        for f in files:
+            by_size.setdefault(f.size, []).append(f)
+
+        candidates = []
+        for same_size in by_size.values():
+            if len({f.inode for f in same_size}) > 1:
+                candidates.extend(same_size)
+
+        # 同じinodeは1回だけハッシュを計算する
+        first_of_inode: dict[tuple[int, int], AssetFile] = {}
+        for f in candidates:
+            first_of_inode.setdefault(f.inode, f)
+        unique = list(first_of_inode.values())
+        digests = dict(zip((f.inode for f in unique), map_io(lambda f: file_sha1(f.path), unique)))
+
+        groups: dict[str, list[AssetFile]] = {}
+        for f in candidates:
+            f.sha1 = digests[f.inode]
+            groups.setdefault(f.sha1, []).append(f)
+        return {sha1: group for sha1, group in groups.items() if len({f.inode for f in group}) > 1}
+
+    def reclaim(self, groups: dict[str, list[AssetFile]]) -> tuple[int, int]:
+        """重複ファイルをストアの実体へのハードリンクに置き換える（置き換えたファイル数, 解放バイト数）"""
+        relinked = 0
+        freed = 0
+        for sha1, group in groups.items():
+            blob = self.adopt(group[0].path, sha1)
+            st = blob.stat()
+            blob_inode = (st.st_dev, st.st_ino)
+            seen = {blob_inode}
+            for f in group:
+                if f.inode == blob_inode:
+                    continue
+                try:
+                    replace_with_link(blob, f.path)
+                except OSError:
+                    # 別デバイスなどリンクできないものはそのまま
+                    continue
+                relinked += 1
+                if f.inode not in seen:
+                    seen.add(f.inode)
+                    freed += f.size
+        return relinked, freed
+
+    def gc(self) -> tuple[int, int]:
+        """どのプロジェクトからも参照されなくなった実体を削除（削除数, バイト数）"""
+        removed = 0
+        freed = 0
+        if not self.root.is_dir():
+            return 0, 0
+        for entry in scan_files(self.root, 0):
+            if entry.is_dir:
+                continue
+            blob = self.root / entry.path
+            st = blob.stat()
+            if st.st_nlink == 1:
+                blob.unlink()
+                removed += 1
+                freed += st.st_size
+        return removed, freed
+
+
+def asset_store() -> AssetStore:
+    return AssetStore(PROJECTS_DIR / ASSET_STORE_DIRNAME)
+
+
+# ============================================================
+# ゴミ箱（バックグラウンド削除）
+# ============================================================
+
+# 削除したプロジェクトの一時置き場（renameで移すため PROJECTS_DIR と同じファイルシステムに置く）
+TRASH_DIRNAME = ".trash"
+
+
+def trash_dir() -> Path:
+    return PROJECTS_DIR / TRASH_DIRNAME
+
+
+@dataclass(slots=True)
+class TrashJob:
+    """ゴミ箱内の1項目の削除状況"""
+    name: str
+    path: Path
+    state: str = "pending"  # pending, running, done, cancelled, failed
+    total_files: int = 0
+    removed_files: int = 0
+    removed_bytes: int = 0
+    error: str | None = None
+    started: float | None = None
+    finished: float | None = None
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+    task: asyncio.Future | None = None
+
+    def run(self):
+        """ファイルを1つずつ削除（キャンセルされたらその時点で止める）"""
+        self.state = "running"
+        self.started = time.time()
+        try:
+            tree = list(os.walk(self.path, topdown=False))
+            self.total_files = sum(len(files) for _, _, files in tree)
+            for root, dirs, files in tree:
+                for name in files:
+                    if self.cancel_event.is_set():
+                        self.state = "cancelled"
+                        return
+                    file_path = os.path.join(root, name)
+                    size = os.lstat(file_path).st_size
+                    os.unlink(file_path)
+                    self.removed_files += 1
+                    self.removed_bytes += size
+                for name in dirs:
+                    dir_path = os.path.join(root, name)
+                    # ディレクトリへのシンボリックリンクはリンクだけを消す
+                    if os.path.islink(dir_path):
+                        os.unlink(dir_path)
+                    else:
+                        os.rmdir(dir_path)
+            os.rmdir(self.path)
+            self.state = "done"
+        except OSError as e:
+            self.state = "failed"
+            self.error = str(e)
+        finally:
+            self.finished = time.time()
+
+    @property
+    def active(self) -> bool:
+        return self.state in ("pending", "running")
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "total_files": self.total_files,
+            "removed_files": self.removed_files,
+            "removed_bytes": self.removed_bytes,
+            "error": self.error,
+        }
+
+
+trash_jobs: dict[str, TrashJob] = {}
+
+
+def move_to_trash(project_path: Path) -> Path:
+    """プロジェクトをゴミ箱へ移動（同一ファイルシステム内のrenameなので一瞬で終わる）"""
+    trash = trash_dir()
+    trash.mkdir(exist_ok=True)
+    dest = trash / f"{project_path.name}.{time.strftime('%Y%m%d-%H%M%S')}.{os.getpid()}"
+    suffix = 0
+    while dest.exists():
+        suffix += 1
+        dest = dest.with_name(f"{dest.name.rsplit('~', 1)[0]}~{suffix}")
+    os.rename(project_path, dest)
+    return dest
+
+
+def schedule_purge(path: Path) -> TrashJob:
+    """ゴミ箱内の項目をバックグラウンドで削除"""
+    job = trash_jobs.get(path.name)
+    if job and job.active:
+        return job
+    job = TrashJob(path.name, path)
+    trash_jobs[path.name] = job
+    job.task = asyncio.get_running_loop().run_in_executor(None, job.run)
+    return job
+
+
+def purge_all_trash() -> list[TrashJob]:
+    """ゴミ箱内の削除中でない項目をすべて削除対象にする"""
+    trash = trash_dir()
+    if not trash.is_dir():
+        return []
+    return [schedule_purge(entry) for entry in sorted(trash.iterdir())]
+
+
 app = Server("tyrano-studio")
 
 
+# ツールレジストリ
+TOOL_HANDLERS: dict[str, Callable[[dict], Awaitable[list[types.TextContent]]]] = {}
+TOOL_DEFINITIONS: list[types.Tool] = []
+
+# 多くのツールで共通のパラメータ
+PROJECT_NAME_PROPERTY = {
+    "type": "string",
+    "description": "プロジェクト名",
+}
+
+
+def tool(name: str, description: str, properties: dict | None = None, required: list[str] | None = None):
+    """ハンドラーをMCPツールとして登録するデコレーター
+
+    スキーマはインポート時に一度だけ構築される。
+    """
+    input_schema = {"type": "object", "properties": properties or {}}
+    if required:
+        input_schema["required"] = required
+
+    def decorator(handler):
+        if name in TOOL_HANDLERS:
+            raise ValueError(f"ツール '{name}' は既に登録されています")
+        TOOL_DEFINITIONS.append(types.Tool(name=name, description=description, inputSchema=input_schema))
+        TOOL_HANDLERS[name] = handler
+        return handler
+
+    return decorator
+
+
 @app.list_tools()
 async def list_tools() -> list[types.Tool]:
-    """利用可能なツールのリスト"""
-    return [
-        types.Tool(
-            name="list_projects",
-            description="TyranoStudioのプロジェクト一覧を取得",
-            inputSchema={
-                "type": "object",
-                "properties": {},
-            },
-        ),
-        types.Tool(
-            name="create_project",
-            description="新しいTyranoScriptプロジェクトを作成",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                    "template": {
-                        "type": "string",
-                        "description": "テンプレート (tyranoscript_ja または tyranoscript_en)",
-                        "enum": ["tyranoscript_ja", "tyranoscript_en"],
-                        "default": "tyranoscript_ja",
-                    },
-                },
-                "required": ["project_name"],
-            },
-        ),
-        types.Tool(
-            name="read_scenario",
-            description="プロジェクトのシナリオファイル(.ks)を読み込む",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                    "scenario_file": {
-                        "type": "string",
-                        "description": "シナリオファイル名 (data/scenario内の.ksファイル)",
-                    },
-                },
-                "required": ["project_name", "scenario_file"],
-            },
-        ),
-        types.Tool(
-            name="write_scenario",
-            description="プロジェクトのシナリオファイル(.ks)を書き込む",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                    "scenario_file": {
-                        "type": "string",
-                        "description": "シナリオファイル名 (data/scenario内の.ksファイル)",
-                    },
-                    "content": {
-                        "type": "string",
-                        "description": "書き込む内容",
-                    },
-                },
-                "required": ["project_name", "scenario_file", "content"],
-            },
-        ),
-        types.Tool(
-            name="list_project_files",
-            description="プロジェクト内のファイル一覧を取得",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                    "path": {
-                        "type": "string",
-                        "description": "相対パス (省略時はプロジェクトルート)",
-                        "default": "",
-                    },
-                },
-                "required": ["project_name"],
-            },
-        ),
-        types.Tool(
-            name="read_config",
-            description="プロジェクトの設定ファイル(Config.tjs)を読み込む",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                },
-                "required": ["project_name"],
-            },
-        ),
-        types.Tool(
-            name="write_config",
-            description="プロジェクトの設定ファイル(Config.tjs)を書き込む",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                    "content": {
-                        "type": "string",
-                        "description": "書き込む内容",
-                    },
-                },
-                "required": ["project_name", "content"],
-            },
-        ),
-        types.Tool(
-            name="add_image",
-            description="プロジェクトに画像ファイルを追加",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                    "source_path": {
-                        "type": "string",
-                        "description": "コピー元の画像ファイルパス",
-                    },
-                    "dest_category": {
-                        "type": "string",
-                        "description": "配置先カテゴリ (fgimage, bgimage, system など)",
-                    },
-                    "dest_filename": {
-                        "type": "string",
-                        "description": "配置先ファイル名 (省略時は元のファイル名)",
-                        "default": "",
-                    },
-                },
-                "required": ["project_name", "source_path", "dest_category"],
-            },
-        ),
-        types.Tool(
-            name="add_audio",
-            description="プロジェクトに音声ファイル（BGM/効果音）を追加",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                    "source_path": {
-                        "type": "string",
-                        "description": "コピー元の音声ファイルパス",
-                    },
-                    "audio_type": {
-                        "type": "string",
-                        "description": "音声タイプ (bgm: BGM, sound: 効果音)",
-                        "enum": ["bgm", "sound"],
-                    },
-                    "dest_filename": {
-                        "type": "string",
-                        "description": "配置先ファイル名 (省略時は元のファイル名)",
-                        "default": "",
-                    },
-                },
-                "required": ["project_name", "source_path", "audio_type"],
-            },
-        ),
-        types.Tool(
-            name="list_audio",
-            description="プロジェクト内の音声ファイル一覧を取得",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                    "audio_type": {
-                        "type": "string",
-                        "description": "音声タイプ (bgm, sound, all)",
-                        "enum": ["bgm", "sound", "all"],
-                        "default": "all",
-                    },
-                },
-                "required": ["project_name"],
-            },
-        ),
-        types.Tool(
-            name="delete_project",
-            description="プロジェクトを削除",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                },
-                "required": ["project_name"],
-            },
-        ),
-        types.Tool(
-            name="get_tyranoscript_reference",
-            description="TyranoScriptのタグリファレンスを取得",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "category": {
-                        "type": "string",
-                        "description": "カテゴリ (text, character, background, choice, variable, audio, all)",
-                        "enum": ["text", "character", "background", "choice", "variable", "audio", "all"],
-                        "default": "all",
-                    },
-                },
-            },
-        ),
-        types.Tool(
-            name="validate_scenario",
-            description="シナリオファイルの構文チェック（基本的なタグの検証）",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                    "scenario_file": {
-                        "type": "string",
-                        "description": "シナリオファイル名",
-                    },
-                },
-                "required": ["project_name", "scenario_file"],
-            },
-        ),
-        types.Tool(
-            name="generate_scenario_template",
-            description="テンプレートからシナリオを生成",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                    "scenario_file": {
-                        "type": "string",
-                        "description": "生成するシナリオファイル名",
-                    },
-                    "template_type": {
-                        "type": "string",
-                        "description": "テンプレートタイプ",
-                        "enum": ["basic_scene", "character_intro", "choice_branch", "dialogue", "title_screen"],
-                    },
-                    "params": {
-                        "type": "object",
-                        "description": "テンプレートパラメータ（JSON形式）",
-                        "default": {},
-                    },
-                },
-                "required": ["project_name", "scenario_file", "template_type"],
-            },
-        ),
-        types.Tool(
-            name="analyze_project",
-            description="プロジェクト全体を分析（シナリオ統計、リソース使用状況等）",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                },
-                "required": ["project_name"],
-            },
-        ),
-        types.Tool(
-            name="analyze_scenario_flow",
-            description="シナリオフローを解析（ラベル間の遷移を可視化）",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                    "scenario_file": {
-                        "type": "string",
-                        "description": "シナリオファイル名",
-                    },
-                },
-                "required": ["project_name", "scenario_file"],
-            },
-        ),
-        types.Tool(
-            name="git_init",
-            description="プロジェクトにGitリポジトリを初期化",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                },
-                "required": ["project_name"],
-            },
-        ),
-        types.Tool(
-            name="git_commit",
-            description="プロジェクトの変更をコミット",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                    "message": {
-                        "type": "string",
-                        "description": "コミットメッセージ",
-                    },
-                },
-                "required": ["project_name", "message"],
-            },
-        ),
-        types.Tool(
-            name="git_status",
-            description="Gitリポジトリの状態を確認",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                },
-                "required": ["project_name"],
-            },
-        ),
-        types.Tool(
-            name="git_log",
-            description="コミット履歴を表示",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                    "limit": {
-                        "type": "number",
-                        "description": "表示件数",
-                        "default": 10,
-                    },
-                },
-                "required": ["project_name"],
-            },
-        ),
-        types.Tool(
-            name="optimize_resources",
-            description="プロジェクトのリソース使用状況を分析し、最適化提案を行う",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                },
-                "required": ["project_name"],
-            },
-        ),
-        types.Tool(
-            name="batch_rename",
-            description="複数ファイルを一括リネーム",
-            inputSchema={
-                "type": "object",
-                "properties": {
-                    "project_name": {
-                        "type": "string",
-                        "description": "プロジェクト名",
-                    },
-                    "pattern": {
-                        "type": "string",
-                        "description": "検索パターン（正規表現）",
-                    },
-                    "replacement": {
-                        "type": "string",
-                        "description": "置換文字列",
-                    },
-                    "target_dir": {
-                        "type": "string",
-                        "description": "対象ディレクトリ（data/配下の相対パス）",
-                    },
-                },
-                "required": ["project_name", "pattern", "replacement", "target_dir"],
-            },
-        ),
-    ]
+    """利用可能なツールのリスト（呼び出し側が変更してもレジストリに影響しないよう複製を返す）"""
+    return list(TOOL_DEFINITIONS)
 
 
 @app.call_tool()
 async def call_tool(name: str, arguments: Any) -> list[types.TextContent]:
     """ツールの実行"""
+    handler = TOOL_HANDLERS.get(name)
+    if handler is None:
+        return [types.TextContent(type="text", text=f"Unknown tool: {name}")]
+
+    metrics = CallMetrics()
+    token = _call_metrics.set(metrics)
+    started = time.perf_counter()
+    ok = True
     try:
-        if name == "list_projects":
-            return await list_projects_handler()
-        elif name == "create_project":
-            return await create_project_handler(arguments)
-        elif name == "read_scenario":
-            return await read_scenario_handler(arguments)
-        elif name == "write_scenario":
-            return await write_scenario_handler(arguments)
-        elif name == "list_project_files":
-            return await list_project_files_handler(arguments)
-        elif name == "read_config":
-            return await read_config_handler(arguments)
-        elif name == "write_config":
-            return await write_config_handler(arguments)
-        elif name == "add_image":
-            return await add_image_handler(arguments)
-        elif name == "add_audio":
-            return await add_audio_handler(arguments)
-        elif name == "list_audio":
-            return await list_audio_handler(arguments)
-        elif name == "delete_project":
-            return await delete_project_handler(arguments)
-        elif name == "get_tyranoscript_reference":
-            return await get_tyranoscript_reference_handler(arguments)
-        elif name == "validate_scenario":
-            return await validate_scenario_handler(arguments)
-        elif name == "generate_scenario_template":
-            return await generate_scenario_template_handler(arguments)
-        elif name == "analyze_project":
-            return await analyze_project_handler(arguments)
-        elif name == "analyze_scenario_flow":
-            return await analyze_scenario_flow_handler(arguments)
-        elif name == "git_init":
-            return await git_init_handler(arguments)
-        elif name == "git_commit":
-            return await git_commit_handler(arguments)
-        elif name == "git_status":
-            return await git_status_handler(arguments)
-        elif name == "git_log":
-            return await git_log_handler(arguments)
-        elif name == "optimize_resources":
-            return await optimize_resources_handler(arguments)
-        elif name == "batch_rename":
-            return await batch_rename_handler(arguments)
-        else:
-            return [types.TextContent(type="text", text=f"Unknown tool: {name}")]
+        return await handler(arguments or {})
     except Exception as e:
+        ok = False
         return [types.TextContent(type="text", text=f"Error: {str(e)}")]
-
-
-async def list_projects_handler() -> list[types.TextContent]:
+    finally:
+        elapsed = time.perf_counter() - started
+        _call_metrics.reset(token)
+        tool_stats.setdefault(name, ToolStats()).add(elapsed, metrics, ok)
+        write_trace({
+            "ts": time.time(),
+            "tool": name,
+            "ms": round(elapsed * 1000, 3),
+            "ok": ok,
+            "bytes_read": metrics.bytes_read,
+            "bytes_written": metrics.bytes_written,
+            "files": metrics.files,
+            "cache_hits": metrics.cache_hits,
+            "cache_misses": metrics.cache_misses,
+        })
+
+
+@tool(
+    "list_projects",
+    "TyranoStudioのプロジェクト一覧を取得",
+)
+async def list_projects_handler(arguments: dict | None = None) -> list[types.TextContent]:
     """プロジェクト一覧を取得"""
     if not PROJECTS_DIR.exists():
         return [types.TextContent(type="text", text="プロジェクトディレクトリが存在しません")]
 
-    projects = [d.name for d in PROJECTS_DIR.iterdir() if d.is_dir()]
+    projects = await asyncio.to_thread(
+        lambda: [d.name for d in PROJECTS_DIR.iterdir() if d.is_dir() and not d.name.startswith(".")]
+    )
 
     if not projects:
         return [types.TextContent(type="text", text="プロジェクトが見つかりません")]
@@ -504,10 +2834,31 @@ async def list_projects_handler() -> list[types.TextContent]:
     return [types.TextContent(type="text", text=result)]
 
 
+@tool(
+    "create_project",
+    "新しいTyranoScriptプロジェクトを作成",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "template": {
+            "type": "string",
+            "description": "テンプレート (tyranoscript_ja または tyranoscript_en)",
+            "enum": ["tyranoscript_ja", "tyranoscript_en"],
+            "default": "tyranoscript_ja",
+        },
+        "copy_mode": {
+            "type": "string",
+            "description": "複製方法 (copy: 全ファイルをコピー, link: reflink/ハードリンクで高速・省容量に複製)",
+            "enum": ["copy", "link"],
+            "default": DEFAULT_COPY_MODE,
+        },
+    },
+    required=["project_name"],
+)
 async def create_project_handler(arguments: dict) -> list[types.TextContent]:
     """新しいプロジェクトを作成"""
     project_name = arguments["project_name"]
     template = arguments.get("template", "tyranoscript_ja")
+    copy_mode = arguments.get("copy_mode", DEFAULT_COPY_MODE)
 
     project_path = PROJECTS_DIR / project_name
     template_path = SYSTEM_MASTER_DIR / template
@@ -518,12 +2869,54 @@ async def create_project_handler(arguments: dict) -> list[types.TextContent]:
     if not template_path.exists():
         return [types.TextContent(type="text", text=f"テンプレート '{template}' が見つかりません")]
 
+    if copy_mode == "link":
+        stats = await asyncio.to_thread(clone_template, template_path, project_path)
+        return [types.TextContent(
+            type="text",
+            text=f"プロジェクト '{project_name}' を作成しました"
+                 f"（reflink {stats.reflinked} / ハードリンク {stats.linked} / コピー {stats.copied}ファイル、"
+                 f"実コピー {stats.bytes_copied / 1024:.1f} KB）"
+        )]
+
     # テンプレートをコピー
-    shutil.copytree(template_path, project_path)
+    await asyncio.to_thread(shutil.copytree, template_path, project_path)
 
     return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' を作成しました")]
 
 
+@tool(
+    "read_scenario",
+    "プロジェクトのシナリオファイル(.ks)を読み込む",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "scenario_file": {
+            "type": "string",
+            "description": "シナリオファイル名 (data/scenario内の.ksファイル)",
+        },
+        "start_line": {
+            "type": "integer",
+            "description": "読み込み開始行 (1始まり)",
+        },
+        "end_line": {
+            "type": "integer",
+            "description": "読み込み終了行 (この行を含む)",
+        },
+        "label": {
+            "type": "string",
+            "description": "このラベルから次のラベルの直前までを読み込む",
+        },
+        "offset": {
+            "type": "integer",
+            "description": "読み込み開始バイト位置 (前回の応答の続きの位置を指定)",
+        },
+        "max_bytes": {
+            "type": "integer",
+            "description": "offset指定時に読み込む最大バイト数",
+            "default": DEFAULT_READ_BYTES,
+        },
+    },
+    required=["project_name", "scenario_file"],
+)
 async def read_scenario_handler(arguments: dict) -> list[types.TextContent]:
     """シナリオファイルを読み込む"""
     project_name = arguments["project_name"]
@@ -538,10 +2931,44 @@ async def read_scenario_handler(arguments: dict) -> list[types.TextContent]:
     if not scenario_path.exists():
         return [types.TextContent(type="text", text=f"シナリオファイル '{scenario_file}' が見つかりません")]
 
-    content = scenario_path.read_text(encoding="utf-8")
-    return [types.TextContent(type="text", text=content)]
+    modes = [
+        bool(arguments.get("label")),
+        arguments.get("offset") is not None,
+        arguments.get("start_line") is not None or arguments.get("end_line") is not None,
+    ]
+    if not any(modes):
+        content = await asyncio.to_thread(read_text_file, scenario_path)
+        return [types.TextContent(type="text", text=content)]
+    if sum(modes) > 1:
+        return [types.TextContent(type="text", text="label・行範囲・offset はいずれか1つだけ指定してください")]
 
+    try:
+        content, info = await asyncio.to_thread(read_scenario_range, scenario_path, arguments)
+    except ValueError as e:
+        return [types.TextContent(type="text", text=str(e))]
 
+    return [
+        types.TextContent(type="text", text=content),
+        types.TextContent(type="text", text=info),
+    ]
+
+
+@tool(
+    "write_scenario",
+    "プロジェクトのシナリオファイル(.ks)を書き込む",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "scenario_file": {
+            "type": "string",
+            "description": "シナリオファイル名 (data/scenario内の.ksファイル)",
+        },
+        "content": {
+            "type": "string",
+            "description": "書き込む内容",
+        },
+    },
+    required=["project_name", "scenario_file", "content"],
+)
 async def write_scenario_handler(arguments: dict) -> list[types.TextContent]:
     """シナリオファイルに書き込む"""
     project_name = arguments["project_name"]
@@ -552,17 +2979,126 @@ async def write_scenario_handler(arguments: dict) -> list[types.TextContent]:
     if not scenario_file.endswith(".ks"):
         scenario_file += ".ks"
 
-    scenario_dir = PROJECTS_DIR / project_name / "data" / "scenario"
-    scenario_path = scenario_dir / scenario_file
+    scenario_path = PROJECTS_DIR / project_name / "data" / "scenario" / scenario_file
 
     # ディレクトリが存在しない場合は作成
-    scenario_dir.mkdir(parents=True, exist_ok=True)
-
-    scenario_path.write_text(content, encoding="utf-8")
+    await asyncio.to_thread(write_text_file, scenario_path, content)
+    scenario_cache.invalidate(scenario_path)
+    line_index_cache.invalidate(scenario_path)
 
     return [types.TextContent(type="text", text=f"シナリオファイル '{scenario_file}' を保存しました")]
 
 
+@tool(
+    "patch_scenario",
+    "シナリオファイルの一部だけを書き換える（unified diff またはラベル単位の置き換え）",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "scenario_file": {
+            "type": "string",
+            "description": "シナリオファイル名 (data/scenario内の.ksファイル)",
+        },
+        "diff": {
+            "type": "string",
+            "description": "適用する unified diff (@@ -開始,行数 +開始,行数 @@ のハンク)",
+        },
+        "operations": {
+            "type": "array",
+            "description": "ラベルブロックの置き換え。*label 行から次のラベルの直前までを content で置き換える",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "label": {"type": "string", "description": "ラベル名"},
+                    "content": {"type": "string", "description": "新しいブロックの内容 (*label 行を含む)"},
+                },
+                "required": ["label", "content"],
+            },
+        },
+    },
+    required=["project_name", "scenario_file"],
+)
+async def patch_scenario_handler(arguments: dict) -> list[types.TextContent]:
+    """シナリオファイルにパッチを適用"""
+    project_name = arguments["project_name"]
+    scenario_file = arguments["scenario_file"]
+    diff = arguments.get("diff")
+    operations = arguments.get("operations")
+
+    if not scenario_file.endswith(".ks"):
+        scenario_file += ".ks"
+
+    scenario_path = PROJECTS_DIR / project_name / "data" / "scenario" / scenario_file
+
+    if not scenario_path.exists():
+        return [types.TextContent(type="text", text=f"シナリオファイル '{scenario_file}' が見つかりません")]
+
+    if bool(diff) == bool(operations):
+        return [types.TextContent(type="text", text="diff と operations のどちらか一方を指定してください")]
+
+    try:
+        changed = await asyncio.to_thread(patch_scenario_file, scenario_path, diff, operations)
+    except ValueError as e:
+        return [types.TextContent(type="text", text=f"パッチを適用できません: {e}")]
+
+    ranges = ", ".join(f"{start}-{end}" if end >= start else f"{start}(削除)" for start, end in changed)
+    return [types.TextContent(
+        type="text",
+        text=f"シナリオファイル '{scenario_file}' にパッチを適用しました（{len(changed)}箇所、変更行: {ranges}）"
+    )]
+
+
+@tool(
+    "list_project_files",
+    "プロジェクト内のファイル一覧を取得",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "path": {
+            "type": "string",
+            "description": "相対パス (省略時はプロジェクトルート)",
+            "default": "",
+        },
+        "recursive": {
+            "type": "boolean",
+            "description": "サブディレクトリも含めて一覧する",
+            "default": False,
+        },
+        "max_depth": {
+            "type": "integer",
+            "description": "recursive時の最大深さ (0で無制限)",
+            "default": 0,
+        },
+        "pattern": {
+            "type": "string",
+            "description": "ファイル名または相対パスのglobパターン (例: *.ks, bgimage/room_*)",
+        },
+        "extensions": {
+            "type": "array",
+            "items": {"type": "string"},
+            "description": "拡張子で絞り込む (例: [\".png\", \".jpg\"])",
+        },
+        "sort": {
+            "type": "string",
+            "description": "並び順 (name, size, mtime)",
+            "enum": list(FILE_SORT_KEYS),
+            "default": "name",
+        },
+        "descending": {
+            "type": "boolean",
+            "description": "降順に並べる",
+            "default": False,
+        },
+        "limit": {
+            "type": "integer",
+            "description": "1回に返す最大件数",
+            "default": FILE_LIST_LIMIT,
+        },
+        "cursor": {
+            "type": "string",
+            "description": "前回の応答で返された続きの位置",
+        },
+    },
+    required=["project_name"],
+)
 async def list_project_files_handler(arguments: dict) -> list[types.TextContent]:
     """プロジェクト内のファイル一覧を取得"""
     project_name = arguments["project_name"]
@@ -577,22 +3113,48 @@ async def list_project_files_handler(arguments: dict) -> list[types.TextContent]
     if not target_path.exists():
         return [types.TextContent(type="text", text=f"パス '{rel_path}' が見つかりません")]
 
-    files = []
-    dirs = []
+    if not target_path.is_dir():
+        return [types.TextContent(type="text", text=f"パス '{rel_path}' はディレクトリではありません")]
 
-    for item in target_path.iterdir():
-        if item.is_dir():
-            dirs.append(f"[DIR]  {item.name}")
-        else:
-            size = item.stat().st_size
-            files.append(f"[FILE] {item.name} ({size} bytes)")
-
-    result = f"プロジェクト '{project_name}' のファイル一覧 ({rel_path or 'root'}):\n"
-    result += "\n".join(dirs + files)
+    sort = arguments.get("sort", "name")
+    if sort not in FILE_SORT_KEYS:
+        return [types.TextContent(type="text", text=f"sort は {', '.join(FILE_SORT_KEYS)} のいずれかを指定してください")]
 
-    return [types.TextContent(type="text", text=result)]
+    max_depth = int(arguments.get("max_depth", 0)) if arguments.get("recursive") else 1
+    extensions = frozenset(
+        ext.lower() if ext.startswith(".") else f".{ext.lower()}" for ext in arguments.get("extensions") or []
+    )
+    limit = max(1, int(arguments.get("limit", FILE_LIST_LIMIT)))
 
+    def collect():
+        files = scan_files(target_path, max_depth, arguments.get("pattern", ""), extensions)
+        return len(files), *page_files(files, sort, arguments.get("descending", False), limit, arguments.get("cursor"))
 
+    try:
+        total, page, next_cursor = await asyncio.to_thread(collect)
+    except ValueError as e:
+        return [types.TextContent(type="text", text=str(e))]
+
+    lines = [f"プロジェクト '{project_name}' のファイル一覧 ({rel_path or 'root'}):"]
+    lines.extend(
+        f"[DIR]  {f.path}" if f.is_dir else f"[FILE] {f.path} ({f.size} bytes)"
+        for f in page
+    )
+    if next_cursor:
+        lines.append("")
+        lines.append(f"（{total}件中 {len(page)}件を表示。続きは cursor=\"{next_cursor}\" で取得できます）")
+
+    return [types.TextContent(type="text", text="\n".join(lines))]
+
+
+@tool(
+    "read_config",
+    "プロジェクトの設定ファイル(Config.tjs)を読み込む",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+    },
+    required=["project_name"],
+)
 async def read_config_handler(arguments: dict) -> list[types.TextContent]:
     """設定ファイルを読み込む"""
     project_name = arguments["project_name"]
@@ -601,24 +3163,55 @@ async def read_config_handler(arguments: dict) -> list[types.TextContent]:
     if not config_path.exists():
         return [types.TextContent(type="text", text=f"設定ファイルが見つかりません")]
 
-    content = config_path.read_text(encoding="utf-8")
+    content = await asyncio.to_thread(read_text_file, config_path)
     return [types.TextContent(type="text", text=content)]
 
 
+@tool(
+    "write_config",
+    "プロジェクトの設定ファイル(Config.tjs)を書き込む",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "content": {
+            "type": "string",
+            "description": "書き込む内容",
+        },
+    },
+    required=["project_name", "content"],
+)
 async def write_config_handler(arguments: dict) -> list[types.TextContent]:
     """設定ファイルに書き込む"""
     project_name = arguments["project_name"]
     content = arguments["content"]
 
-    config_dir = PROJECTS_DIR / project_name / "data" / "system"
-    config_path = config_dir / "Config.tjs"
+    config_path = PROJECTS_DIR / project_name / "data" / "system" / "Config.tjs"
 
-    config_dir.mkdir(parents=True, exist_ok=True)
-    config_path.write_text(content, encoding="utf-8")
+    await asyncio.to_thread(write_text_file, config_path, content)
 
     return [types.TextContent(type="text", text=f"設定ファイルを保存しました")]
 
 
+@tool(
+    "add_image",
+    "プロジェクトに画像ファイルを追加",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "source_path": {
+            "type": "string",
+            "description": "コピー元の画像ファイルパス",
+        },
+        "dest_category": {
+            "type": "string",
+            "description": "配置先カテゴリ (fgimage, bgimage, system など)",
+        },
+        "dest_filename": {
+            "type": "string",
+            "description": "配置先ファイル名 (省略時は元のファイル名)",
+            "default": "",
+        },
+    },
+    required=["project_name", "source_path", "dest_category"],
+)
 async def add_image_handler(arguments: dict) -> list[types.TextContent]:
     """画像ファイルを追加"""
     project_name = arguments["project_name"]
@@ -631,18 +3224,39 @@ async def add_image_handler(arguments: dict) -> list[types.TextContent]:
 
     # 配置先ディレクトリ
     dest_dir = PROJECTS_DIR / project_name / "data" / dest_category
-    dest_dir.mkdir(parents=True, exist_ok=True)
 
     # ファイル名
     filename = dest_filename if dest_filename else source_path.name
     dest_path = dest_dir / filename
 
     # コピー
-    shutil.copy2(source_path, dest_path)
+    await asyncio.to_thread(copy_file, source_path, dest_path)
 
     return [types.TextContent(type="text", text=f"画像ファイル '{filename}' を {dest_category} に追加しました")]
 
 
+@tool(
+    "add_audio",
+    "プロジェクトに音声ファイル（BGM/効果音）を追加",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "source_path": {
+            "type": "string",
+            "description": "コピー元の音声ファイルパス",
+        },
+        "audio_type": {
+            "type": "string",
+            "description": "音声タイプ (bgm: BGM, sound: 効果音)",
+            "enum": ["bgm", "sound"],
+        },
+        "dest_filename": {
+            "type": "string",
+            "description": "配置先ファイル名 (省略時は元のファイル名)",
+            "default": "",
+        },
+    },
+    required=["project_name", "source_path", "audio_type"],
+)
 async def add_audio_handler(arguments: dict) -> list[types.TextContent]:
     """音声ファイルを追加"""
     project_name = arguments["project_name"]
@@ -655,7 +3269,6 @@ async def add_audio_handler(arguments: dict) -> list[types.TextContent]:
 
     # 配置先ディレクトリ
     dest_dir = PROJECTS_DIR / project_name / "data" / audio_type
-    dest_dir.mkdir(parents=True, exist_ok=True)
 
     # ファイル名
     filename = dest_filename if dest_filename else source_path.name
@@ -663,13 +3276,321 @@ async def add_audio_handler(arguments: dict) -> list[types.TextContent]:
 
     # コピー
     try:
-        shutil.copy2(source_path, dest_path)
+        await asyncio.to_thread(copy_file, source_path, dest_path)
         type_name = "BGM" if audio_type == "bgm" else "効果音"
         return [types.TextContent(type="text", text=f"{type_name}ファイル '{filename}' を追加しました")]
     except Exception as e:
         return [types.TextContent(type="text", text=f"ファイルコピーエラー: {str(e)}")]
 
 
+@dataclass(slots=True)
+class ImportItem:
+    """一括取り込みの1ファイル"""
+    source: Path
+    rel: str
+    category: str
+    size: int
+    sha1: str | None = None
+    status: str = "copy"  # copy, duplicate, conflict, error
+    detail: str = ""
+
+
+def collect_import_sources(source: str, recursive: bool) -> list[tuple[Path, str]]:
+    """取り込み元のファイル一覧 [(パス, 取り込み元からの相対パス)]（ディレクトリまたはglob）"""
+    source_path = Path(source).expanduser()
+    if source_path.is_dir():
+        files = scan_files(source_path, 0 if recursive else 1)
+        return [(source_path / f.path, f.path) for f in files if not f.is_dir]
+    matches = glob.glob(str(source_path), recursive=True)
+    return [(Path(m), Path(m).name) for m in sorted(matches) if os.path.isfile(m)]
+
+
+def match_category(rel: str, rules: list[dict], default_category: str) -> str:
+    """ルールの先頭から順に照合して配置先カテゴリを決める"""
+    name = rel.rsplit("/", 1)[-1]
+    for rule in rules:
+        pattern = rule["pattern"]
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(rel, pattern):
+            return rule["category"]
+    return default_category
+
+
+def plan_import(items: list[ImportItem], data_dir: Path, overwrite: bool):
+    """内容ハッシュで重複を判定し、各ファイルの処理を決める
+
+    ハッシュは同じカテゴリに同じサイズのファイルがある場合だけ計算する。
+    """
+    by_category: dict[str, list[ImportItem]] = {}
+    for item in items:
+        by_category.setdefault(item.category, []).append(item)
+
+    for category, category_items in by_category.items():
+        existing = file_sizes(data_dir / category)
+        source_sizes: dict[int, int] = {}
+        for item in category_items:
+            source_sizes[item.size] = source_sizes.get(item.size, 0) + 1
+        existing_sizes = set(existing.values())
+
+        # サイズが衝突するものだけハッシュを計算
+        to_hash = [item for item in category_items if item.size in existing_sizes or source_sizes[item.size] > 1]
+        for item, digest in zip(to_hash, map_io(lambda item: file_sha1(item.source), to_hash)):
+            item.sha1 = digest
+        hash_sizes = {item.size for item in to_hash}
+        existing_to_hash = [name for name, size in existing.items() if size in hash_sizes]
+        known = dict(zip(
+            map_io(lambda name: file_sha1(data_dir / category / name), existing_to_hash),
+            existing_to_hash,
+        ))
+
+        planned: set[str] = set()
+        for item in category_items:
+            name = item.source.name
+            if item.sha1 and item.sha1 in known:
+                item.status, item.detail = "duplicate", known[item.sha1]
+                continue
+            if name in planned or (name in existing and not overwrite):
+                item.status, item.detail = "conflict", name
+                continue
+            planned.add(name)
+            if item.sha1:
+                known[item.sha1] = name
+
+
+# 一括取り込みの既定のコピー並列数（I/O待ちが主なのでCPU数より多めにする）
+IMPORT_WORKERS = min(32, ANALYSIS_WORKERS * 4)
+
+
+def run_import(items: list[ImportItem], data_dir: Path, workers: int) -> int:
+    """処理が copy のファイルを並列数を制限してコピーし、コピーしたバイト数を返す"""
+    def copy_one(item: ImportItem) -> int:
+        try:
+            copy_file(item.source, data_dir / item.category / item.source.name)
+            return item.size
+        except OSError as e:
+            item.status, item.detail = "error", str(e)
+            return 0
+
+    to_copy = [item for item in items if item.status == "copy"]
+    if len(to_copy) < 2 or workers < 2:
+        return sum(copy_one(item) for item in to_copy)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tyrano-import") as executor:
+        return sum(executor.map(in_caller_context(copy_one), to_copy))
+
+
+@tool(
+    "bulk_import_assets",
+    "ディレクトリまたはglobで指定した素材をカテゴリ振り分けルールに従って一括取り込み（重複はスキップ）",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "source": {
+            "type": "string",
+            "description": "取り込み元ディレクトリ、またはglobパターン (例: /art/sprites/**/*.png)",
+        },
+        "rules": {
+            "type": "array",
+            "description": "カテゴリ振り分けルール。先頭から順にファイル名または相対パスをglobで照合する",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "pattern": {"type": "string", "description": "globパターン (例: bg_*.jpg)"},
+                    "category": {"type": "string", "description": "配置先カテゴリ (bgimage, fgimage, bgm など)"},
+                },
+                "required": ["pattern", "category"],
+            },
+        },
+        "default_category": {
+            "type": "string",
+            "description": "どのルールにも一致しなかったファイルの配置先 (省略時は取り込まない)",
+            "default": "",
+        },
+        "recursive": {
+            "type": "boolean",
+            "description": "取り込み元ディレクトリのサブディレクトリも含める",
+            "default": True,
+        },
+        "overwrite": {
+            "type": "boolean",
+            "description": "同名で内容が異なるファイルを上書きする",
+            "default": False,
+        },
+        "workers": {
+            "type": "integer",
+            "description": "コピーの並列数",
+            "default": IMPORT_WORKERS,
+        },
+        "dry_run": {
+            "type": "boolean",
+            "description": "コピーせずに取り込み計画だけを表示",
+            "default": False,
+        },
+    },
+    required=["project_name", "source"],
+)
+async def bulk_import_assets_handler(arguments: dict) -> list[types.TextContent]:
+    """素材を一括で取り込む"""
+    project_name = arguments["project_name"]
+    source = arguments["source"]
+    rules = arguments.get("rules") or []
+    default_category = arguments.get("default_category", "")
+    dry_run = arguments.get("dry_run", False)
+    workers = max(1, int(arguments.get("workers", IMPORT_WORKERS)))
+
+    project_path = PROJECTS_DIR / project_name
+    if not project_path.exists():
+        return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' が見つかりません")]
+
+    for category in [rule["category"] for rule in rules] + [default_category]:
+        if category and (category in (".", "..") or "/" in category or "\\" in category):
+            return [types.TextContent(type="text", text=f"カテゴリ '{category}' が不正です")]
+
+    data_dir = project_path / "data"
+    start = time.perf_counter()
+
+    def import_all():
+        sources = collect_import_sources(source, arguments.get("recursive", True))
+        items, unmatched = [], []
+        for path, rel in sources:
+            category = match_category(rel, rules, default_category)
+            if category:
+                items.append(ImportItem(path, rel, category, path.stat().st_size))
+            else:
+                unmatched.append(rel)
+        plan_import(items, data_dir, arguments.get("overwrite", False))
+        copied_bytes = 0 if dry_run else run_import(items, data_dir, workers)
+        return sources, items, unmatched, copied_bytes
+
+    sources, items, unmatched, copied_bytes = await asyncio.to_thread(import_all)
+    elapsed = time.perf_counter() - start
+
+    if not sources:
+        return [types.TextContent(type="text", text=f"取り込み元 '{source}' にファイルが見つかりません")]
+
+    groups: dict[str, list[ImportItem]] = {"copy": [], "duplicate": [], "conflict": [], "error": []}
+    for item in items:
+        groups[item.status].append(item)
+
+    lines = [f"📦 素材の一括取り込み{'（ドライラン）' if dry_run else ''}: {project_name}", "=" * 60, ""]
+    per_category: dict[str, int] = {}
+    for item in groups["copy"]:
+        per_category[item.category] = per_category.get(item.category, 0) + 1
+    lines.append(f"【{'取り込み予定' if dry_run else '取り込み'}】{len(groups['copy'])}件")
+    lines.extend(f"- {category}: {count}件" for category, count in sorted(per_category.items()))
+
+    if groups["duplicate"]:
+        lines.append(f"\n【重複のためスキップ】{len(groups['duplicate'])}件")
+        lines.extend(f"- {item.rel} (= {item.category}/{item.detail})" for item in groups["duplicate"][:20])
+    if groups["conflict"]:
+        lines.append(f"\n【同名ファイルが既に存在】{len(groups['conflict'])}件")
+        lines.extend(f"- {item.rel} → {item.category}/{item.detail}" for item in groups["conflict"][:20])
+    if groups["error"]:
+        lines.append(f"\n【エラー】{len(groups['error'])}件")
+        lines.extend(f"- {item.rel}: {item.detail}" for item in groups["error"][:20])
+    if unmatched:
+        lines.append(f"\n【ルールに一致せず未取り込み】{len(unmatched)}件")
+        lines.extend(f"- {rel}" for rel in unmatched[:20])
+
+    if not dry_run:
+        copied = len(groups["copy"])
+        lines.append("")
+        lines.append("【スループット】")
+        lines.append(f"- 所要時間: {elapsed:.2f}秒 (並列数 {workers})")
+        lines.append(f"- {copied / elapsed:.1f} ファイル/秒, {copied_bytes / 1024 / 1024 / elapsed:.1f} MB/秒"
+                     f" (合計 {copied_bytes / 1024 / 1024:.1f} MB)")
+
+    return [types.TextContent(type="text", text="\n".join(lines))]
+
+
+@tool(
+    "dedupe_assets",
+    "プロジェクト間で重複している素材を検出し、共有アセットストアへのハードリンクに置き換えて容量を解放",
+    properties={
+        "project_name": {
+            "type": "string",
+            "description": "対象プロジェクト (省略時は全プロジェクト)",
+        },
+        "action": {
+            "type": "string",
+            "description": "操作 (report: 重複を報告, reclaim: ハードリンクに置き換え, gc: 参照されなくなった実体を削除)",
+            "enum": ["report", "reclaim", "gc"],
+            "default": "report",
+        },
+    },
+)
+async def dedupe_assets_handler(arguments: dict) -> list[types.TextContent]:
+    """素材の重複を報告・解消"""
+    project_name = arguments.get("project_name")
+    action = arguments.get("action", "report")
+    store = asset_store()
+
+    if action == "gc":
+        removed, freed = await asyncio.to_thread(store.gc)
+        return [types.TextContent(
+            type="text",
+            text=f"🧹 参照されていない実体を {removed}件 削除しました（{freed / 1024 / 1024:.1f} MB）"
+        )]
+
+    if project_name:
+        project_path = PROJECTS_DIR / project_name
+        if not project_path.exists():
+            return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' が見つかりません")]
+        project_paths = [project_path]
+    elif PROJECTS_DIR.exists():
+        project_paths = [p for p in PROJECTS_DIR.iterdir() if p.is_dir() and not p.name.startswith(".")]
+    else:
+        project_paths = []
+
+    def analyze():
+        files = store.collect(project_paths)
+        groups = store.duplicate_groups(files)
+        inodes = {}
+        for f in files:
+            inodes[f.inode] = f.size
+        return files, groups, sum(inodes.values())
+
+    files, groups, disk_bytes = await asyncio.to_thread(analyze)
+    logical_bytes = sum(f.size for f in files)
+    duplicate_bytes = sum(
+        group[0].size * (len({f.inode for f in group}) - 1) for group in groups.values()
+    )
+
+    lines = [f"🗄️ 素材の重複 ({project_name or '全プロジェクト'})", "=" * 60, ""]
+    lines.append(f"- ファイル数: {len(files)}")
+    lines.append(f"- 合計サイズ: {logical_bytes / 1024 / 1024:.1f} MB（ディスク上 {disk_bytes / 1024 / 1024:.1f} MB）")
+    lines.append(f"- 重複: {len(groups)}種類 / 解放可能 {duplicate_bytes / 1024 / 1024:.1f} MB")
+
+    if action == "reclaim":
+        relinked, freed = await asyncio.to_thread(store.reclaim, groups)
+        lines.append("")
+        lines.append(f"♻️ {relinked}ファイルを共有ストアへのハードリンクに置き換え、{freed / 1024 / 1024:.1f} MB を解放しました")
+        return [types.TextContent(type="text", text="\n".join(lines))]
+
+    if groups:
+        lines.append("")
+        lines.append("【重複の多い素材】")
+        top = sorted(groups.values(), key=lambda g: -g[0].size * (len({f.inode for f in g}) - 1))[:10]
+        for group in top:
+            lines.append(f"- {group[0].path.name} ({group[0].size / 1024:.1f} KB × {len(group)}件)")
+            lines.extend(f"    {f.path.relative_to(PROJECTS_DIR)}" for f in group[:5])
+        lines.append("")
+        lines.append("action: \"reclaim\" で重複をハードリンクに置き換えられます")
+
+    return [types.TextContent(type="text", text="\n".join(lines))]
+
+
+@tool(
+    "list_audio",
+    "プロジェクト内の音声ファイル一覧を取得",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "audio_type": {
+            "type": "string",
+            "description": "音声タイプ (bgm, sound, all)",
+            "enum": ["bgm", "sound", "all"],
+            "default": "all",
+        },
+    },
+    required=["project_name"],
+)
 async def list_audio_handler(arguments: dict) -> list[types.TextContent]:
     """音声ファイル一覧を取得"""
     project_name = arguments["project_name"]
@@ -682,9 +3603,8 @@ async def list_audio_handler(arguments: dict) -> list[types.TextContent]:
     result = []
 
     if audio_type in ["bgm", "all"]:
-        bgm_dir = project_path / "data" / "bgm"
-        if bgm_dir.exists():
-            bgm_files = [f.name for f in bgm_dir.iterdir() if f.is_file()]
+        bgm_files = await asset_files(project_path, "bgm")
+        if bgm_files is not None:
             if bgm_files:
                 result.append(f"【BGM】({len(bgm_files)}件)")
                 result.extend(f"  - {f}" for f in sorted(bgm_files))
@@ -692,9 +3612,8 @@ async def list_audio_handler(arguments: dict) -> list[types.TextContent]:
                 result.append("【BGM】なし")
 
     if audio_type in ["sound", "all"]:
-        sound_dir = project_path / "data" / "sound"
-        if sound_dir.exists():
-            sound_files = [f.name for f in sound_dir.iterdir() if f.is_file()]
+        sound_files = await asset_files(project_path, "sound")
+        if sound_files is not None:
             if sound_files:
                 result.append(f"【効果音】({len(sound_files)}件)")
                 result.extend(f"  - {f}" for f in sorted(sound_files))
@@ -707,6 +3626,14 @@ async def list_audio_handler(arguments: dict) -> list[types.TextContent]:
     return [types.TextContent(type="text", text="\n".join(result))]
 
 
+@tool(
+    "delete_project",
+    "プロジェクトを削除（ゴミ箱へ移動し、バックグラウンドで削除）",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+    },
+    required=["project_name"],
+)
 async def delete_project_handler(arguments: dict) -> list[types.TextContent]:
     """プロジェクトを削除"""
     project_name = arguments["project_name"]
@@ -715,11 +3642,105 @@ async def delete_project_handler(arguments: dict) -> list[types.TextContent]:
     if not project_path.exists():
         return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' が見つかりません")]
 
-    shutil.rmtree(project_path)
-
-    return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' を削除しました")]
-
-
+    # 同じ名前で作り直したときに古い解析結果を使わないよう、プロジェクトのキャッシュを破棄
+    watcher = project_watchers.pop(project_path, None)
+    if watcher:
+        watcher.stop()
+    drop_project_index(project_path)
+    scenario_cache.invalidate_tree(project_path)
+    line_index_cache.invalidate_tree(project_path)
+    _graph_cache.pop(project_path, None)
+    trashed = await asyncio.to_thread(move_to_trash, project_path)
+    schedule_purge(trashed)
+
+    return [types.TextContent(
+        type="text",
+        text=f"プロジェクト '{project_name}' を削除しました（バックグラウンドで削除中: {trashed.name}）"
+    )]
+
+
+@tool(
+    "purge_trash",
+    "ゴミ箱内の削除待ちプロジェクトをバックグラウンドで削除、または削除を中断",
+    properties={
+        "action": {
+            "type": "string",
+            "description": "操作 (purge: 削除を開始, cancel: 実行中の削除を中断)",
+            "enum": ["purge", "cancel"],
+            "default": "purge",
+        },
+    },
+)
+async def purge_trash_handler(arguments: dict) -> list[types.TextContent]:
+    """ゴミ箱を空にする"""
+    action = arguments.get("action", "purge")
+
+    if action == "cancel":
+        cancelled = [job.name for job in trash_jobs.values() if job.active]
+        for job in trash_jobs.values():
+            job.cancel_event.set()
+        if not cancelled:
+            return [types.TextContent(type="text", text="実行中の削除はありません")]
+        return [types.TextContent(
+            type="text",
+            text="🗑️ 削除を中断しました（残りは purge_trash で再開できます）:\n" + "\n".join(f"- {name}" for name in cancelled)
+        )]
+
+    jobs = purge_all_trash()
+    if not jobs:
+        return [types.TextContent(type="text", text="ゴミ箱は空です")]
+
+    return [types.TextContent(
+        type="text",
+        text=f"🗑️ {len(jobs)}件の削除をバックグラウンドで実行中です（進捗は trash_status で確認できます）"
+    )]
+
+
+@tool(
+    "trash_status",
+    "バックグラウンド削除の進捗とゴミ箱の中身を取得",
+)
+async def trash_status_handler(arguments: dict) -> list[types.TextContent]:
+    """ゴミ箱の状態を取得"""
+    trash = trash_dir()
+    entries = await asyncio.to_thread(lambda: sorted(p.name for p in trash.iterdir()) if trash.is_dir() else [])
+
+    if not entries and not trash_jobs:
+        return [types.TextContent(type="text", text="ゴミ箱は空です")]
+
+    state_labels = {
+        "pending": "待機中", "running": "削除中", "done": "完了",
+        "cancelled": "中断", "failed": "失敗",
+    }
+    lines = ["🗑️ ゴミ箱の状態", "=" * 60]
+    for name, job in trash_jobs.items():
+        progress = f"{job.removed_files}/{job.total_files}ファイル" if job.total_files else f"{job.removed_files}ファイル"
+        line = f"- {name}: {state_labels[job.state]} ({progress}, {job.removed_bytes / 1024 / 1024:.1f} MB)"
+        if job.error:
+            line += f" エラー: {job.error}"
+        lines.append(line)
+    for name in entries:
+        if name not in trash_jobs:
+            lines.append(f"- {name}: 未処理（purge_trash で削除できます）")
+    # 終わったジョブは一度報告したら忘れる（削除を繰り返しても溜まらないように）
+    for name in [name for name, job in trash_jobs.items() if not job.active]:
+        del trash_jobs[name]
+
+    return [types.TextContent(type="text", text="\n".join(lines))]
+
+
+@tool(
+    "get_tyranoscript_reference",
+    "TyranoScriptのタグリファレンスを取得",
+    properties={
+        "category": {
+            "type": "string",
+            "description": "カテゴリ (text, character, background, choice, variable, audio, all)",
+            "enum": ["text", "character", "background", "choice", "variable", "audio", "all"],
+            "default": "all",
+        },
+    },
+)
 async def get_tyranoscript_reference_handler(arguments: dict) -> list[types.TextContent]:
     """TyranoScriptのタグリファレンスを取得"""
     category = arguments.get("category", "all")
@@ -811,39 +3832,65 @@ async def get_tyranoscript_reference_handler(arguments: dict) -> list[types.Text
     return [types.TextContent(type="text", text=result)]
 
 
-async def validate_scenario_handler(arguments: dict) -> list[types.TextContent]:
-    """シナリオファイルの高度な構文チェック"""
-    project_name = arguments["project_name"]
-    scenario_file = arguments["scenario_file"]
-
-    if not scenario_file.endswith(".ks"):
-        scenario_file += ".ks"
-
-    project_path = PROJECTS_DIR / project_name
-    scenario_path = project_path / "data" / "scenario" / scenario_file
-
-    if not scenario_path.exists():
-        return [types.TextContent(type="text", text=f"シナリオファイル '{scenario_file}' が見つかりません")]
-
-    content = scenario_path.read_text(encoding="utf-8")
-    lines = content.split("\n")
+class ValidationContext:
+    """プロジェクト全体の検証で共有するラベル・キャラクター・リソースの索引"""
+
+    def __init__(self, project_path: Path):
+        self.project_path = project_path
+        self.scenario_dir = project_path / "data" / "scenario"
+        summaries = get_project_index(project_path).refresh()
+        self.labels = {
+            name: {label for label, _ in summary["labels"]}
+            for name, summary in summaries.items()
+        }
+        self.characters = {chara for summary in summaries.values() for chara in summary["characters"]}
+        self._index = get_project_index(project_path)
+        self._asset_names: dict[str, set[str]] = {}
+
+    def indexed_refs(self, scenario_file: str) -> list[tuple[str, str, int, str]] | None:
+        """インデックス済みのシナリオなら素材参照 [(category, storage, line, tag)]（未登録ならNone）"""
+        return self._index.query_resources(
+            lambda index: index.refs_in(scenario_file) if scenario_file in index.by_file else None,
+            refresh=False,
+        )
 
+    def labels_of(self, scenario_file: str) -> set[str] | None:
+        """シナリオファイルのラベル集合（ファイルがなければNone）"""
+        if scenario_file not in self.labels:
+            scenario_path = self.scenario_dir / scenario_file
+            if not scenario_path.is_file():
+                return None
+            self.labels[scenario_file] = {label.name for label in load_scenario(scenario_path).labels}
+        return self.labels[scenario_file]
+
+    def resource_exists(self, category: str, storage: str) -> bool:
+        """data/<category>/ にリソースが存在するか"""
+        if "/" in storage:
+            return (self.project_path / "data" / category / storage).exists()
+        if category not in self._asset_names:
+            resource_dir = self.project_path / "data" / category
+            names = set()
+            if resource_dir.is_dir():
+                with os.scandir(resource_dir) as it:
+                    names = {entry.name for entry in it}
+            self._asset_names[category] = names
+        return storage in self._asset_names[category]
+
+
+def scenario_storage_name(storage: str) -> str:
+    """storage属性をシナリオファイル名に正規化"""
+    return storage if storage.endswith(".ks") else storage + ".ks"
+
+
+def check_scenario(ctx: ValidationContext, scenario_file: str, ast: ScenarioAST) -> tuple[list, list, list]:
+    """シナリオ1ファイルを検証し (errors, warnings, info) を返す"""
     errors = []
     warnings = []
     info = []
 
     # ラベルとジャンプ先を収集
-    labels = set()
+    labels = {label.name for label in ast.labels}
     jump_targets = []
-    call_targets = []
-    link_targets = []
-
-    # リソース参照を収集
-    image_refs = []
-    bgm_refs = []
-    se_refs = []
-    video_refs = []
-    storage_refs = []
 
     # キャラクター定義と使用
     defined_charas = set()
@@ -851,156 +3898,107 @@ async def validate_scenario_handler(arguments: dict) -> list[types.TextContent]:
 
     # 基本的なチェック
     tag_stack = []
-    import re
-
-    for i, line in enumerate(lines, 1):
-        line_strip = line.strip()
-
-        # コメントはスキップ
-        if line_strip.startswith(";") or line_strip.startswith("//"):
-            continue
 
-        # ラベル定義を収集
-        if line_strip.startswith("*"):
-            label_name = line_strip[1:].strip()
-            if label_name:
-                labels.add(label_name)
+    for tag in ast.tags:
+        name = tag.name
+        i = tag.line
 
         # タグの対応チェック
-        if "[if" in line_strip:
-            tag_stack.append(("if", i))
-        elif "[endif]" in line_strip:
-            if tag_stack and tag_stack[-1][0] == "if":
-                tag_stack.pop()
-            else:
-                errors.append(f"行 {i}: 対応する[if]がありません")
-
-        if "[iscript]" in line_strip:
-            tag_stack.append(("iscript", i))
-        elif "[endscript]" in line_strip:
-            if tag_stack and tag_stack[-1][0] == "iscript":
+        if name in ("if", "iscript", "link"):
+            tag_stack.append((name, i))
+        elif name in ("endif", "endscript", "endlink"):
+            opener = name[3:]
+            if tag_stack and tag_stack[-1][0] == opener:
                 tag_stack.pop()
-            else:
-                errors.append(f"行 {i}: 対応する[iscript]がありません")
-
-        if "[link" in line_strip:
-            tag_stack.append(("link", i))
-        elif "[endlink]" in line_strip:
-            if tag_stack and tag_stack[-1][0] == "link":
-                tag_stack.pop()
-            else:
+            elif name == "endlink":
                 warnings.append(f"行 {i}: 対応する[link]がありません")
+            else:
+                errors.append(f"行 {i}: 対応する[{opener}]がありません")
 
-        # ジャンプ先のチェック
-        if "[jump" in line_strip or "@jump" in line_strip:
-            match = re.search(r'target=["\']?\*?([^"\'\s\]]+)', line_strip)
-            if match:
-                target = match.group(1)
-                jump_targets.append((target, i))
-
-        if "[call" in line_strip or "@call" in line_strip:
-            match = re.search(r'target=["\']?\*?([^"\'\s\]]+)', line_strip)
-            if match:
-                target = match.group(1)
-                call_targets.append((target, i))
-
-        if "[link" in line_strip or "[glink" in line_strip:
-            match = re.search(r'target=["\']?\*?([^"\'\s\]]+)', line_strip)
-            if match:
-                target = match.group(1)
-                link_targets.append((target, i))
-
-        # リソース参照のチェック
-        if "[bg" in line_strip or "[image" in line_strip or "[chara_new" in line_strip or "[chara_show" in line_strip or "[chara_mod" in line_strip:
-            match = re.search(r'storage=["\']([^"\']+)["\']', line_strip)
-            if match:
-                storage = match.group(1)
-                if "[bg" in line_strip:
-                    image_refs.append((storage, "bgimage", i))
-                elif "[image" in line_strip:
-                    image_refs.append((storage, "image", i))
-                elif "[chara" in line_strip:
-                    image_refs.append((storage, "fgimage", i))
-
-        if "[playbgm" in line_strip:
-            match = re.search(r'storage=["\']?([^"\'\s\]]+)', line_strip)
-            if match:
-                bgm_refs.append((match.group(1), i))
-
-        if "[playse" in line_strip:
-            match = re.search(r'storage=["\']?([^"\'\s\]]+)', line_strip)
-            if match:
-                se_refs.append((match.group(1), i))
-
-        if "[playvideo" in line_strip:
-            match = re.search(r'storage=["\']?([^"\'\s\]]+)', line_strip)
-            if match:
-                video_refs.append((match.group(1), i))
-
-        if "[call" in line_strip or "@call" in line_strip:
-            match = re.search(r'storage=["\']([^"\']+)["\']', line_strip)
-            if match:
-                storage_refs.append((match.group(1), i))
+        # ジャンプ先のチェック（storage指定があれば他ファイルのラベル）
+        if name in JUMP_TAGS and (tag.target or tag.attrs.get("storage")):
+            storage = tag.attrs.get("storage")
+            jump_targets.append((scenario_storage_name(storage) if storage else None, tag.target, i))
 
         # キャラクター定義と使用
-        if "[chara_new" in line_strip:
-            match = re.search(r'name=["\']([^"\']+)["\']', line_strip)
-            if match:
-                defined_charas.add(match.group(1))
-
-        if any(tag in line_strip for tag in ["[chara_show", "[chara_hide", "[chara_mod", "[chara_layer"]):
-            match = re.search(r'name=["\']([^"\']+)["\']', line_strip)
-            if match:
-                used_charas.add(match.group(1))
+        if name == "chara_new" and tag.attrs.get("name"):
+            defined_charas.add(tag.attrs["name"])
+        elif name in ("chara_show", "chara_hide", "chara_mod", "chara_layer") and tag.attrs.get("name"):
+            used_charas.add(tag.attrs["name"])
 
     # 未閉じタグのチェック
     for tag, line_num in tag_stack:
         errors.append(f"行 {line_num}: [{tag}]が閉じられていません")
 
-    # ラベル存在チェック
-    for target, line_num in jump_targets + call_targets + link_targets:
-        if target not in labels:
-            errors.append(f"行 {line_num}: ラベル '*{target}' が定義されていません")
-
-    # ストレージファイル存在チェック
-    for storage_file, line_num in storage_refs:
-        if not storage_file.endswith(".ks"):
-            storage_file += ".ks"
-        storage_path = project_path / "data" / "scenario" / storage_file
-        if not storage_path.exists():
-            warnings.append(f"行 {line_num}: シナリオファイル '{storage_file}' が見つかりません")
-
-    # リソースファイル存在チェック
-    for img_file, category, line_num in image_refs:
-        img_path = project_path / "data" / category / img_file
-        if not img_path.exists():
-            warnings.append(f"行 {line_num}: 画像ファイル '{img_file}' が {category}/ に見つかりません")
-
-    for bgm_file, line_num in bgm_refs:
-        bgm_path = project_path / "data" / "bgm" / bgm_file
-        if not bgm_path.exists():
-            warnings.append(f"行 {line_num}: BGMファイル '{bgm_file}' が見つかりません")
-
-    for se_file, line_num in se_refs:
-        se_path = project_path / "data" / "sound" / se_file
-        if not se_path.exists():
-            warnings.append(f"行 {line_num}: 効果音ファイル '{se_file}' が見つかりません")
+    # ラベル・ストレージファイル存在チェック
+    for storage_file, target, line_num in jump_targets:
+        if storage_file is None or storage_file == scenario_file:
+            if target and target not in labels:
+                errors.append(f"行 {line_num}: ラベル '*{target}' が定義されていません")
+            continue
 
-    for video_file, line_num in video_refs:
-        video_path = project_path / "data" / "video" / video_file
-        if not video_path.exists():
-            warnings.append(f"行 {line_num}: 動画ファイル '{video_file}' が見つかりません")
+        target_labels = ctx.labels_of(storage_file)
+        if target_labels is None:
+            warnings.append(f"行 {line_num}: シナリオファイル '{storage_file}' が見つかりません")
+        elif target and target not in target_labels:
+            errors.append(f"行 {line_num}: ラベル '*{target}' が '{storage_file}' に定義されていません")
+
+    # リソースファイル存在チェック（インデックス済みならその参照を使う）
+    refs = ctx.indexed_refs(scenario_file)
+    if refs is None:
+        refs = [(category, storage, tag.line, tag.name) for tag in ast.tags for category, storage in resource_refs(tag)]
+    resource_names = {"bgm": "BGMファイル", "sound": "効果音ファイル", "video": "動画ファイル"}
+    for category, res_file, line_num, _ in refs:
+        if ctx.resource_exists(category, res_file):
+            continue
+        if category in resource_names:
+            warnings.append(f"行 {line_num}: {resource_names[category]} '{res_file}' が見つかりません")
+        else:
+            warnings.append(f"行 {line_num}: 画像ファイル '{res_file}' が {category}/ に見つかりません")
 
-    # 未定義キャラクター使用チェック
+    # 未定義キャラクター使用チェック（他ファイルでの定義も有効）
     for chara in used_charas:
-        if chara not in defined_charas:
+        if chara not in defined_charas and chara not in ctx.characters:
             warnings.append(f"キャラクター '{chara}' が定義されていません（[chara_new]で定義してください）")
 
     # 統計情報
     info.append(f"ラベル数: {len(labels)}")
-    info.append(f"ジャンプ/リンク数: {len(jump_targets) + len(call_targets) + len(link_targets)}")
+    info.append(f"ジャンプ/リンク数: {len(jump_targets)}")
     info.append(f"定義済みキャラクター数: {len(defined_charas)}")
 
+    return errors, warnings, info
+
+
+@tool(
+    "validate_scenario",
+    "シナリオファイルの構文チェック（基本的なタグの検証）",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "scenario_file": {
+            "type": "string",
+            "description": "シナリオファイル名",
+        },
+    },
+    required=["project_name", "scenario_file"],
+)
+async def validate_scenario_handler(arguments: dict) -> list[types.TextContent]:
+    """シナリオファイルの高度な構文チェック"""
+    project_name = arguments["project_name"]
+    scenario_file = arguments["scenario_file"]
+
+    if not scenario_file.endswith(".ks"):
+        scenario_file += ".ks"
+
+    project_path = PROJECTS_DIR / project_name
+    scenario_path = project_path / "data" / "scenario" / scenario_file
+
+    if not scenario_path.exists():
+        return [types.TextContent(type="text", text=f"シナリオファイル '{scenario_file}' が見つかりません")]
+
+    ctx = await asyncio.to_thread(ValidationContext, project_path)
+    ast = await asyncio.to_thread(load_scenario, scenario_path)
+    errors, warnings, info = await asyncio.to_thread(check_scenario, ctx, scenario_file, ast)
+
     # 結果
     if not errors and not warnings:
         result = "✅ 構文エラーは見つかりませんでした\n\n"
@@ -1017,6 +4015,82 @@ async def validate_scenario_handler(arguments: dict) -> list[types.TextContent]:
     return [types.TextContent(type="text", text=result)]
 
 
+@tool(
+    "validate_project",
+    "プロジェクト内の全シナリオを検証（ファイルをまたぐラベル参照も解決）",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+    },
+    required=["project_name"],
+)
+async def validate_project_handler(arguments: dict) -> list[types.TextContent]:
+    """プロジェクト内の全シナリオを共有ラベル索引で検証"""
+    project_name = arguments["project_name"]
+    project_path = PROJECTS_DIR / project_name
+
+    if not project_path.exists():
+        return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' が見つかりません")]
+
+    ctx = await asyncio.to_thread(ValidationContext, project_path)
+    scenario_dir = project_path / "data" / "scenario"
+
+    lines = [f"🔍 プロジェクト全体の構文チェック: {project_name}", "=" * 60]
+    total_errors = 0
+    total_warnings = 0
+
+    scenario_files = sorted(ctx.labels)
+
+    def check_all():
+        results = []
+        for scenario_file in scenario_files:
+            scenario_path = scenario_dir / scenario_file
+            if scenario_path.is_file():
+                errors, warnings, _ = check_scenario(ctx, scenario_file, load_scenario(scenario_path))
+                results.append((scenario_file, errors, warnings))
+        return results
+
+    for scenario_file, errors, warnings in await asyncio.to_thread(check_all):
+        total_errors += len(errors)
+        total_warnings += len(warnings)
+        if not errors and not warnings:
+            continue
+
+        lines.append(f"\n【{scenario_file}】 エラー {len(errors)}件 / 警告 {len(warnings)}件")
+        lines.extend(f"  ❌ {e}" for e in errors)
+        lines.extend(f"  ⚠️  {w}" for w in warnings)
+
+    lines.append("\n【サマリー】")
+    lines.append(f"- 検証ファイル数: {len(scenario_files)}")
+    lines.append(f"- エラー: {total_errors}件")
+    lines.append(f"- 警告: {total_warnings}件")
+    if not total_errors and not total_warnings:
+        lines.append("\n✅ 構文エラーは見つかりませんでした")
+
+    return [types.TextContent(type="text", text="\n".join(lines))]
+
+
+@tool(
+    "generate_scenario_template",
+    "テンプレートからシナリオを生成",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "scenario_file": {
+            "type": "string",
+            "description": "生成するシナリオファイル名",
+        },
+        "template_type": {
+            "type": "string",
+            "description": "テンプレートタイプ",
+            "enum": ["basic_scene", "character_intro", "choice_branch", "dialogue", "title_screen"],
+        },
+        "params": {
+            "type": "object",
+            "description": "テンプレートパラメータ（JSON形式）",
+            "default": {},
+        },
+    },
+    required=["project_name", "scenario_file", "template_type"],
+)
 async def generate_scenario_template_handler(arguments: dict) -> list[types.TextContent]:
     """テンプレートからシナリオを生成"""
     project_name = arguments["project_name"]
@@ -1115,15 +4189,23 @@ async def generate_scenario_template_handler(arguments: dict) -> list[types.Text
     content = templates[template_type](params)
 
     # ファイルに書き込み
-    scenario_dir = PROJECTS_DIR / project_name / "data" / "scenario"
-    scenario_path = scenario_dir / scenario_file
+    scenario_path = PROJECTS_DIR / project_name / "data" / "scenario" / scenario_file
 
-    scenario_dir.mkdir(parents=True, exist_ok=True)
-    scenario_path.write_text(content, encoding="utf-8")
+    await asyncio.to_thread(write_text_file, scenario_path, content)
+    scenario_cache.invalidate(scenario_path)
+    line_index_cache.invalidate(scenario_path)
 
     return [types.TextContent(type="text", text=f"テンプレート '{template_type}' からシナリオ '{scenario_file}' を生成しました")]
 
 
+@tool(
+    "analyze_project",
+    "プロジェクト全体を分析（シナリオ統計、リソース使用状況等）",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+    },
+    required=["project_name"],
+)
 async def analyze_project_handler(arguments: dict) -> list[types.TextContent]:
     """プロジェクト全体を分析"""
     project_name = arguments["project_name"]
@@ -1132,13 +4214,9 @@ async def analyze_project_handler(arguments: dict) -> list[types.TextContent]:
     if not project_path.exists():
         return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' が見つかりません")]
 
-    import re
-
-    # シナリオファイルを収集
-    scenario_dir = project_path / "data" / "scenario"
-    scenario_files = []
-    if scenario_dir.exists():
-        scenario_files = [f.name for f in scenario_dir.iterdir() if f.suffix == ".ks"]
+    # シナリオファイルの要約をインデックスから取得
+    summaries = await scenario_summaries(project_path)
+    scenario_files = list(summaries)
 
     # リソースを収集
     resource_counts = {}
@@ -1152,12 +4230,8 @@ async def analyze_project_handler(arguments: dict) -> list[types.TextContent]:
     }
 
     for label, dir_name in resource_dirs.items():
-        res_dir = project_path / "data" / dir_name
-        if res_dir.exists():
-            files = [f for f in res_dir.iterdir() if f.is_file()]
-            resource_counts[label] = len(files)
-        else:
-            resource_counts[label] = 0
+        files = await asset_files(project_path, dir_name)
+        resource_counts[label] = len(files or {})
 
     # 全シナリオを解析
     total_lines = 0
@@ -1168,52 +4242,36 @@ async def analyze_project_handler(arguments: dict) -> list[types.TextContent]:
     all_characters = set()
     word_count = 0
 
-    for scenario_file in scenario_files:
-        scenario_path = scenario_dir / scenario_file
-        try:
-            content = scenario_path.read_text(encoding="utf-8")
-            lines = content.split("\n")
-            total_lines += len(lines)
-
-            for line in lines:
-                line_strip = line.strip()
-
-                # コメントをスキップ
-                if line_strip.startswith(";") or line_strip.startswith("//"):
-                    continue
-
-                # ラベル
-                if line_strip.startswith("*"):
-                    label_name = line_strip[1:].strip()
-                    if label_name:
-                        total_labels.add(label_name)
-
-                # ジャンプ/コール
-                if any(tag in line_strip for tag in ["[jump", "@jump", "[call", "@call"]):
-                    total_jumps += 1
-
-                # 選択肢
-                if "[glink" in line_strip or "[link" in line_strip:
-                    total_choices += 1
-
-                # キャラクター定義
-                if "[chara_new" in line_strip:
-                    match = re.search(r'name=["\']([^"\']+)["\']', line_strip)
-                    if match:
-                        all_characters.add(match.group(1))
-
-                # テキスト行（タグがない、またはテキストを含む行）
-                if line_strip and not line_strip.startswith("[") and not line_strip.startswith("*") and not line_strip.startswith(";"):
-                    total_text_lines += 1
-                    # 簡易的な文字数カウント（[p]などのタグを除く）
-                    text_only = re.sub(r'\[.*?\]', '', line_strip)
-                    word_count += len(text_only)
-
-        except Exception as e:
-            print(f"Error reading {scenario_file}: {e}")
-
-    # プレイ時間推定（平均読書速度: 600文字/分）
-    estimated_playtime = word_count / 600 if word_count > 0 else 0
+    for summary in summaries.values():
+        total_lines += summary["line_count"]
+        total_text_lines += summary["text_lines"]
+        word_count += summary["chars"]
+        total_labels.update(name for name, _ in summary["labels"])
+        all_characters.update(summary["characters"])
+
+        for tag_name, _, _, _ in summary["jumps"]:
+            # ジャンプ/コール
+            if tag_name in ("jump", "call"):
+                total_jumps += 1
+            # 選択肢
+            else:
+                total_choices += 1
+
+    # プレイ時間推定（全文と、first.ks からのエンディングごとのルート）
+    estimated_playtime = playtime_minutes(word_count)
+    graph = await project_graph(project_path, summaries)
+    start = graph.ids.get(("first.ks", ""))
+    endings = await asyncio.to_thread(count_routes, graph, start) if start is not None else []
+    endings.sort(key=lambda ending: graph.nodes[ending.nodes[0]])
+    route_lines = [
+        f"  - {graph.label_of(ending.nodes[0])}: 最短 {playtime_minutes(ending.shortest):.1f} 分"
+        f" / 平均 {playtime_minutes(ending.average):.1f} 分"
+        f" / 最長 {playtime_minutes(ending.longest):.1f} 分 ({ending.routes}ルート)"
+        for ending in endings[:20]
+    ]
+    if len(endings) > 20:
+        route_lines.append(f"  ...他{len(endings) - 20}件")
+    route_report = ("\n- エンディング別 (first.ks から):\n" + "\n".join(route_lines)) if route_lines else ""
 
     # レポート生成
     report = f"""📊 プロジェクト分析レポート: {project_name}
@@ -1230,8 +4288,8 @@ async def analyze_project_handler(arguments: dict) -> list[types.TextContent]:
 - 定義済みキャラクター数: {len(all_characters)}
 
 【推定プレイ時間】
-- 約 {estimated_playtime:.1f} 分 ({estimated_playtime/60:.1f} 時間)
-  ※ 平均読書速度600文字/分で計算
+- 全文を読む場合: 約 {estimated_playtime:.1f} 分 ({estimated_playtime/60:.1f} 時間){route_report}
+  ※ 平均読書速度{READING_CHARS_PER_MINUTE}文字/分で計算
 
 【リソース統計】
 """
@@ -1252,6 +4310,18 @@ async def analyze_project_handler(arguments: dict) -> list[types.TextContent]:
     return [types.TextContent(type="text", text=report)]
 
 
+@tool(
+    "analyze_scenario_flow",
+    "シナリオフローを解析（ラベル間の遷移を可視化）",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "scenario_file": {
+            "type": "string",
+            "description": "シナリオファイル名",
+        },
+    },
+    required=["project_name", "scenario_file"],
+)
 async def analyze_scenario_flow_handler(arguments: dict) -> list[types.TextContent]:
     """シナリオフローを解析"""
     project_name = arguments["project_name"]
@@ -1265,108 +4335,318 @@ async def analyze_scenario_flow_handler(arguments: dict) -> list[types.TextConte
     if not scenario_path.exists():
         return [types.TextContent(type="text", text=f"シナリオファイル '{scenario_file}' が見つかりません")]
 
-    content = scenario_path.read_text(encoding="utf-8")
-    lines = content.split("\n")
-
-    import re
+    ast = await asyncio.to_thread(load_scenario, scenario_path)
 
     # ラベルとその遷移を解析
     labels = {}  # {label_name: {"line": line_num, "jumps_to": [], "choices": []}}
     current_label = None
 
-    for i, line in enumerate(lines, 1):
-        line_strip = line.strip()
+    for node in ast.nodes:
+        # ラベル定義
+        if isinstance(node, ScenarioLabel):
+            current_label = node.name
+            labels[node.name] = {
+                "line": node.line,
+                "jumps_to": [],
+                "choices": [],
+                "calls": []
+            }
+            continue
 
-        # コメントをスキップ
-        if line_strip.startswith(";") or line_strip.startswith("//"):
+        if not current_label or not isinstance(node, ScenarioTag) or not node.target:
             continue
 
-        # ラベル定義
-        if line_strip.startswith("*"):
-            label_name = line_strip[1:].strip()
-            if label_name:
-                current_label = label_name
-                labels[label_name] = {
-                    "line": i,
-                    "jumps_to": [],
-                    "choices": [],
-                    "calls": []
-                }
-
-        if current_label:
-            # ジャンプ
-            if "[jump" in line_strip or "@jump" in line_strip:
-                match = re.search(r'target=["\']?\*?([^"\'\s\]]+)', line_strip)
-                if match:
-                    target = match.group(1)
-                    labels[current_label]["jumps_to"].append(target)
-
-            # コール
-            if "[call" in line_strip or "@call" in line_strip:
-                match = re.search(r'target=["\']?\*?([^"\'\s\]]+)', line_strip)
-                if match:
-                    target = match.group(1)
-                    labels[current_label]["calls"].append(target)
+        # ジャンプ
+        if node.name == "jump":
+            labels[current_label]["jumps_to"].append(node.target)
 
-            # 選択肢
-            if "[link" in line_strip or "[glink" in line_strip:
-                match = re.search(r'target=["\']?\*?([^"\'\s\]]+)', line_strip)
-                if match:
-                    target = match.group(1)
-                    text_match = re.search(r'text=["\']([^"\']+)["\']', line_strip)
-                    choice_text = text_match.group(1) if text_match else target
-                    labels[current_label]["choices"].append({
-                        "text": choice_text,
-                        "target": target
-                    })
+        # コール
+        elif node.name == "call":
+            labels[current_label]["calls"].append(node.target)
 
-    # フロー図生成
-    report = f"""🔀 シナリオフロー解析: {scenario_file}
-{'=' * 60}
+        # 選択肢
+        elif node.name in ("link", "glink"):
+            labels[current_label]["choices"].append({
+                "text": node.attrs.get("text", node.target),
+                "target": node.target
+            })
 
-【ラベル一覧】 ({len(labels)}個)
-"""
+    # フロー図生成
+    lines = [
+        f"🔀 シナリオフロー解析: {scenario_file}",
+        "=" * 60,
+        "",
+        f"【ラベル一覧】 ({len(labels)}個)",
+    ]
 
     for label_name, info in sorted(labels.items(), key=lambda x: x[1]["line"]):
-        report += f"\n*{label_name} (行 {info['line']})\n"
+        lines.append(f"\n*{label_name} (行 {info['line']})")
 
         if info["jumps_to"]:
-            report += f"  → ジャンプ: " + ", ".join(f"*{t}" for t in info["jumps_to"]) + "\n"
+            lines.append("  → ジャンプ: " + ", ".join(f"*{t}" for t in info["jumps_to"]))
 
         if info["calls"]:
-            report += f"  ⇒ コール: " + ", ".join(f"*{t}" for t in info["calls"]) + "\n"
+            lines.append("  ⇒ コール: " + ", ".join(f"*{t}" for t in info["calls"]))
 
         if info["choices"]:
-            report += f"  ◇ 選択肢:\n"
-            for choice in info["choices"]:
-                report += f"    - [{choice['text']}] → *{choice['target']}\n"
+            lines.append("  ◇ 選択肢:")
+            lines.extend(f"    - [{choice['text']}] → *{choice['target']}" for choice in info["choices"])
+
+    # Mermaid形式のフローチャート（このファイルのラベルと、その遷移先）
+    graph = await project_graph(PROJECTS_DIR / project_name)
+    selected = set(graph.file_nodes.get(scenario_file, ()))
+    selected.update(target for node in list(selected) for target in graph.successors(node))
+    export = export_graph(graph, selected, collapse=False)
+    lines.append("\n【Mermaidフローチャート】\n```mermaid")
+    lines.extend(iter_mermaid(graph, export))
+    lines.append("```")
+
+    return [types.TextContent(type="text", text="\n".join(lines))]
+
+
+@tool(
+    "export_flow_graph",
+    "プロジェクト全体のフローグラフを Mermaid / Graphviz DOT / JSON で書き出し（ファイルごとにまとめ、一本道を縮約し、ノード数を制限）",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "format": {
+            "type": "string",
+            "enum": list(EXPORT_FORMATS),
+            "description": "出力形式（デフォルト: mermaid）",
+            "default": "mermaid",
+        },
+        "entry": {
+            "type": "string",
+            "description": "指定するとこのシナリオから到達できる部分だけを書き出す",
+        },
+        "scenario_file": {
+            "type": "string",
+            "description": "指定するとこのシナリオのラベルと、その遷移先だけを書き出す",
+        },
+        "collapse": {
+            "type": "boolean",
+            "description": "分岐も合流もない一本道を1ノードにまとめる（デフォルト: true）",
+            "default": True,
+        },
+        "max_nodes": {
+            "type": "integer",
+            "description": f"書き出すノード数の上限（デフォルト: {DEFAULT_NODE_BUDGET}）",
+            "default": DEFAULT_NODE_BUDGET,
+        },
+    },
+    required=["project_name"],
+)
+async def export_flow_graph_handler(arguments: dict) -> list[types.TextContent]:
+    """フローグラフを書き出し"""
+    project_name = arguments["project_name"]
+    fmt = arguments.get("format") or "mermaid"
+    collapse = arguments.get("collapse", True)
+    budget = max(1, int(arguments.get("max_nodes", DEFAULT_NODE_BUDGET)))
+    project_path = PROJECTS_DIR / project_name
 
-    # Mermaid形式のフローチャート
-    report += f"\n【Mermaidフローチャート】\n```mermaid\ngraph TD\n"
+    if not project_path.exists():
+        return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' が見つかりません")]
 
-    for label_name, info in labels.items():
-        safe_label = label_name.replace("-", "_").replace(" ", "_")
+    if fmt not in EXPORT_FORMATS:
+        return [types.TextContent(type="text", text=f"不明な形式です: {fmt}（{', '.join(EXPORT_FORMATS)}）")]
+
+    graph = await project_graph(project_path)
+    selected = None
+    start = None
+    if arguments.get("entry"):
+        entry = scenario_storage_name(arguments["entry"])
+        start = graph.ids.get((entry, ""))
+        if start is None:
+            return [types.TextContent(type="text", text=f"シナリオファイル '{entry}' が見つかりません")]
+        reachable = await asyncio.to_thread(reachable_nodes, graph, start)
+        selected = {node for node in range(graph.node_count) if reachable[node]}
+    if arguments.get("scenario_file"):
+        scenario_file = scenario_storage_name(arguments["scenario_file"])
+        if scenario_file not in graph.file_nodes:
+            return [types.TextContent(type="text", text=f"シナリオファイル '{scenario_file}' が見つかりません")]
+        in_file = set(graph.file_nodes[scenario_file])
+        in_file.update(target for node in list(in_file) for target in graph.successors(node))
+        selected = in_file if selected is None else selected & in_file
+
+    def render() -> tuple[ExportGraph, str]:
+        export = export_graph(graph, selected, start, collapse, budget)
+        return export, render_graph(graph, export, fmt)
+
+    export, text = await asyncio.to_thread(render)
+    summary = f"📤 フローグラフ ({fmt}): {len(export.chains)}ノード / {len(export.edges)}辺"
+    if export.omitted:
+        summary += f"（上限のため {export.omitted}ノードを省略）"
+    return [types.TextContent(type="text", text=summary), types.TextContent(type="text", text=text)]
+
+
+@tool(
+    "analyze_reachability",
+    "プロジェクト全体の制御フローを解析（到達不能なラベル・行き止まり・抜け出せないループ・解決できない遷移先）",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "entry": {
+            "type": "string",
+            "description": "開始シナリオ（デフォルト: first.ks）",
+            "default": "first.ks",
+        },
+        "limit": {
+            "type": "integer",
+            "description": "各項目の最大表示件数（デフォルト: 50）",
+            "default": 50,
+        },
+    },
+    required=["project_name"],
+)
+async def analyze_reachability_handler(arguments: dict) -> list[types.TextContent]:
+    """プロジェクト全体の到達可能性を解析"""
+    project_name = arguments["project_name"]
+    entry = scenario_storage_name(arguments.get("entry") or "first.ks")
+    limit = max(1, int(arguments.get("limit", 50)))
+    project_path = PROJECTS_DIR / project_name
 
-        for target in info["jumps_to"]:
-            safe_target = target.replace("-", "_").replace(" ", "_")
-            report += f"  {safe_label}[{label_name}] --> {safe_target}[{target}]\n"
+    if not project_path.exists():
+        return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' が見つかりません")]
 
-        for choice in info["choices"]:
-            safe_target = choice["target"].replace("-", "_").replace(" ", "_")
-            report += f"  {safe_label}[{label_name}] -->|{choice['text']}| {safe_target}[{choice['target']}]\n"
+    graph = await project_graph(project_path)
+    start = graph.ids.get((entry, ""))
+    if start is None:
+        return [types.TextContent(type="text", text=f"シナリオファイル '{entry}' が見つかりません")]
+
+    def analyze():
+        reachable = reachable_nodes(graph, start)
+        component, count = graph.components()
+        cycles = closed_cycles(graph, component, count, reachable)
+
+        unreachable: dict[str, list[str]] = {}
+        for node, (file, label) in enumerate(graph.nodes):
+            if label and not reachable[node]:
+                unreachable.setdefault(file, []).append(label)
+        dead_ends = [
+            node for node in range(graph.node_count)
+            if reachable[node] and not graph.successors(node) and graph.stops.get(node) != "return"
+        ]
+        return reachable, count, cycles, unreachable, dead_ends
+
+    reachable, count, cycles, unreachable, dead_ends = await asyncio.to_thread(analyze)
+
+    lines = [
+        f"🧭 到達可能性解析: {project_name} (開始: {entry})",
+        "=" * 60,
+        f"- ノード: {graph.node_count} / 辺: {graph.edge_count} / 強連結成分: {count}",
+        f"- 到達可能: {sum(reachable)}ノード",
+    ]
 
-        for target in info["calls"]:
-            safe_target = target.replace("-", "_").replace(" ", "_")
-            report += f"  {safe_label}[{label_name}] -.->|call| {safe_target}[{target}]\n"
+    def append_limited(items: list[str]):
+        lines.extend(items[:limit])
+        if len(items) > limit:
+            lines.append(f"  ...他{len(items) - limit}件")
+
+    total_unreachable = sum(len(labels) for labels in unreachable.values())
+    lines.append(f"\n【到達できないラベル】{total_unreachable}件")
+    append_limited([
+        f"- {file}: " + ", ".join(f"*{label}" for label in labels)
+        for file, labels in sorted(unreachable.items())
+    ])
+
+    lines.append(f"\n【行き止まり】{len(dead_ends)}件")
+    append_limited([
+        f"- {graph.label_of(node)} → "
+        + ("[s] で停止（選択肢なし）" if graph.stops.get(node) == "s" else "ファイル末尾に到達")
+        for node in dead_ends
+    ])
+
+    lines.append(f"\n【抜け出せないループ】{len(cycles)}件")
+    append_limited([
+        "- " + " → ".join(graph.label_of(node) for node in sorted(nodes, key=lambda n: graph.nodes[n]))
+        for nodes in cycles
+    ])
+
+    lines.append(f"\n【解決できない遷移】{len(graph.unresolved)}件")
+    append_limited([
+        f"- {file}:{line} [{tag}] storage={storage or '(同じファイル)'} target={'*' + target if target else '(先頭)'}"
+        for file, line, tag, storage, target in graph.unresolved
+    ])
+
+    if not (total_unreachable or dead_ends or cycles or graph.unresolved):
+        lines.append("\n✅ 問題は見つかりませんでした")
+
+    return [types.TextContent(type="text", text="\n".join(lines))]
+
+
+@tool(
+    "analyze_routes",
+    "開始シナリオから各エンディングまでのルート数と、最短・最長ルートの文字数を集計",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "entry": {
+            "type": "string",
+            "description": "開始シナリオ（デフォルト: first.ks）",
+            "default": "first.ks",
+        },
+        "label": {
+            "type": "string",
+            "description": "開始ラベル（省略時はファイル先頭）",
+        },
+        "limit": {
+            "type": "integer",
+            "description": "表示するエンディングの最大数（デフォルト: 50）",
+            "default": 50,
+        },
+    },
+    required=["project_name"],
+)
+async def analyze_routes_handler(arguments: dict) -> list[types.TextContent]:
+    """エンディングごとのルート数を集計"""
+    project_name = arguments["project_name"]
+    entry = scenario_storage_name(arguments.get("entry") or "first.ks")
+    label = (arguments.get("label") or "").lstrip("*")
+    limit = max(1, int(arguments.get("limit", 50)))
+    project_path = PROJECTS_DIR / project_name
+
+    if not project_path.exists():
+        return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' が見つかりません")]
 
-    report += "```\n"
+    graph = await project_graph(project_path)
+    if (entry, "") not in graph.ids:
+        return [types.TextContent(type="text", text=f"シナリオファイル '{entry}' が見つかりません")]
+    start = graph.ids.get((entry, label))
+    if start is None:
+        return [types.TextContent(type="text", text=f"ラベル '*{label}' が {entry} に見つかりません")]
+
+    endings = await asyncio.to_thread(count_routes, graph, start)
+    endings.sort(key=lambda ending: (-ending.routes, graph.nodes[ending.nodes[0]]))
+
+    lines = [
+        f"🗺️ ルート解析: {project_name} (開始: {graph.label_of(start)})",
+        "=" * 60,
+        f"- エンディング: {len(endings)}個",
+        f"- 総ルート数: {sum(ending.routes for ending in endings)}",
+        "",
+    ]
+    for ending in endings[:limit]:
+        name = " / ".join(graph.label_of(node) for node in ending.nodes[:3])
+        if len(ending.nodes) > 1:
+            name = f"ループ: {name}" + (" ..." if len(ending.nodes) > 3 else "")
+        lines.append(
+            f"- {name}: {ending.routes}通り / 最短 {ending.shortest}字 / 最長 {ending.longest}字"
+            f" / 平均 {ending.average:.0f}字"
+        )
+    if len(endings) > limit:
+        lines.append(f"  ...他{len(endings) - limit}件")
 
-    return [types.TextContent(type="text", text=report)]
+    return [types.TextContent(type="text", text="\n".join(lines))]
 
 
+@tool(
+    "git_init",
+    "プロジェクトにGitリポジトリを初期化",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+    },
+    required=["project_name"],
+)
 async def git_init_handler(arguments: dict) -> list[types.TextContent]:
     """Gitリポジトリを初期化"""
-    import subprocess
     project_name = arguments["project_name"]
     project_path = PROJECTS_DIR / project_name
 
@@ -1379,7 +4659,7 @@ async def git_init_handler(arguments: dict) -> list[types.TextContent]:
 
     try:
         # git init
-        subprocess.run(["git", "init"], cwd=project_path, check=True, capture_output=True)
+        (await run_command(["git", "init"], project_path)).check_returncode()
 
         # .gitignore作成
         gitignore_content = """# TyranoScript Project
@@ -1388,17 +4668,29 @@ Thumbs.db
 *.log
 *.tmp
 node_modules/
+.tyrano_mcp/
 """
-        (project_path / ".gitignore").write_text(gitignore_content, encoding="utf-8")
+        await asyncio.to_thread(write_text_file, project_path / ".gitignore", gitignore_content)
 
         return [types.TextContent(type="text", text=f"✅ Gitリポジトリを初期化しました\n.gitignoreも作成しました")]
     except Exception as e:
         return [types.TextContent(type="text", text=f"エラー: {str(e)}")]
 
 
+@tool(
+    "git_commit",
+    "プロジェクトの変更をコミット",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "message": {
+            "type": "string",
+            "description": "コミットメッセージ",
+        },
+    },
+    required=["project_name", "message"],
+)
 async def git_commit_handler(arguments: dict) -> list[types.TextContent]:
     """変更をコミット"""
-    import subprocess
     project_name = arguments["project_name"]
     message = arguments["message"]
     project_path = PROJECTS_DIR / project_name
@@ -1412,15 +4704,10 @@ async def git_commit_handler(arguments: dict) -> list[types.TextContent]:
 
     try:
         # git add .
-        subprocess.run(["git", "add", "."], cwd=project_path, check=True, capture_output=True)
+        (await run_command(["git", "add", "."], project_path)).check_returncode()
 
         # git commit
-        result = subprocess.run(
-            ["git", "commit", "-m", message],
-            cwd=project_path,
-            capture_output=True,
-            text=True
-        )
+        result = await run_command(["git", "commit", "-m", message], project_path)
 
         if result.returncode == 0:
             return [types.TextContent(type="text", text=f"✅ コミットしました\n\n{result.stdout}")]
@@ -1430,9 +4717,16 @@ async def git_commit_handler(arguments: dict) -> list[types.TextContent]:
         return [types.TextContent(type="text", text=f"エラー: {str(e)}")]
 
 
+@tool(
+    "git_status",
+    "Gitリポジトリの状態を確認",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+    },
+    required=["project_name"],
+)
 async def git_status_handler(arguments: dict) -> list[types.TextContent]:
     """Git状態を確認"""
-    import subprocess
     project_name = arguments["project_name"]
     project_path = PROJECTS_DIR / project_name
 
@@ -1444,21 +4738,28 @@ async def git_status_handler(arguments: dict) -> list[types.TextContent]:
         return [types.TextContent(type="text", text=f"Gitリポジトリが初期化されていません")]
 
     try:
-        result = subprocess.run(
-            ["git", "status"],
-            cwd=project_path,
-            capture_output=True,
-            text=True,
-            check=True
-        )
+        result = await run_command(["git", "status"], project_path)
+        result.check_returncode()
         return [types.TextContent(type="text", text=f"📋 Git Status:\n\n{result.stdout}")]
     except Exception as e:
         return [types.TextContent(type="text", text=f"エラー: {str(e)}")]
 
 
+@tool(
+    "git_log",
+    "コミット履歴を表示",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "limit": {
+            "type": "number",
+            "description": "表示件数",
+            "default": 10,
+        },
+    },
+    required=["project_name"],
+)
 async def git_log_handler(arguments: dict) -> list[types.TextContent]:
     """コミット履歴を表示"""
-    import subprocess
     project_name = arguments["project_name"]
     limit = arguments.get("limit", 10)
     project_path = PROJECTS_DIR / project_name
@@ -1471,12 +4772,7 @@ async def git_log_handler(arguments: dict) -> list[types.TextContent]:
         return [types.TextContent(type="text", text=f"Gitリポジトリが初期化されていません")]
 
     try:
-        result = subprocess.run(
-            ["git", "log", f"-{limit}", "--oneline", "--decorate"],
-            cwd=project_path,
-            capture_output=True,
-            text=True
-        )
+        result = await run_command(["git", "log", f"-{limit}", "--oneline", "--decorate"], project_path)
 
         if result.returncode == 0 and result.stdout.strip():
             return [types.TextContent(type="text", text=f"📜 コミット履歴 (最新{limit}件):\n\n{result.stdout}")]
@@ -1486,6 +4782,14 @@ async def git_log_handler(arguments: dict) -> list[types.TextContent]:
         return [types.TextContent(type="text", text=f"エラー: {str(e)}")]
 
 
+@tool(
+    "optimize_resources",
+    "プロジェクトのリソース使用状況を分析し、最適化提案を行う",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+    },
+    required=["project_name"],
+)
 async def optimize_resources_handler(arguments: dict) -> list[types.TextContent]:
     """リソース最適化提案"""
     project_name = arguments["project_name"]
@@ -1494,63 +4798,13 @@ async def optimize_resources_handler(arguments: dict) -> list[types.TextContent]
     if not project_path.exists():
         return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' が見つかりません")]
 
-    import re
-
-    # 使用されているリソースを収集
-    scenario_dir = project_path / "data" / "scenario"
-    used_resources = {
-        "bgimage": set(),
-        "fgimage": set(),
-        "image": set(),
-        "bgm": set(),
-        "sound": set(),
-        "video": set()
-    }
-
-    if scenario_dir.exists():
-        for scenario_file in scenario_dir.glob("*.ks"):
-            try:
-                content = scenario_file.read_text(encoding="utf-8")
-                lines = content.split("\n")
-
-                for line in lines:
-                    # 背景画像
-                    if "[bg" in line:
-                        match = re.search(r'storage=["\']([^"\']+)["\']', line)
-                        if match:
-                            used_resources["bgimage"].add(match.group(1))
-
-                    # キャラクター画像
-                    if any(tag in line for tag in ["[chara_new", "[chara_show", "[chara_mod"]):
-                        match = re.search(r'storage=["\']([^"\']+)["\']', line)
-                        if match:
-                            used_resources["fgimage"].add(match.group(1))
-
-                    # その他画像
-                    if "[image" in line:
-                        match = re.search(r'storage=["\']([^"\']+)["\']', line)
-                        if match:
-                            used_resources["image"].add(match.group(1))
-
-                    # BGM
-                    if "[playbgm" in line:
-                        match = re.search(r'storage=["\']?([^"\'\s\]]+)', line)
-                        if match:
-                            used_resources["bgm"].add(match.group(1))
-
-                    # 効果音
-                    if "[playse" in line:
-                        match = re.search(r'storage=["\']?([^"\'\s\]]+)', line)
-                        if match:
-                            used_resources["sound"].add(match.group(1))
-
-                    # 動画
-                    if "[playvideo" in line:
-                        match = re.search(r'storage=["\']?([^"\'\s\]]+)', line)
-                        if match:
-                            used_resources["video"].add(match.group(1))
-            except:
-                pass
+    # 使用されているリソースを収集（素材参照インデックスから）
+    # 監視中ならインデックスはウォッチャーが最新に保っている
+    await scenario_summaries(project_path)
+    used = await asyncio.to_thread(get_project_index(project_path).query_resources, ResourceIndex.used, False)
+    used_resources = {category: used.get(category, set()) for category in ASSET_CATEGORIES}
+    for category, storages in used.items():
+        used_resources.setdefault(category, storages)
 
     # 実際に存在するリソースを確認
     report = f"""🔧 リソース最適化分析: {project_name}
@@ -1564,18 +4818,16 @@ async def optimize_resources_handler(arguments: dict) -> list[types.TextContent]
     total_size = 0
 
     for category, used_files in used_resources.items():
-        resource_dir = project_path / "data" / category
-        if not resource_dir.exists():
+        existing_files = await asset_files(project_path, category)
+        if existing_files is None:
             continue
 
-        existing_files = {f.name: f for f in resource_dir.iterdir() if f.is_file()}
-
         # 未使用ファイル
         unused = set(existing_files.keys()) - used_files
         # 存在しないファイル
         missing = used_files - set(existing_files.keys())
 
-        category_size = sum(f.stat().st_size for f in existing_files.values())
+        category_size = sum(existing_files.values())
         total_size += category_size
 
         report += f"\n【{category}】\n"
@@ -1585,7 +4837,7 @@ async def optimize_resources_handler(arguments: dict) -> list[types.TextContent]
 
         if unused:
             total_unused += len(unused)
-            unused_size = sum(existing_files[f].stat().st_size for f in unused)
+            unused_size = sum(existing_files[f] for f in unused)
             report += f"  削除候補: {', '.join(list(unused)[:5])}"
             if len(unused) > 5:
                 report += f" ...他{len(unused)-5}件"
@@ -1614,6 +4866,143 @@ async def optimize_resources_handler(arguments: dict) -> list[types.TextContent]
     return [types.TextContent(type="text", text=report)]
 
 
+@tool(
+    "find_asset_usages",
+    "素材ファイルがどのシナリオのどの行で使われているかを検索（ファイル指定時はそのシナリオが使う素材一覧）",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "asset": {
+            "type": "string",
+            "description": "素材ファイル名またはglobパターン (例: bg03.jpg, chara/akane/*.png)",
+        },
+        "category": {
+            "type": "string",
+            "description": "カテゴリで絞り込む (bgimage, fgimage, image, bgm, sound, video など)",
+        },
+        "scenario_file": {
+            "type": "string",
+            "description": "指定するとこのシナリオが参照する素材を一覧する",
+        },
+    },
+    required=["project_name"],
+)
+async def find_asset_usages_handler(arguments: dict) -> list[types.TextContent]:
+    """素材の参照箇所を検索"""
+    project_name = arguments["project_name"]
+    asset = arguments.get("asset")
+    category = arguments.get("category")
+    scenario_file = arguments.get("scenario_file")
+    project_path = PROJECTS_DIR / project_name
+
+    if not project_path.exists():
+        return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' が見つかりません")]
+
+    if not asset and not scenario_file:
+        return [types.TextContent(type="text", text="asset または scenario_file を指定してください")]
+
+    await scenario_summaries(project_path)
+    project_index = get_project_index(project_path)
+
+    if scenario_file:
+        scenario_file = scenario_storage_name(scenario_file)
+        refs = await asyncio.to_thread(
+            project_index.query_resources,
+            lambda index: index.refs_in(scenario_file) if scenario_file in index.by_file else None,
+            False,
+        )
+        if refs is None:
+            return [types.TextContent(type="text", text=f"シナリオファイル '{scenario_file}' が見つかりません")]
+        refs = [ref for ref in refs if not category or ref[0] == category]
+        lines = [f"🔎 {scenario_file} が参照する素材 ({len(refs)}箇所)"]
+        lines.extend(f"- 行 {line}: [{tag}] {ref_category}/{storage}" for ref_category, storage, line, tag in refs)
+        return [types.TextContent(type="text", text="\n".join(lines))]
+
+    matches = await asyncio.to_thread(project_index.query_resources, lambda index: index.find(asset, category), False)
+    if not matches:
+        return [types.TextContent(type="text", text=f"'{asset}' を参照しているシナリオはありません")]
+
+    lines = [f"🔎 '{asset}' の使用箇所"]
+    for (ref_category, storage), refs in sorted(matches.items()):
+        lines.append(f"\n【{ref_category}/{storage}】{len(refs)}箇所")
+        lines.extend(f"- {file}:{line} [{tag}]" for file, line, tag in sorted(refs))
+
+    return [types.TextContent(type="text", text="\n".join(lines))]
+
+
+@tool(
+    "find_variable_usages",
+    "ゲーム変数（f. / sf. / tf.）の読み書きを検索（指定した変数の代入箇所・参照箇所、書かれずに読まれる変数、読まれない変数）",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "variable": {
+            "type": "string",
+            "description": "変数名 (例: f.love。接頭辞を省くと f. とみなす)",
+        },
+        "query": {
+            "type": "string",
+            "enum": ["summary", "unwritten", "unread"],
+            "description": "variable 省略時の一覧: summary（デフォルト）/ unwritten（書かれずに読まれる）/ unread（読まれない）",
+            "default": "summary",
+        },
+    },
+    required=["project_name"],
+)
+async def find_variable_usages_handler(arguments: dict) -> list[types.TextContent]:
+    """変数の読み書きを検索"""
+    project_name = arguments["project_name"]
+    variable = arguments.get("variable")
+    query = arguments.get("query") or "summary"
+    project_path = PROJECTS_DIR / project_name
+
+    if not project_path.exists():
+        return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' が見つかりません")]
+
+    await scenario_summaries(project_path)
+    project_index = get_project_index(project_path)
+
+    if variable:
+        if not variable.startswith(("f.", "sf.", "tf.")):
+            variable = f"f.{variable}"
+        writes, reads = await asyncio.to_thread(project_index.query_variables, lambda index: index.usages(variable), False)
+        if not writes and not reads:
+            return [types.TextContent(type="text", text=f"変数 '{variable}' はどのシナリオでも使われていません")]
+        lines = [f"🔎 変数 {variable}", f"\n【代入】{len(writes)}箇所"]
+        lines.extend(f"- {file}:{line} [{tag}]" for file, line, tag in writes)
+        lines.append(f"\n【参照】{len(reads)}箇所")
+        lines.extend(f"- {file}:{line} [{tag}]" for file, line, tag in reads)
+        return [types.TextContent(type="text", text="\n".join(lines))]
+
+    count, unwritten, unread = await asyncio.to_thread(project_index.query_variables, VariableIndex.report, False)
+    lines = [f"📋 変数の使用状況: {project_name} ({count}個)"]
+    if query in ("summary", "unwritten"):
+        lines.append(f"\n【代入されずに参照される変数】{len(unwritten)}個")
+        lines.extend(f"- {name} (初出: {file}:{line} [{tag}])" for name, (file, line, tag) in unwritten)
+    if query in ("summary", "unread"):
+        lines.append(f"\n【代入されるが参照されない変数】{len(unread)}個")
+        lines.extend(f"- {name} (初出: {file}:{line} [{tag}])" for name, (file, line, tag) in unread)
+    return [types.TextContent(type="text", text="\n".join(lines))]
+
+
+@tool(
+    "batch_rename",
+    "複数ファイルを一括リネーム",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "pattern": {
+            "type": "string",
+            "description": "検索パターン（正規表現）",
+        },
+        "replacement": {
+            "type": "string",
+            "description": "置換文字列",
+        },
+        "target_dir": {
+            "type": "string",
+            "description": "対象ディレクトリ（data/配下の相対パス）",
+        },
+    },
+    required=["project_name", "pattern", "replacement", "target_dir"],
+)
 async def batch_rename_handler(arguments: dict) -> list[types.TextContent]:
     """一括リネーム"""
     project_name = arguments["project_name"]
@@ -1631,28 +5020,42 @@ async def batch_rename_handler(arguments: dict) -> list[types.TextContent]:
     if not target_path.exists():
         return [types.TextContent(type="text", text=f"ディレクトリ '{target_dir}' が見つかりません")]
 
-    import re
+    try:
+        name_pattern = re.compile(pattern)
+    except re.error as e:
+        return [types.TextContent(type="text", text=f"正規表現が不正です: {e}")]
 
     renamed = []
     errors = []
 
-    for file in target_path.iterdir():
-        if not file.is_file():
-            continue
+    def rename_all():
+        for file in target_path.iterdir():
+            if not file.is_file():
+                continue
 
-        new_name = re.sub(pattern, replacement, file.name)
+            new_name = name_pattern.sub(replacement, file.name)
 
-        if new_name != file.name:
-            new_path = target_path / new_name
+            if new_name != file.name:
+                new_path = target_path / new_name
 
-            if new_path.exists():
-                errors.append(f"❌ {file.name} → {new_name} (既に存在)")
-            else:
-                try:
-                    file.rename(new_path)
-                    renamed.append(f"✅ {file.name} → {new_name}")
-                except Exception as e:
-                    errors.append(f"❌ {file.name}: {str(e)}")
+                if new_path.exists():
+                    errors.append(f"❌ {file.name} → {new_name} (既に存在)")
+                else:
+                    try:
+                        file.rename(new_path)
+                        sync_directory(target_path)
+                        renamed.append(f"✅ {file.name} → {new_name}")
+                    except Exception as e:
+                        errors.append(f"❌ {file.name}: {str(e)}")
+
+    def rename_in_batch():
+        # ディレクトリのfsyncは最後に1回だけ行う
+        with write_batch():
+            rename_all()
+
+    await asyncio.to_thread(rename_in_batch)
+    if renamed:
+        notify_changed(target_path)
 
     result = f"📝 一括リネーム結果:\n\n"
 
@@ -1670,8 +5073,162 @@ async def batch_rename_handler(arguments: dict) -> list[types.TextContent]:
     return [types.TextContent(type="text", text=result)]
 
 
+@tool(
+    "watch_project",
+    "プロジェクトの監視を開始・停止し、解析結果をメモリ上で最新に保つ",
+    properties={
+        "project_name": PROJECT_NAME_PROPERTY,
+        "action": {
+            "type": "string",
+            "description": "操作 (start, stop, status)",
+            "enum": ["start", "stop", "status"],
+            "default": "start",
+        },
+        "interval": {
+            "type": "number",
+            "description": "ポーリング間隔（秒）",
+            "default": WATCH_INTERVAL,
+        },
+    },
+    required=["project_name"],
+)
+async def watch_project_handler(arguments: dict) -> list[types.TextContent]:
+    """プロジェクトの監視を管理"""
+    project_name = arguments["project_name"]
+    action = arguments.get("action", "start")
+    project_path = PROJECTS_DIR / project_name
+
+    if not project_path.exists():
+        return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' が見つかりません")]
+
+    watcher = project_watchers.get(project_path)
+
+    if action == "stop":
+        if watcher is None:
+            return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' は監視されていません")]
+        watcher.stop()
+        del project_watchers[project_path]
+        return [types.TextContent(type="text", text=f"👁️ プロジェクト '{project_name}' の監視を停止しました")]
+
+    if action == "status":
+        if watcher is None:
+            return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' は監視されていません")]
+        asset_count = sum(len(files) for files in watcher.assets.values())
+        last_poll = time.strftime("%H:%M:%S", time.localtime(watcher.last_poll)) if watcher.last_poll else "-"
+        lines = [
+            f"👁️ 監視状態: {project_name}",
+            f"- ポーリング間隔: {watcher.interval}秒",
+            f"- ポーリング回数: {watcher.polls}",
+            f"- 最終ポーリング: {last_poll}",
+            f"- シナリオ: {len(watcher.summaries)}件",
+            f"- リソース: {asset_count}件",
+        ]
+        return [types.TextContent(type="text", text="\n".join(lines))]
+
+    interval = float(arguments.get("interval", WATCH_INTERVAL))
+    if interval <= 0:
+        return [types.TextContent(type="text", text="interval は正の数で指定してください")]
+
+    if watcher is not None:
+        watcher.interval = interval
+        return [types.TextContent(type="text", text=f"プロジェクト '{project_name}' は既に監視中です（間隔 {interval}秒）")]
+
+    watcher = ProjectWatcher(project_path, interval)
+    await watcher.start()
+    project_watchers[project_path] = watcher
+
+    return [types.TextContent(
+        type="text",
+        text=f"👁️ プロジェクト '{project_name}' の監視を開始しました（間隔 {interval}秒、シナリオ {len(watcher.summaries)}件）"
+    )]
+
+
+@tool(
+    "server_stats",
+    "ツールごとの実行時間・I/O量・キャッシュヒット率などの統計を取得",
+    properties={
+        "format": {
+            "type": "string",
+            "description": "出力形式 (text, json)",
+            "enum": ["text", "json"],
+            "default": "text",
+        },
+        "reset": {
+            "type": "boolean",
+            "description": "取得後に統計をリセットする",
+            "default": False,
+        },
+    },
+)
+async def server_stats_handler(arguments: dict) -> list[types.TextContent]:
+    """サーバーの実行統計を取得"""
+    output_format = arguments.get("format", "text")
+
+    tools = {name: stats.to_dict() for name, stats in sorted(tool_stats.items())}
+    cache = {
+        "entries": len(scenario_cache),
+        "estimated_bytes": scenario_cache.total_bytes,
+        "max_bytes": scenario_cache.max_bytes,
+        "hits": scenario_cache.hits,
+        "misses": scenario_cache.misses,
+    }
+
+    if arguments.get("reset"):
+        tool_stats.clear()
+
+    if output_format == "json":
+        payload = {"tools": tools, "scenario_cache": cache, "project_indexes": len(_project_indexes),
+                   "watched_projects": len(project_watchers),
+                   "group_commit": group_committer.to_dict() if group_committer else None, "trace_file": TRACE_FILE}
+        return [types.TextContent(type="text", text=json.dumps(payload, ensure_ascii=False, indent=2))]
+
+    lines = ["📈 サーバー統計", "=" * 60, "", "【ツール別】"]
+    if not tools:
+        lines.append("- まだツールは呼び出されていません")
+    for name, t in sorted(tools.items(), key=lambda item: -item[1]["total_ms"]):
+        lines.append(
+            f"- {name}: {t['calls']}回 (エラー {t['errors']}) "
+            f"平均 {t['avg_ms']:.1f}ms / p95 {t['p95_ms']:.1f}ms / 最大 {t['max_ms']:.1f}ms"
+        )
+        lines.append(
+            f"    読込 {t['bytes_read'] / 1024:.1f} KB / 書込 {t['bytes_written'] / 1024:.1f} KB / "
+            f"ファイル {t['files']}件 / キャッシュ ヒット {t['cache_hits']} ミス {t['cache_misses']}"
+        )
+
+    lines.append("")
+    lines.append("【解析キャッシュ】")
+    lines.append(f"- エントリ数: {cache['entries']}")
+    lines.append(f"- 推定メモリ: {cache['estimated_bytes'] / 1024 / 1024:.1f} / {cache['max_bytes'] / 1024 / 1024:.0f} MB")
+    lines.append(f"- ヒット/ミス: {cache['hits']} / {cache['misses']}")
+    lines.append(f"- 読み込み済みプロジェクトインデックス: {len(_project_indexes)}")
+    lines.append(f"- 監視中のプロジェクト: {len(project_watchers)}")
+    if group_committer:
+        gc = group_committer.to_dict()
+        lines.append("")
+        lines.append("【グループコミット】")
+        lines.append(f"- 待ち合わせ: {gc['window_ms']:.0f}ms / バッチ {gc['batches']}回 / ファイル {gc['files']}件 / 統合 {gc['coalesced']}件")
+    if TRACE_FILE:
+        lines.append(f"\nトレース出力先: {TRACE_FILE}")
+
+    return [types.TextContent(type="text", text="\n".join(lines))]
+
+
 async def main():
     """メイン関数"""
+    # インデックスの検証はバックグラウンドで行う
+    warmup = asyncio.get_running_loop().run_in_executor(None, warm_project_indexes)
+
+    # 前回の実行で削除しきれなかったゴミ箱の中身を片付ける
+    purge_all_trash()
+
+    # TYRANO_MCP_WATCH=1 で全プロジェクトを起動時から監視する
+    if os.environ.get("TYRANO_MCP_WATCH") == "1" and PROJECTS_DIR.exists():
+        for project_path in PROJECTS_DIR.iterdir():
+            if project_path.is_dir() and not project_path.name.startswith("."):
+                watcher = ProjectWatcher(project_path)
+                project_watchers[project_path] = watcher
+                await watcher.start()
+
     async with stdio_server() as (read_stream, write_stream):
         await app.run(
             read_stream,
@@ -1679,7 +5236,8 @@ async def main():
             app.create_initialization_options()
         )
 
+    await warmup
+
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
\ No newline at end of file
@@ -4,6 +4,7 @@ Test script for analysis features
 """
 
 import sys
+import json
 import asyncio
 from pathlib import Path
 
@@ -13,13 +14,53 @@ from server import (
     write_scenario_handler,
     analyze_project_handler,
     analyze_scenario_flow_handler,
+    analyze_reachability_handler,
+    analyze_routes_handler,
+    export_flow_graph_handler,
+    validate_project_handler,
+    find_asset_usages_handler,
+    find_variable_usages_handler,
     delete_project_handler,
+    parse_scenario,
+    scenario_cache,
+    drop_project_index,
+    get_project_index,
+    project_graph,
     PROJECTS_DIR
 )
 
 TEST_PROJECT = "analysis_test"
 
 
+def test_parser():
+    """パーサーのテスト"""
+    print("=" * 60)
+    print("Parser Test")
+    print("=" * 60)
+
+    ast = parse_scenario("""; コメント
+*start|タイトル
+[bg storage="room.jpg" time=500]こんにちは[p]
+@jump storage=sub.ks target=*sub_start
+#主人公
+[glink text="a]b" target="*next"]
+[iscript]
+f.flag = [1, 2];
+[endscript]
+""")
+
+    assert [label.name for label in ast.labels] == ["start"]
+    assert [tag.name for tag in ast.tags] == [
+        "bg", "p", "jump", "chara_ptext", "glink", "iscript", "endscript"
+    ]
+    assert ast.tags[0].attrs == {"storage": "room.jpg", "time": "500"}
+    assert ast.tags[2].target == "sub_start"
+    assert ast.tags[4].attrs["text"] == "a]b"
+    assert [t.text for t in ast.texts] == ["こんにちは"]
+    assert ast.scripts[0].code == "f.flag = [1, 2];"
+    print("✅ Parser test passed")
+
+
 async def test_analysis():
     """分析機能のテスト"""
     print("=" * 60)
@@ -110,6 +151,17 @@ async def test_analysis():
         "content": sub_scenario
     })
 
+    # 他ファイルのラベルを参照するシナリオ
+    await write_scenario_handler({
+        "project_name": TEST_PROJECT,
+        "scenario_file": "cross.ks",
+        "content": """*cross_start
+[call storage="sub.ks" target="*sub_routine"]
+[jump storage="sub.ks" target="*no_such_label"]
+[jump storage="main.ks"]
+"""
+    })
+
     # ダミーリソースを追加
     print("\n[3] Creating dummy resources...")
     project_path = PROJECTS_DIR / TEST_PROJECT
@@ -131,8 +183,105 @@ async def test_analysis():
     })
     print(result[0].text)
 
+    # 2回目は未変更ファイルを再解析しない
+    misses = scenario_cache.misses
+    await analyze_project_handler({
+        "project_name": TEST_PROJECT
+    })
+    assert scenario_cache.misses == misses, "unchanged scenarios were re-parsed"
+    print("✅ Parse cache reused for unchanged files")
+
+    # 再起動後もディスク上のインデックスから復元される
+    drop_project_index(project_path)
+    scenario_cache.clear()
+    summaries = get_project_index(project_path).refresh()
+    assert {"main.ks", "sub.ks", "cross.ks"} <= set(summaries)
+    assert scenario_cache.misses == misses, "fresh index entries were re-parsed"
+    assert (project_path / ".tyrano_mcp" / ".gitignore").read_text() == "*\n"
+    print("✅ Project index restored from disk")
+
+    # プロジェクト全体の検証
+    print("\n[5] Validating whole project...")
+    print("=" * 60)
+    result = await validate_project_handler({
+        "project_name": TEST_PROJECT
+    })
+    print(result[0].text)
+    assert "*no_such_label" in result[0].text
+    assert "*sub_routine" not in result[0].text
+    print("✅ Cross-file labels resolved")
+
+    # 素材の参照インデックス
+    print("\n[5b] Finding asset usages...")
+    await write_scenario_handler({
+        "project_name": TEST_PROJECT,
+        "scenario_file": "effects.ks",
+        "content": """*effects
+[chara_face name="hero" face="smile" storage="hero_smile.png"]
+[layermode graphic="flash.png" mode="screen"]
+[playvideo storage="op.webm"]
+[bg storage="room.jpg"]
+"""
+    })
+    result = await find_asset_usages_handler({"project_name": TEST_PROJECT, "asset": "room.jpg"})
+    print(result[0].text)
+    assert "main.ks:4 [bg]" in result[0].text and "effects.ks:5 [bg]" in result[0].text
+    result = await find_asset_usages_handler({"project_name": TEST_PROJECT, "scenario_file": "effects"})
+    print(result[0].text)
+    for expected in ("fgimage/hero_smile.png", "image/flash.png", "video/op.webm"):
+        assert expected in result[0].text
+
+    await write_scenario_handler({
+        "project_name": TEST_PROJECT,
+        "scenario_file": "effects.ks",
+        "content": "*effects\n[playvideo storage=\"op.webm\"]\n"
+    })
+    result = await find_asset_usages_handler({"project_name": TEST_PROJECT, "asset": "room.jpg"})
+    assert "effects.ks" not in result[0].text
+    print("✅ Asset usages resolved from the index")
+
+    # 変数の読み書き
+    print("\n[5c] Finding variable usages...")
+    await write_scenario_handler({
+        "project_name": TEST_PROJECT,
+        "scenario_file": "vars.ks",
+        "content": """*start
+[eval exp="f.love = 0"]
+[eval exp="f.love += 1; tf.tmp = f.bonus * 2"]
+[if exp="f.love > 3 && sf.cleared"]
+[jump target="*start" cond="f.route == 'a'"]
+[endif]
+[input name="f.name"]
+[iscript]
+f.count++;
+sf.unused = 1;
+[endscript]
+[emb exp="f.name"]
+"""
+    })
+    result = await find_variable_usages_handler({"project_name": TEST_PROJECT, "variable": "love"})
+    print(result[0].text)
+    assert "【代入】2箇所\n- vars.ks:2 [eval]\n- vars.ks:3 [eval]" in result[0].text
+    assert "vars.ks:4 [if]" in result[0].text
+    result = await find_variable_usages_handler({"project_name": TEST_PROJECT})
+    print(result[0].text)
+    unwritten, unread = result[0].text.split("【代入されるが参照されない変数】")
+    for name in ("f.bonus", "sf.cleared", "f.route"):
+        assert f"- {name} " in unwritten
+    assert "- tf.tmp " in unread and "- sf.unused (初出: vars.ks:10 [iscript])" in unread
+    assert "f.count" not in result[0].text and "f.name" not in result[0].text
+
+    await write_scenario_handler({
+        "project_name": TEST_PROJECT,
+        "scenario_file": "vars2.ks",
+        "content": "[eval exp=\"f.bonus = 5\"]\n"
+    })
+    result = await find_variable_usages_handler({"project_name": TEST_PROJECT, "query": "unwritten"})
+    assert "f.bonus" not in result[0].text and "sf.cleared" in result[0].text
+    print("✅ Variable def-use index passed")
+
     # シナリオフロー分析
-    print("\n[5] Analyzing scenario flow...")
+    print("\n[6] Analyzing scenario flow...")
     print("=" * 60)
     result = await analyze_scenario_flow_handler({
         "project_name": TEST_PROJECT,
@@ -140,8 +289,136 @@ async def test_analysis():
     })
     print(result[0].text)
 
+    # プロジェクト全体の到達可能性
+    print("\n[6b] Analyzing reachability...")
+    await write_scenario_handler({
+        "project_name": TEST_PROJECT,
+        "scenario_file": "first.ks",
+        "content": """*start
+[glink text="本編" storage="main.ks" target="*start"]
+[glink text="ループ" storage="loop.ks"]
+[s]
+*orphan
+迷子[p]
+"""
+    })
+    await write_scenario_handler({
+        "project_name": TEST_PROJECT,
+        "scenario_file": "loop.ks",
+        "content": """*loop_a
+[jump target="*loop_b" cond="f.skip"]
+[jump target="*loop_b"]
+*loop_b
+[jump target="*loop_a"]
+"""
+    })
+    result = await analyze_reachability_handler({"project_name": TEST_PROJECT})
+    text = result[0].text
+    print(text)
+    assert "first.ks: *orphan" in text
+    assert "sub.ks: *sub_start, *sub_routine" in text
+    assert "main.ks *end → [s] で停止" in text
+    assert "loop.ks *loop_a → loop.ks *loop_b" in text
+    assert "cross.ks:3 [jump]" in text
+    print("✅ Reachability analysis passed")
+
+    result = await analyze_routes_handler({"project_name": TEST_PROJECT})
+    text = result[0].text
+    print(text)
+    assert "main.ks *end: 2通り / 最短 62字 / 最長 64字" in text
+    assert "ループ: loop.ks *loop_a / loop.ks *loop_b: 1通り" in text
+    result = await analyze_routes_handler({"project_name": TEST_PROJECT, "entry": "main", "label": "*alone"})
+    assert "main.ks *end: 1通り / 最短 36字 / 最長 36字" in result[0].text
+
+    # 分岐が連続しても経路を列挙しない
+    diamonds = []
+    for i in range(40):
+        diamonds.append(f"""*q{i}
+[glink text="A" target="*a{i}"]
+[glink text="B" target="*b{i}"]
+[s]
+*a{i}
+[jump target="*q{i + 1}"]
+*b{i}
+[jump target="*q{i + 1}"]
+""")
+    await write_scenario_handler({
+        "project_name": TEST_PROJECT,
+        "scenario_file": "diamonds.ks",
+        "content": "".join(diamonds) + "*q40\n[s]\n"
+    })
+    result = await analyze_routes_handler({"project_name": TEST_PROJECT, "entry": "diamonds"})
+    assert f"diamonds.ks *q40: {2 ** 40}通り" in result[0].text
+
+    # ハブに戻るループは最短に含めず、call 先は [return] までの文字数を足す
+    await write_scenario_handler({
+        "project_name": TEST_PROJECT,
+        "scenario_file": "hub.ks",
+        "content": f"""*hub
+[glink text="A" target="*a"]
+[glink text="B" target="*b"]
+[glink text="終" target="*end"]
+[s]
+*a
+{"あ" * 600}[p]
+[jump target="*hub"]
+*b
+{"い" * 1200}[p]
+[jump target="*hub"]
+*end
+[call storage="hub_sub.ks" target="*sub"]
+おわり。[p]
+[s]
+"""
+    })
+    await write_scenario_handler({
+        "project_name": TEST_PROJECT,
+        "scenario_file": "hub_sub.ks",
+        "content": "*sub\nサブルーチン。[p]\n[return]\n"
+    })
+    result = await analyze_routes_handler({"project_name": TEST_PROJECT, "entry": "hub"})
+    print(result[0].text)
+    assert "hub.ks *end: 1通り / 最短 11字 / 最長 1811字 / 平均 11字" in result[0].text
+    print("✅ Route counting passed")
+
+    # 本文だけの変更はグラフを作り直さずに文字数を更新する
+    graph = await project_graph(project_path)
+    await write_scenario_handler({
+        "project_name": TEST_PROJECT,
+        "scenario_file": "main.ks",
+        "content": main_scenario.replace("おしまい。[p]", "おしまい。おしまい。[p]")
+    })
+    result = await analyze_routes_handler({"project_name": TEST_PROJECT})
+    updated = await project_graph(project_path)
+    assert updated is not graph and updated.targets is graph.targets, "graph was rebuilt for a text-only edit"
+    assert "main.ks *end: 2通り / 最短 67字 / 最長 69字 / 平均 68字" in result[0].text
+    result = await analyze_project_handler({"project_name": TEST_PROJECT})
+    print(result[0].text)
+    assert "main.ks *end: 最短 0.1 分 / 平均 0.1 分 / 最長 0.1 分 (2ルート)" in result[0].text
+    print("✅ Per-route playtime updated incrementally")
+
+    # フローグラフの書き出し
+    result = await export_flow_graph_handler({
+        "project_name": TEST_PROJECT, "format": "json", "scenario_file": "main.ks"
+    })
+    nodes = {tuple(node["labels"]): node for node in json.loads(result[1].text)["nodes"]}
+    assert ("", "start", "choice1") in nodes
+    assert {edge["kind"] for edge in nodes[("", "start", "choice1")]["edges"]} == {"choice"}
+    result = await export_flow_graph_handler({
+        "project_name": TEST_PROJECT, "format": "dot", "entry": "first.ks"
+    })
+    assert result[1].text.startswith("digraph scenario {") and "subgraph cluster_" in result[1].text
+    assert "diamonds.ks" not in result[1].text
+    result = await export_flow_graph_handler({
+        "project_name": TEST_PROJECT, "entry": "diamonds", "max_nodes": 10
+    })
+    print(result[0].text)
+    assert "10ノード" in result[0].text and "省略" in result[0].text
+    assert result[1].text.startswith("graph TD") and "...他" in result[1].text
+    print("✅ Flow graph export passed")
+
     # クリーンアップ
-    print("\n[6] Cleaning up...")
+    print("\n[7] Cleaning up...")
     await delete_project_handler({
         "project_name": TEST_PROJECT
     })
@@ -149,4 +426,5 @@ async def test_analysis():
 
 
 if __name__ == "__main__":
+    test_parser()
     asyncio.run(test_analysis())
\ No newline at end of file
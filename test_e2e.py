@@ -3,7 +3,11 @@
 End-to-End Test for TyranoStudio MCP Server
 """
 
+import os
+import re
 import sys
+import difflib
+import json
 import asyncio
 from pathlib import Path
 
@@ -20,7 +24,11 @@ from server import (
     list_audio_handler,
     generate_scenario_template_handler,
     delete_project_handler,
-    PROJECTS_DIR
+    call_tool,
+    trash_jobs,
+    write_text_file,
+    PROJECTS_DIR,
+    SYSTEM_MASTER_DIR
 )
 
 # テスト用プロジェクト名
@@ -56,6 +64,44 @@ async def test_project_management():
     assert project_path.exists(), f"Project directory not created: {project_path}"
     print(f"✅ Project directory exists: {project_path}")
 
+    # 4. リンクモードでの作成
+    print("\n[4] Creating project with copy_mode=link...")
+    linked_project = TEST_PROJECT + "_linked"
+    result = await create_project_handler({
+        "project_name": linked_project,
+        "template": "tyranoscript_ja",
+        "copy_mode": "link"
+    })
+    print(result[0].text)
+    linked_path = PROJECTS_DIR / linked_project
+    try:
+        assert (linked_path / "data" / "scenario" / "first.ks").stat().st_nlink == 1
+        engine_files = [p for p in (linked_path / "tyrano").rglob("*") if p.is_file()]
+        assert engine_files and all(p.exists() for p in engine_files)
+        # リンクしたエンジンファイルを書き換えてもテンプレートには反映されない
+        shared = next((p for p in engine_files if p.stat().st_nlink > 1), None)
+        if shared is not None:
+            template_file = SYSTEM_MASTER_DIR / "tyranoscript_ja" / shared.relative_to(linked_path)
+            original = template_file.read_bytes()
+            write_text_file(shared, "// edited\n")
+            assert template_file.read_bytes() == original and shared.stat().st_nlink == 1
+        print("✅ data/ copied, engine files shared")
+    finally:
+        result = await delete_project_handler({"project_name": linked_project})
+        print(result[0].text)
+
+    # 5. バックグラウンド削除の完了を確認
+    print("\n[5] Waiting for background delete...")
+    assert not linked_path.exists()
+    for job in list(trash_jobs.values()):
+        await job.task
+    result = await call_tool("trash_status", {})
+    print(result[0].text)
+    assert linked_project in result[0].text and "完了" in result[0].text
+    # 完了したジョブは一度報告したら消える
+    assert not trash_jobs
+    print("✅ Project removed in background")
+
     return True
 
 
@@ -98,6 +144,161 @@ async def test_scenario_operations():
     assert "これはテストシナリオです" in result[0].text
     print("✅ Scenario content verified")
 
+    # 2b. 範囲読み込み
+    print("\n[2b] Reading scenario by label / line range / offset...")
+    result = await read_scenario_handler({
+        "project_name": TEST_PROJECT,
+        "scenario_file": "test_scene.ks",
+        "label": "next"
+    })
+    assert result[0].text == "*next\n次のシーンです。[p]\n[s]"
+    print(result[1].text)
+
+    result = await read_scenario_handler({
+        "project_name": TEST_PROJECT,
+        "scenario_file": "test_scene.ks",
+        "start_line": 3,
+        "end_line": 4
+    })
+    assert result[0].text == '[cm]\n[bg storage="room.jpg"]'
+
+    chunks = []
+    offset = 0
+    while offset is not None:
+        result = await read_scenario_handler({
+            "project_name": TEST_PROJECT,
+            "scenario_file": "test_scene.ks",
+            "offset": offset,
+            "max_bytes": 40
+        })
+        chunks.append(result[0].text)
+        match = re.search(r"offset=(\d+)", result[1].text)
+        offset = int(match.group(1)) if match else None
+    assert "".join(chunks) == test_content
+
+    # 1文字(3バイト)より小さい max_bytes でも文字単位で進む
+    for max_bytes in (1, 2):
+        chunks = []
+        offset = 0
+        while offset is not None:
+            result = await read_scenario_handler({
+                "project_name": TEST_PROJECT,
+                "scenario_file": "test_scene.ks",
+                "offset": offset,
+                "max_bytes": max_bytes
+            })
+            chunks.append(result[0].text)
+            match = re.search(r"offset=(\d+)", result[1].text)
+            assert not match or int(match.group(1)) > offset, "offset did not advance"
+            offset = int(match.group(1)) if match else None
+        assert "".join(chunks) == test_content and "\ufffd" not in "".join(chunks)
+    print(f"✅ Range reads verified ({len(chunks)} chunks)")
+
+    # 2c. パッチ適用
+    print("\n[2c] Patching scenario...")
+    patched = test_content.replace("これはテストシナリオです。", "パッチ後のテキストです。")
+    diff = "\n".join(difflib.unified_diff(
+        test_content.split("\n"), patched.split("\n"), "a/test_scene.ks", "b/test_scene.ks", lineterm=""
+    ))
+    result = await call_tool("patch_scenario", {
+        "project_name": TEST_PROJECT,
+        "scenario_file": "test_scene.ks",
+        "diff": diff
+    })
+    print(result[0].text)
+    assert "変更行: 6-6" in result[0].text
+
+    result = await call_tool("patch_scenario", {
+        "project_name": TEST_PROJECT,
+        "scenario_file": "test_scene.ks",
+        "operations": [{"label": "next", "content": "*next\n書き換えたシーンです。[p]\n[s]"}]
+    })
+    print(result[0].text)
+    result = await read_scenario_handler({
+        "project_name": TEST_PROJECT,
+        "scenario_file": "test_scene.ks"
+    })
+    assert result[0].text == patched.replace("次のシーンです。", "書き換えたシーンです。")
+
+    result = await call_tool("patch_scenario", {
+        "project_name": TEST_PROJECT,
+        "scenario_file": "test_scene.ks",
+        "diff": diff
+    })
+    assert "パッチを適用できません" in result[0].text
+
+    # 改行コードは元のファイルに合わせる
+    scenario_dir = PROJECTS_DIR / TEST_PROJECT / "data" / "scenario"
+    (scenario_dir / "crlf.ks").write_bytes("*start\r\nhello[p]\r\n*next\r\nbye[p]\r\n".encode("utf-8"))
+    result = await call_tool("patch_scenario", {
+        "project_name": TEST_PROJECT,
+        "scenario_file": "crlf.ks",
+        "operations": [{"label": "next", "content": "*next\nsee you[p]"}]
+    })
+    print(result[0].text)
+    assert (scenario_dir / "crlf.ks").read_bytes() == b"*start\r\nhello[p]\r\n*next\r\nsee you[p]\r\n"
+    (scenario_dir / "crlf.ks").unlink()
+    print("✅ Patches applied")
+
+    assert not list(scenario_dir.glob("*.tmp")), "temporary files left behind"
+    umask = os.umask(0)
+    os.umask(umask)
+    assert (scenario_dir / "test_scene.ks").stat().st_mode & 0o777 == 0o666 & ~umask
+
+    # 2d. 再帰的なファイル一覧
+    print("\n[2d] Listing project files recursively...")
+    await write_scenario_handler({
+        "project_name": TEST_PROJECT,
+        "scenario_file": "test_scene_2.ks",
+        "content": "*start\n[s]\n"
+    })
+    result = await call_tool("list_project_files", {
+        "project_name": TEST_PROJECT,
+        "recursive": True,
+        "pattern": "test_scene*",
+        "extensions": ["ks"],
+        "limit": 1
+    })
+    print(result[0].text)
+    assert result[0].text.count("[FILE]") == 1
+    cursor = re.search(r'cursor="([^"]+)"', result[0].text)
+    assert cursor, "no cursor for the second page"
+    first_page = result[0].text
+    result = await call_tool("list_project_files", {
+        "project_name": TEST_PROJECT,
+        "recursive": True,
+        "pattern": "test_scene*",
+        "extensions": ["ks"],
+        "limit": 1,
+        "cursor": cursor.group(1)
+    })
+    print(result[0].text)
+    assert result[0].text.count("[FILE]") == 1 and "cursor=" not in result[0].text
+    pages = first_page + result[0].text
+    assert "data/scenario/test_scene.ks" in pages and "data/scenario/test_scene_2.ks" in pages
+    (scenario_dir / "test_scene_2.ks").unlink()
+    result = await call_tool("list_project_files", {
+        "project_name": TEST_PROJECT,
+        "recursive": True,
+        "pattern": "test_scene.ks"
+    })
+    assert "[FILE] data/scenario/test_scene.ks" in result[0].text
+    # 親を指すシンボリックリンクがあっても循環しない
+    loop_link = scenario_dir / "loop"
+    os.symlink("..", loop_link)
+    try:
+        result = await call_tool("list_project_files", {"project_name": TEST_PROJECT, "recursive": True})
+    finally:
+        loop_link.unlink()
+    assert "[DIR]  data/scenario/loop" in result[0].text and "data/scenario/loop/" not in result[0].text
+    print("✅ Recursive listing verified")
+
+    await write_scenario_handler({
+        "project_name": TEST_PROJECT,
+        "scenario_file": "test_scene.ks",
+        "content": test_content
+    })
+
     # 3. シナリオ検証
     print("\n[3] Validating scenario...")
     result = await validate_scenario_handler({
@@ -288,6 +489,135 @@ async def test_resource_validation():
     return True
 
 
+async def test_bulk_import():
+    """素材一括取り込みのテスト"""
+    print("\n" + "=" * 60)
+    print("TEST: Bulk Import Assets")
+    print("=" * 60)
+
+    print("\n[1] Creating source files...")
+    source_dir = PROJECTS_DIR / TEST_PROJECT / "import_source"
+    (source_dir / "sprites").mkdir(parents=True, exist_ok=True)
+    (source_dir / "bg_room.jpg").write_bytes(b"room image")
+    (source_dir / "bg_room_copy.jpg").write_bytes(b"room image")
+    (source_dir / "sprites" / "akane.png").write_bytes(b"akane sprite")
+    (source_dir / "readme.txt").write_text("not an asset")
+
+    print("\n[2] Importing...")
+    arguments = {
+        "project_name": TEST_PROJECT,
+        "source": str(source_dir),
+        "rules": [
+            {"pattern": "bg_*", "category": "bgimage"},
+            {"pattern": "sprites/*.png", "category": "fgimage"},
+        ],
+    }
+    result = await call_tool("bulk_import_assets", arguments)
+    print(result[0].text)
+    assert "【取り込み】2件" in result[0].text
+    assert "【重複のためスキップ】1件" in result[0].text
+    assert "【ルールに一致せず未取り込み】1件" in result[0].text
+    assert (PROJECTS_DIR / TEST_PROJECT / "data" / "fgimage" / "akane.png").exists()
+    result = await call_tool("server_stats", {"format": "json"})
+    stats = json.loads(result[0].text)["tools"]["bulk_import_assets"]
+    assert stats["bytes_written"] == len(b"room image") + len(b"akane sprite")
+    assert stats["bytes_read"] > 0
+
+    print("\n[3] Importing again (all duplicates)...")
+    result = await call_tool("bulk_import_assets", arguments)
+    assert "【取り込み】0件" in result[0].text
+    assert "【重複のためスキップ】3件" in result[0].text
+    print("✅ Bulk import verified")
+
+    print("\n[4] Reclaiming duplicates across categories...")
+    data_dir = PROJECTS_DIR / TEST_PROJECT / "data"
+    (data_dir / "image").mkdir(parents=True, exist_ok=True)
+    (data_dir / "image" / "room_thumb.jpg").write_bytes(b"room image")
+    result = await call_tool("dedupe_assets", {"project_name": TEST_PROJECT})
+    print(result[0].text)
+    assert "重複: 1種類" in result[0].text
+    result = await call_tool("dedupe_assets", {"project_name": TEST_PROJECT, "action": "reclaim"})
+    print(result[0].text)
+    assert (data_dir / "image" / "room_thumb.jpg").samefile(data_dir / "bgimage" / "bg_room.jpg")
+    print("✅ Duplicates reclaimed")
+
+    return True
+
+
+async def test_server_stats():
+    """ツール実行統計のテスト"""
+    print("\n" + "=" * 60)
+    print("TEST: Server Stats")
+    print("=" * 60)
+
+    print("\n[1] Calling tools through call_tool...")
+    await call_tool("read_scenario", {
+        "project_name": TEST_PROJECT,
+        "scenario_file": "test_scene.ks"
+    })
+
+    print("\n[2] Fetching server stats...")
+    result = await call_tool("server_stats", {"format": "json"})
+    print(result[0].text)
+
+    stats = json.loads(result[0].text)
+    assert stats["tools"]["read_scenario"]["calls"] >= 1
+    assert stats["tools"]["read_scenario"]["bytes_read"] > 0
+    print("✅ Tool calls recorded")
+
+    import server
+    tools = await server.list_tools()
+    tools.clear()
+    assert await server.list_tools(), "list_tools returned the registry itself"
+
+    print("\n[3] Writing traces in the background...")
+    trace_path = PROJECTS_DIR / TEST_PROJECT / "trace.jsonl"
+    server.TRACE_FILE = str(trace_path)
+    try:
+        for _ in range(3):
+            await call_tool("list_projects", {})
+        server._trace_writer.close()
+    finally:
+        server.TRACE_FILE, server._trace_writer = None, None
+    records = [json.loads(line) for line in trace_path.read_text(encoding="utf-8").splitlines()]
+    assert [record["tool"] for record in records] == ["list_projects"] * 3
+    print("✅ Traces written")
+
+    return True
+
+
+async def test_project_watcher():
+    """プロジェクト監視のテスト"""
+    print("\n" + "=" * 60)
+    print("TEST: Project Watcher")
+    print("=" * 60)
+
+    print("\n[1] Starting watcher...")
+    result = await call_tool("watch_project", {"project_name": TEST_PROJECT, "interval": 60})
+    print(result[0].text)
+    assert "監視を開始" in result[0].text
+
+    print("\n[2] Adding audio through the server...")
+    source = PROJECTS_DIR / TEST_PROJECT / "watched_source.ogg"
+    source.write_text("dummy watched bgm")
+    await add_audio_handler({
+        "project_name": TEST_PROJECT,
+        "source_path": str(source),
+        "audio_type": "bgm",
+        "dest_filename": "watched.ogg"
+    })
+    result = await list_audio_handler({"project_name": TEST_PROJECT, "audio_type": "bgm"})
+    assert "watched.ogg" in result[0].text
+    print("✅ Change notified to watcher")
+
+    print("\n[3] Stopping watcher...")
+    result = await call_tool("watch_project", {"project_name": TEST_PROJECT, "action": "stop"})
+    assert "監視を停止" in result[0].text
+    print("✅ Watcher stopped")
+
+    return True
+
+
 async def cleanup():
     """テストプロジェクトのクリーンアップ"""
     print("\n" + "=" * 60)
@@ -303,6 +633,9 @@ async def cleanup():
     # プロジェクトが削除されたか確認
     project_path = PROJECTS_DIR / TEST_PROJECT
     assert not project_path.exists(), f"Project directory not deleted: {project_path}"
+    # 解析キャッシュも破棄されている
+    from server import scenario_cache
+    assert not any(path.is_relative_to(project_path) for path in scenario_cache._entries)
     print(f"✅ Project deleted successfully")
 
 
@@ -319,6 +652,9 @@ async def run_all_tests():
         ("Advanced Validation", test_validation_advanced),
         ("Audio Management", test_audio_management),
         ("Resource Validation", test_resource_validation),
+        ("Bulk Import", test_bulk_import),
+        ("Server Stats", test_server_stats),
+        ("Project Watcher", test_project_watcher),
     ]
 
     passed = 0